@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Synthetic phantoms for benchmarks
+
+Generates tractograms (.tck), tcksample style text output, NIfTI / MRtrix
+images and complete BIDS derivative and template trees at a configurable
+scale. All generators are seeded so that repeated runs produce identical
+data
+"""
+import os
+import os.path as op
+
+import numpy as np
+
+# Size of the phantoms at each benchmark scale
+SCALES = {
+    'small': {'streamlines': 2000, 'points': 40, 'shape': (32, 32, 20),
+              'directions': 16, 'subjects': 2},
+    'medium': {'streamlines': 50000, 'points': 80, 'shape': (64, 64, 40),
+               'directions': 32, 'subjects': 8},
+    'large': {'streamlines': 500000, 'points': 100, 'shape': (96, 96, 60),
+              'directions': 64, 'subjects': 32},
+}
+
+VOXEL_SIZE = 2.0
+
+# Streamlines generated at a time, bounds memory for large phantoms
+BLOCK = 10000
+
+
+def getAffine(shape, voxel=VOXEL_SIZE):
+    """ Voxel to scanner transform centring an image of shape on the origin """
+    affine = np.diag([voxel, voxel, voxel, 1.])
+    affine[:3, 3] = -voxel * (np.array(shape[:3]) - 1) / 2.
+
+    return affine
+
+
+def _randomWalks(rng, n_streamlines, n_points, shape, voxel=VOXEL_SIZE):
+    """ Smooth random walks of n_points vertices within the image extent """
+    extent = voxel * (np.array(shape[:3]) - 1) / 2.
+    start = rng.uniform(-0.8, 0.8, size=(n_streamlines, 1, 3)) * extent
+    steps = rng.normal(size=(n_streamlines, n_points, 3))
+    steps = np.cumsum(steps, axis=1) * 0.05 + rng.normal(size=(n_streamlines,
+                                                               1, 3))
+    steps *= voxel * 0.5 / np.linalg.norm(steps, axis=2, keepdims=True)
+    points = start + np.cumsum(steps, axis=1)
+
+    return np.clip(points, -extent, extent).astype(np.float32)
+
+
+def makeTck(out_file, n_streamlines, n_points=40, shape=(32, 32, 20),
+            seed=0):
+    """ Write a .tck of n_streamlines random walks of n_points vertices """
+    from mrtpipelines.interfaces.tck import writeHeader
+
+    rng = np.random.RandomState(seed)
+    header = {'datatype': 'Float32LE',
+              'count': str(n_streamlines),
+              'total_count': str(n_streamlines)}
+    delim = np.full((1, 3), np.nan, dtype='<f4')
+
+    with open(out_file, 'wb') as f:
+        writeHeader(f, header)
+        for first in range(0, n_streamlines, BLOCK):
+            count = min(BLOCK, n_streamlines - first)
+            walks = _randomWalks(rng, count, n_points, shape)
+            block = np.concatenate([walks,
+                                    np.broadcast_to(delim, (count, 1, 3))],
+                                   axis=1)
+            f.write(block.astype('<f4').tobytes())
+        f.write(np.full((1, 3), np.inf, dtype='<f4').tobytes())
+
+    return out_file
+
+
+def makeSampleText(out_file, lengths, seed=0):
+    """
+    Write tcksample style output: a comment header followed by one line of
+    space separated values per streamline, with lengths[i] values on line i
+    """
+    rng = np.random.RandomState(seed)
+    lengths = np.asarray(lengths)
+
+    with open(out_file, 'w') as f:
+        f.write("# mrtrix_version: benchmark\n")
+        f.write("# timestamp: 0\n")
+        for first in range(0, lengths.size, BLOCK):
+            block = lengths[first:first + BLOCK]
+            values = rng.uniform(0, 1, size=int(block.sum()))
+            lines = np.split(values, np.cumsum(block)[:-1])
+            f.write("".join(" ".join("%g" % v for v in line) + "\n"
+                            for line in lines))
+
+    return out_file
+
+
+def makeNifti(out_file, data, affine=None):
+    """ Write data as a NIfTI image """
+    import nibabel as nib
+
+    if affine is None:
+        affine = getAffine(data.shape)
+    nib.Nifti1Image(data, affine).to_filename(out_file)
+
+    return out_file
+
+
+def makeMif(out_file, data, affine=None):
+    """ Write data as an MRtrix image """
+    from mrtpipelines.interfaces import mif
+
+    if affine is None:
+        affine = getAffine(data.shape)
+
+    return mif.save(out_file, np.asarray(data, dtype=np.float32), affine)
+
+
+def makeScalar(out_file, shape=(32, 32, 20), seed=0):
+    """ Smooth random scalar map in [0, 1] """
+    rng = np.random.RandomState(seed)
+    grid = np.meshgrid(*[np.linspace(0, np.pi, d) for d in shape],
+                       indexing='ij')
+    data = np.sin(grid[0] * rng.uniform(1, 3)) * \
+        np.cos(grid[1] * rng.uniform(1, 3)) * np.sin(grid[2])
+    data = (0.5 + 0.5 * data).astype(np.float32)
+
+    if out_file.endswith('.mif'):
+        return makeMif(out_file, data)
+
+    return makeNifti(out_file, data)
+
+
+def makeDwi(out_base, shape=(32, 32, 20), directions=16, shells=(1000, 2000),
+            seed=0):
+    """
+    Multi-shell DWI phantom: out_base.nii.gz with out_base.bval and
+    out_base.bvec (FSL format). Returns the three paths
+    """
+    rng = np.random.RandomState(seed)
+    bvecs = rng.normal(size=(directions, 3))
+    bvecs /= np.linalg.norm(bvecs, axis=1, keepdims=True)
+
+    bvals = [0.]
+    vecs = [np.zeros(3)]
+    for shell in shells:
+        bvals.extend([float(shell)] * directions)
+        vecs.extend(bvecs)
+    bvals = np.array(bvals)
+    vecs = np.array(vecs)
+
+    # Single tensor signal with a uniform diffusivity
+    adc = 0.7e-3
+    signal = 1000. * np.exp(-bvals * adc)
+    data = np.broadcast_to(signal, tuple(shape) + (bvals.size,))
+    data = (data * rng.uniform(0.9, 1.1, size=data.shape)).astype(np.float32)
+
+    makeNifti(out_base + '.nii.gz', data)
+    np.savetxt(out_base + '.bval', bvals[None], fmt='%g')
+    np.savetxt(out_base + '.bvec', vecs.T, fmt='%.6f')
+
+    return out_base + '.nii.gz', out_base + '.bval', out_base + '.bvec'
+
+
+def makeBIDS(root, scale='small', space='Template', scalars=('FA', 'MD')):
+    """
+    Derivatives tree with, for each subject, a preprocessed DWI with its
+    brainmask and gradients, a tractogram and DTI scalar maps in space.
+    Returns the list of subject ids
+    """
+    params = SCALES[scale]
+    shape = params['shape']
+    subjects = ['sub-%03d' % (idx + 1) for idx in range(params['subjects'])]
+
+    for idx, subjid in enumerate(subjects):
+        dwi_dir = op.join(root, subjid, 'dwi')
+        if not op.exists(dwi_dir):
+            os.makedirs(dwi_dir)
+
+        makeDwi(op.join(dwi_dir, '%s_preproc' % subjid), shape,
+                params['directions'], seed=idx)
+        makeNifti(op.join(dwi_dir, '%s_brainmask.nii.gz' % subjid),
+                  np.ones(shape, dtype=np.uint8))
+        makeTck(op.join(dwi_dir, '%s_space-%s_desc-iFOD2_tractography.tck' %
+                        (subjid, space)),
+                params['streamlines'], params['points'], shape, seed=idx)
+        for sidx, scalar in enumerate(scalars):
+            makeScalar(op.join(dwi_dir, '%s_space-%s_model-DTI_%s.nii.gz' %
+                               (subjid, space, scalar)),
+                       shape, seed=idx * len(scalars) + sidx)
+
+    return subjects
+
+
+def makeTemplate(template_dir, template_label='sub-Template',
+                 shape=(32, 32, 20)):
+    """ Template FOD, response functions and brainmask as read by getTemplate """
+    for sub in ('response', 'dwi'):
+        if not op.exists(op.join(template_dir, sub)):
+            os.makedirs(op.join(template_dir, sub))
+
+    fod = np.zeros(tuple(shape) + (45,), dtype=np.float32)
+    fod[..., 0] = 0.28
+    makeMif(op.join(template_dir, 'response',
+                    '%s_wmfod.mif' % template_label), fod)
+    for tissue in ('wm', 'gm', 'csf'):
+        np.savetxt(op.join(template_dir, 'response',
+                           '%s_%sresponse.txt' % (template_label, tissue)),
+                   [[1000., -300., 100., -20., 5.]] * 3, fmt='%g')
+    makeMif(op.join(template_dir, 'dwi',
+                    '%s_brainmask.mif' % template_label),
+            np.ones(shape, dtype=np.float32))
+
+    return template_dir
@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Benchmark suite
+
+Times workflow construction, the BIDS grabbers, scalar writing and
+sampling, and end-to-end runs of the command line pipelines against
+synthetic phantoms, with MRtrix replaced by stub executables. Results are
+written as JSON and can be compared against a previous run to flag
+regressions:
+
+    python -m benchmarks.run --scale small -o results.json
+    python -m benchmarks.run --scale small --compare results.json
+"""
+import json
+import os
+import os.path as op
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+REPO = op.dirname(op.dirname(op.realpath(__file__)))
+PIPELINES = op.join(REPO, 'mrtpipelines', 'pipelines')
+
+BENCHMARKS = []
+
+
+def benchmark(name, repeat=None):
+    """
+    Register a benchmark. The decorated function receives the Context, does
+    any untimed setup and returns the callable that is timed
+    """
+    def register(func):
+        BENCHMARKS.append((name, func, repeat))
+        return func
+    return register
+
+
+class Context(object):
+    """ Phantom data, stub executables and scratch space shared by benchmarks """
+
+    def __init__(self, root, scale='small'):
+        from benchmarks import phantoms, stubs
+
+        self.root = root
+        self.scale = scale
+        self.params = phantoms.SCALES[scale]
+
+        self.bin_dir = stubs.installStubs(op.join(root, 'bin'))
+        self.bids_dir = op.join(root, 'bids', 'derivatives')
+        self.subjects = phantoms.makeBIDS(self.bids_dir, scale)
+        self.template_dir = phantoms.makeTemplate(op.join(root, 'template'),
+                                                  'sub-Template',
+                                                  self.params['shape'])
+        self.template_label = 'sub-Template'
+
+        # tcksample output matching the first subject's tractogram
+        from mrtpipelines.interfaces.tck import TckFile
+
+        self.tract = op.join(self.bids_dir, self.subjects[0], 'dwi',
+                             '%s_space-Template_desc-iFOD2_tractography.tck' %
+                             self.subjects[0])
+        self.scalars = [op.join(self.bids_dir, self.subjects[0], 'dwi',
+                                '%s_space-Template_model-DTI_%s.nii.gz' %
+                                (self.subjects[0], scalar))
+                        for scalar in ('FA', 'MD')]
+        self.samples = phantoms.makeSampleText(op.join(root, 'samples.txt'),
+                                               TckFile(self.tract).lengths)
+
+        self._scratch = 0
+
+    def scratch(self):
+        """ New empty directory """
+        self._scratch += 1
+        path = op.join(self.root, 'scratch', str(self._scratch))
+        os.makedirs(path)
+        return path
+
+    def env(self):
+        """ Environment with the stub executables first on PATH """
+        env = dict(os.environ)
+        env['PATH'] = self.bin_dir + os.pathsep + env.get('PATH', '')
+        env['PYTHONPATH'] = os.pathsep.join([REPO] +
+                                            [p for p in [env.get('PYTHONPATH')]
+                                             if p])
+        return env
+
+
+# Workflow construction
+@benchmark('wf_preproc')
+def benchPreprocWf(ctx):
+    from mrtpipelines.workflows import preproc_wf
+
+    wdir = ctx.scratch()
+
+    def run():
+        preproc_wf.dholl_preproc_wf(template_dir=ctx.template_dir,
+                                    template_label=ctx.template_label,
+                                    wdir=wdir, nthreads=4)
+    return run
+
+
+@benchmark('wf_tract')
+def benchTractWf(ctx):
+    from mrtpipelines.workflows import tractography_wf
+
+    wdir = ctx.scratch()
+
+    def run():
+        tractography_wf.genDhollTract_wf(wdir=wdir, nthreads=4)
+    return run
+
+
+# BIDS grabbers
+@benchmark('bids_index_refresh')
+def benchIndexRefresh(ctx):
+    from mrtpipelines.interfaces.bidsindex import BIDSIndex
+
+    wdir = ctx.scratch()
+    runs = [0]
+
+    def run():
+        runs[0] += 1
+        db_file = op.join(wdir, 'index%d.sqlite' % runs[0])
+        BIDSIndex(db_file, root=ctx.bids_dir).refresh().close()
+    return run
+
+
+@benchmark('bids_get_data')
+def benchGetData(ctx):
+    from mrtpipelines.interfaces import io
+    from mrtpipelines.interfaces.bidsindex import BIDSIndex
+
+    db_file = op.join(ctx.scratch(), 'index.sqlite')
+    BIDSIndex(db_file, root=ctx.bids_dir).refresh().close()
+
+    def run():
+        for subjid in ctx.subjects:
+            io._getData(db_file, subjid, None)
+    return run
+
+
+@benchmark('bids_get_scalar_data')
+def benchGetScalarData(ctx):
+    from mrtpipelines.interfaces import io
+    from mrtpipelines.interfaces.bidsindex import BIDSIndex
+
+    db_file = op.join(ctx.scratch(), 'index.sqlite')
+    BIDSIndex(db_file, root=ctx.bids_dir).refresh().close()
+
+    def run():
+        for subjid in ctx.subjects:
+            io._getScalarData(db_file, subjid, ['FA', 'MD'], 'Template')
+    return run
+
+
+# Scalar writing and sampling
+def _writeScalarBench(out_format):
+    def setup(ctx):
+        from mrtpipelines.interfaces import tractography
+
+        def run():
+            tractography._writeScalar(ctx.samples, ctx.scratch(),
+                                      out_format=out_format)
+        return run
+    return setup
+
+
+benchmark('write_scalar_txt')(_writeScalarBench('txt'))
+benchmark('write_scalar_npz')(_writeScalarBench('npz'))
+
+
+@benchmark('sample_tract')
+def benchSampleTract(ctx):
+    from mrtpipelines.interfaces import tractography
+
+    def run():
+        tractography._sampleTract(ctx.tract, ctx.scalars, ctx.scratch(),
+                                  out_format='npz', names=['FA', 'MD'],
+                                  combine=True)
+    return run
+
+
+@benchmark('tract_stats')
+def benchTractStats(ctx):
+    from mrtpipelines.interfaces import tractstats
+
+    def run():
+        tractstats.tractStats(ctx.tract, ctx.samples,
+                              op.join(ctx.scratch(), 'stats.npz'),
+                              names=['FA'], npoints=20)
+    return run
+
+
+@benchmark('index_tract')
+def benchIndexTract(ctx):
+    from mrtpipelines.interfaces import tckindex
+
+    mask = op.join(ctx.bids_dir, ctx.subjects[0], 'dwi',
+                   '%s_brainmask.nii.gz' % ctx.subjects[0])
+
+    def run():
+        tckindex.buildIndex(ctx.tract, mask,
+                            op.join(ctx.scratch(), 'tractindex.npz'))
+    return run
+
+
+@benchmark('select_tract')
+def benchSelectTract(ctx):
+    import numpy as np
+
+    from benchmarks import phantoms
+    from mrtpipelines.interfaces import tckindex
+
+    wdir = ctx.scratch()
+    mask = op.join(ctx.bids_dir, ctx.subjects[0], 'dwi',
+                   '%s_brainmask.nii.gz' % ctx.subjects[0])
+    index_file = tckindex.buildIndex(ctx.tract, mask,
+                                     op.join(wdir, 'tractindex.npz'))
+
+    # Small ROI at the centre of the image
+    shape = ctx.params['shape']
+    roi = np.zeros(shape, dtype=np.uint8)
+    centre = [d // 2 for d in shape]
+    roi[tuple(slice(c - 2, c + 2) for c in centre)] = 1
+    roi_file = phantoms.makeNifti(op.join(wdir, 'roi.nii.gz'), roi)
+
+    def run():
+        tckindex.selectTck(ctx.tract, op.join(wdir, 'selected.tck'),
+                           include=[roi_file], index_file=index_file)
+    return run
+
+
+def _exportBench(fmt):
+    def setup(ctx):
+        from mrtpipelines.interfaces import tckexport
+
+        mask = op.join(ctx.bids_dir, ctx.subjects[0], 'dwi',
+                       '%s_brainmask.nii.gz' % ctx.subjects[0])
+
+        def run():
+            tckexport.exportTck(ctx.tract, op.join(ctx.scratch(), 'tract'),
+                                [fmt], ref_image=mask)
+        return run
+    return setup
+
+
+benchmark('export_vtk')(_exportBench('vtk'))
+benchmark('export_trk')(_exportBench('trk'))
+
+
+@benchmark('fit_tensor')
+def benchFitTensor(ctx):
+    from mrtpipelines.interfaces import mif, tensor
+
+    wdir = ctx.scratch()
+    dwi_base = op.join(ctx.bids_dir, ctx.subjects[0], 'dwi',
+                       '%s_preproc' % ctx.subjects[0])
+    dwi_file = mif.convertNifti(dwi_base + '.nii.gz',
+                                op.join(wdir, 'dwi.mif'),
+                                (dwi_base + '.bvec', dwi_base + '.bval'))
+    out_files = [op.join(wdir, '%s.mif' % out)
+                 for out in ('tensor', 'fa', 'md', 'ad', 'rd')]
+
+    def run():
+        tensor.fitImage(dwi_file, out_files, nprocs=4)
+    return run
+
+
+@benchmark('work_queue')
+def benchWorkQueue(ctx):
+    import threading
+
+    from mrtpipelines.interfaces import workqueue
+
+    # Queue overhead: no-op tasks shared by 4 workers
+    def run():
+        queue_dir = ctx.scratch()
+        for task in range(32):
+            workqueue.submit(queue_dir, 'task-%02d' % task,
+                             [sys.executable, '-I', '-c', 'pass'])
+        workers = [threading.Thread(target=workqueue.runWorker,
+                                    args=(queue_dir, 'worker-%d' % worker),
+                                    kwargs={'heartbeat': 1., 'poll': 0.1})
+                   for worker in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        report = workqueue.coordinate(queue_dir, once=True)
+        if report['counts']['done'] != 32:
+            raise RuntimeError("Tasks not done: %s" % report['counts'])
+    return run
+
+
+# End-to-end pipelines
+def _runPipeline(ctx, args):
+    proc = subprocess.run([sys.executable] + args, env=ctx.env(),
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError("%s failed:\n%s" % (op.basename(args[0]),
+                                               proc.stdout[-2000:]))
+
+
+@benchmark('e2e_tractScalar', repeat=1)
+def benchTractScalar(ctx):
+    def run():
+        wdir = ctx.scratch()
+        _runPipeline(ctx, [op.join(PIPELINES, 'tractScalar'), ctx.bids_dir,
+                           ctx.subjects[0], 'FA', 'MD', '-s', 'Template',
+                           '-w', op.join(wdir, 'work'),
+                           '-o', op.join(wdir, 'out')])
+    return run
+
+
+@benchmark('e2e_tractScalar_group', repeat=1)
+def benchTractScalarGroup(ctx):
+    def run():
+        wdir = ctx.scratch()
+        _runPipeline(ctx, [op.join(PIPELINES, 'tractScalar'), ctx.bids_dir,
+                           'all', 'FA', 'MD', '-s', 'Template', '--group',
+                           '-e', 'python', '-j', '4', '--stats',
+                           '-w', op.join(wdir, 'work'),
+                           '-o', op.join(wdir, 'out')])
+    return run
+
+
+@benchmark('e2e_tractScalar_dry_run')
+def benchTractScalarDryRun(ctx):
+    wdir = ctx.scratch()
+
+    def run():
+        _runPipeline(ctx, [op.join(PIPELINES, 'tractScalar'), ctx.bids_dir,
+                           ctx.subjects[0], 'FA', 'MD', '-s', 'Template',
+                           '--dry-run', '-w', op.join(wdir, 'work'),
+                           '-o', op.join(wdir, 'out')])
+    return run
+
+
+@benchmark('e2e_genDhollanderTractography', repeat=1)
+def benchGenDholl(ctx):
+    def run():
+        wdir = ctx.scratch()
+        _runPipeline(ctx, [op.join(PIPELINES, 'genDhollanderTractography'),
+                           op.dirname(ctx.bids_dir), ctx.template_dir,
+                           ctx.template_label, ctx.subjects[0],
+                           '-N', '100', '-w', op.join(wdir, 'work'),
+                           '-o', op.join(wdir, 'out')])
+    return run
+
+
+def _stats(times):
+    times = sorted(times)
+    mid = len(times) // 2
+    median = times[mid] if len(times) % 2 else (times[mid - 1] +
+                                                 times[mid]) / 2.
+    return {'min_s': times[0],
+            'median_s': median,
+            'mean_s': sum(times) / len(times),
+            'max_s': times[-1],
+            'repeat': len(times)}
+
+
+def runBenchmarks(scale='small', repeat=5, only=None, root=None):
+    """ Run the registered benchmarks, returning the results as a dict """
+    from mrtpipelines._version import __version__
+
+    root = op.abspath(root or tempfile.mkdtemp(prefix='mrtpipelines_bench_'))
+    start = time.perf_counter()
+    ctx = Context(root, scale)
+    setup_s = time.perf_counter() - start
+
+    results = {'version': __version__,
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'scale': scale,
+               'params': ctx.params,
+               'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'phantom_setup_s': setup_s,
+               'benchmarks': {}}
+
+    # Relative paths written by the benchmarks (or the commands they run)
+    # land in the scratch root, never in the working directory
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        for name, setup, bench_repeat in BENCHMARKS:
+            if only and name not in only:
+                continue
+            try:
+                func = setup(ctx)
+                times = []
+                for _ in range(bench_repeat or repeat):
+                    start = time.perf_counter()
+                    func()
+                    times.append(time.perf_counter() - start)
+                result = _stats(times)
+                result['status'] = 'ok'
+            except Exception:
+                result = {'status': 'error',
+                          'error': traceback.format_exc(limit=3)}
+            results['benchmarks'][name] = result
+            print("%-32s %s" % (name, "%.4f s" % result['median_s']
+                                if result['status'] == 'ok' else 'error'))
+    finally:
+        os.chdir(cwd)
+
+    return results
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Print the change in median time of each benchmark against baseline and
+    return the names of those slower by more than threshold (fraction)
+    """
+    regressions = []
+    print("%-32s %10s %10s %8s" % ('benchmark', 'baseline', 'current',
+                                   'change'))
+    for name, result in sorted(results['benchmarks'].items()):
+        base = baseline.get('benchmarks', {}).get(name)
+        if result['status'] != 'ok' or not base or base['status'] != 'ok':
+            continue
+        change = result['median_s'] / base['median_s'] - 1.
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print("%-32s %9.4fs %9.4fs %+7.1f%%%s" % (name, base['median_s'],
+                                                   result['median_s'],
+                                                   100 * change, flag))
+
+    return regressions
+
+
+def get_parser():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Run the mrtpipelines benchmarks")
+    parser.add_argument("--scale", default="small",
+                        choices=["small", "medium", "large"],
+                        help="Size of the synthetic phantoms")
+    parser.add_argument("-r", "--repeat", default=5, type=int,
+                        help="Timed repetitions of each benchmark")
+    parser.add_argument("-b", "--bench", nargs="+", default=None,
+                        help="Only run the named benchmarks")
+    parser.add_argument("-o", "--out_file", default=None,
+                        help="Write results to this JSON file")
+    parser.add_argument("--compare", default=None,
+                        help="Baseline JSON results to compare against")
+    parser.add_argument("--threshold", default=0.2, type=float,
+                        help="Slowdown (fraction) reported as a regression")
+    parser.add_argument("--keep", default=None,
+                        help="Directory for phantoms and scratch data, kept "
+                        "after the run")
+
+    return parser
+
+
+def main():
+    import shutil
+
+    args = get_parser().parse_args()
+    if args.keep:
+        root = op.realpath(args.keep)
+        if not op.exists(root):
+            os.makedirs(root)
+    else:
+        root = tempfile.mkdtemp(prefix='mrtpipelines_bench_')
+
+    try:
+        results = runBenchmarks(args.scale, args.repeat, args.bench, root)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.out_file:
+        with open(args.out_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
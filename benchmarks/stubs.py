@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Stub MRtrix executables for benchmarks
+
+installStubs writes one small wrapper per MRtrix command (and graphviz
+dot) into a directory that is put first on PATH, so that complete workflows
+run without MRtrix installed. Each wrapper calls this module, which creates
+the outputs of the command: every path argument that does not exist yet is
+treated as an output. Tractography outputs are valid .tck files with the
+requested number of streamlines, tcksample writes one line of values per
+streamline, and images are copied from an input image (or generated) so
+that downstream stages can read them
+
+Usage: stubs.py <command> [arguments]
+"""
+import os
+import os.path as op
+import shutil
+import stat
+import sys
+
+COMMANDS = ('mrconvert', 'dwi2response', 'dwi2fod', 'mtnormalise',
+            'mrregister', 'mrtransform', 'dwinormalise', 'dwi2tensor',
+            'tensor2metric', 'tckgen', 'tcksift', 'tckconvert', 'tcksample',
+            'dwi2mask', 'tckmap',
+            # Graphviz, called when workflow graphs are written
+            'dot')
+
+IMAGE_EXTS = ('.mif.gz', '.nii.gz', '.mif', '.mih', '.nii')
+FILE_EXTS = IMAGE_EXTS + ('.tck', '.txt', '.vtk', '.trk', '.csv', '.b',
+                          '.bval', '.bvec', '.json', '.svg', '.png')
+
+# Streamlines written by tckgen when no count is given
+DEFAULT_TRACKS = 1000
+
+
+def installStubs(bin_dir, python=None):
+    """ Write a wrapper for every command in COMMANDS into bin_dir """
+    python = python or sys.executable
+    repo = op.dirname(op.dirname(op.realpath(__file__)))
+    if not op.exists(bin_dir):
+        os.makedirs(bin_dir)
+
+    for cmd in COMMANDS:
+        wrapper = op.join(bin_dir, cmd)
+        with open(wrapper, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'PYTHONPATH="%s${PYTHONPATH:+:$PYTHONPATH}" '
+                    'exec "%s" "%s" %s "$@"\n' %
+                    (repo, python, op.realpath(__file__), cmd))
+        os.chmod(wrapper, os.stat(wrapper).st_mode | stat.S_IXUSR |
+                 stat.S_IXGRP | stat.S_IXOTH)
+
+    return bin_dir
+
+
+def _ext(path):
+    for ext in FILE_EXTS:
+        if path.endswith(ext):
+            return ext
+    return None
+
+
+def _paths(args):
+    """
+    Arguments naming files, with an option prefix attached to its path (as
+    graphviz's -o<path>) split off
+    """
+    paths = []
+    for arg in args:
+        if arg.startswith('-') and len(arg) > 2 and not arg[1] == '-' and \
+           _ext(arg):
+            arg = arg[2:]
+        if _ext(arg):
+            paths.append(arg)
+    return paths
+
+
+def _option(args, names, default=None):
+    for idx, arg in enumerate(args[:-1]):
+        if arg in names:
+            return args[idx + 1]
+    return default
+
+
+def _writeSubset(in_file, out_file, count):
+    """ Write the first count streamlines of in_file to out_file """
+    import numpy as np
+
+    from mrtpipelines.interfaces.tck import TckFile, writeHeader
+
+    tck = TckFile(in_file)
+    count = min(count, len(tck))
+    header = dict(tck.header)
+    header['count'] = str(count)
+    with open(out_file, 'wb') as f:
+        writeHeader(f, header)
+        if count:
+            f.write(np.ascontiguousarray(tck.points[:tck.ends[count - 1] + 1],
+                                         dtype=tck.dtype).tobytes())
+        f.write(np.full((1, 3), np.inf, dtype=tck.dtype).tobytes())
+
+
+def _writeSamples(in_file, out_file):
+    """ tcksample style output with one line per streamline of in_file """
+    from benchmarks.phantoms import makeSampleText
+    from mrtpipelines.interfaces.tck import TckFile
+
+    makeSampleText(out_file, TckFile(in_file).lengths)
+
+
+def _writeImage(out_file, inputs):
+    """ Copy an input image of the same format, or generate a phantom """
+    from benchmarks.phantoms import makeScalar
+
+    ext = _ext(out_file)
+    same = [path for path in inputs if _ext(path) == ext]
+    if same:
+        shutil.copyfile(same[0], out_file)
+    elif ext in ('.mif', '.nii.gz', '.nii'):
+        makeScalar(out_file)
+    else:
+        open(out_file, 'w').close()
+
+
+def main(cmd, args):
+    paths = _paths(args)
+    inputs = [path for path in paths if op.exists(path)]
+    outputs = [path for path in paths if not op.exists(path)]
+    tracks = [path for path in inputs if path.endswith('.tck')]
+
+    for out_file in outputs:
+        ext = _ext(out_file)
+        out_dir = op.dirname(out_file)
+        if out_dir and not op.exists(out_dir):
+            os.makedirs(out_dir)
+
+        if cmd == 'tckgen' and ext == '.tck':
+            from benchmarks.phantoms import makeTck
+
+            count = _option(args, ('-select', '-number'), DEFAULT_TRACKS)
+            seed = int(os.environ.get('MRTRIX_RNG_SEED', 0))
+            makeTck(out_file, int(count), seed=seed)
+        elif cmd == 'tcksift' and ext == '.tck':
+            count = _option(args, ('-term_number',), sys.maxsize)
+            _writeSubset(tracks[0], out_file, int(count))
+        elif cmd == 'tcksample' and tracks:
+            _writeSamples(tracks[0], out_file)
+        elif cmd == 'tckconvert' and tracks:
+            shutil.copyfile(tracks[0], out_file)
+        elif ext in IMAGE_EXTS:
+            _writeImage(out_file, inputs)
+        elif ext == '.txt':
+            with open(out_file, 'w') as f:
+                f.write("1000 -300 100 -20 5\n")
+        else:
+            open(out_file, 'w').close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1], sys.argv[2:]))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Persistent SQLite index of a BIDS (derivatives) tree
+
+Files are keyed by path and described by their BIDS entities. Refreshing
+only re-lists directories whose modification time changed since the last
+refresh, so repeated runs over a large tree do not re-parse it. Only the
+path of the index database needs to be passed between pipeline nodes
+"""
+import os
+import os.path as op
+import sqlite3
+
+ENTITIES = ('subject', 'session', 'space', 'desc', 'model')
+SHORT = {'sub': 'subject', 'ses': 'session', 'space': 'space',
+         'desc': 'desc', 'model': 'model'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime REAL);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, dir TEXT, mtime REAL, datatype TEXT,
+    subject TEXT, session TEXT, space TEXT, desc TEXT, model TEXT,
+    suffix TEXT, extension TEXT);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_subject ON files (subject, suffix);
+"""
+
+
+def parseEntities(path):
+    """
+    Parse the BIDS entities of a file name, e.g.
+    sub-01/dwi/sub-01_space-Template_model-DTI_FA.mif ->
+    {'subject': '01', 'space': 'Template', 'model': 'DTI', 'suffix': 'FA',
+     'extension': 'mif', 'datatype': 'dwi'}
+    """
+    fname = op.basename(path)
+    stem, _, extension = fname.partition('.')
+
+    entities = {'datatype': op.basename(op.dirname(path)),
+                'extension': extension,
+                'suffix': None}
+    for part in stem.split('_'):
+        key, sep, value = part.partition('-')
+        if sep and key in SHORT:
+            entities[SHORT[key]] = value
+        elif not sep:
+            entities['suffix'] = part
+
+    return entities
+
+
+def defaultIndexFile(root, index_dir):
+    """ Index database for root within index_dir (one database per root) """
+    import hashlib
+
+    digest = hashlib.sha1(op.realpath(root).encode('utf-8')).hexdigest()
+
+    return op.join(index_dir, "bidsindex_%s.sqlite" % digest[:12])
+
+
+class BIDSIndex(object):
+    """
+    Index of the files under root, stored in db_file. When root is None,
+    the root recorded in an existing db_file is used
+    """
+
+    def __init__(self, db_file, root=None):
+        self.db_file = db_file
+        self._conn = sqlite3.connect(db_file, timeout=600)
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+
+        row = self._conn.execute("SELECT value FROM meta "
+                                 "WHERE key = 'root'").fetchone()
+        if root is None:
+            if row is None:
+                raise IOError("BIDS index %s has no root" % db_file)
+            self.root = row[0]
+        else:
+            self.root = op.realpath(root)
+            if row is None:
+                with self._conn:
+                    self._conn.execute("INSERT INTO meta VALUES "
+                                       "('root', ?)", (self.root,))
+            elif row[0] != self.root:
+                raise IOError("BIDS index %s belongs to %s" %
+                              (db_file, row[0]))
+
+    def close(self):
+        self._conn.close()
+
+    def _scanDir(self, path, mtime):
+        """ Replace the rows of the files directly within path """
+        conn = self._conn
+        conn.execute("DELETE FROM files WHERE dir = ?", (path,))
+
+        rows = []
+        for entry in os.scandir(path):
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            ents = parseEntities(entry.path)
+            if ents.get('subject') is None:
+                continue
+            rows.append((entry.path, path,
+                         entry.stat().st_mtime, ents['datatype']) +
+                        tuple(ents.get(e) for e in ENTITIES) +
+                        (ents['suffix'], ents['extension']))
+
+        conn.executemany("INSERT OR REPLACE INTO files VALUES "
+                         "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)",
+                     (path, mtime))
+
+    def refresh(self, exclude=()):
+        """
+        Bring the index up to date with the tree, re-listing only new or
+        modified directories and dropping those that were removed.
+        Directories in exclude (e.g. a work dir within the tree) are skipped
+        """
+        exclude = set(op.realpath(path) for path in exclude)
+        conn = self._conn
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            known = dict(conn.execute("SELECT path, mtime FROM dirs"))
+
+            stack = [self.root]
+            seen = set()
+            while stack:
+                path = stack.pop()
+                seen.add(path)
+                mtime = op.getmtime(path)
+                if known.get(path) != mtime:
+                    self._scanDir(path, mtime)
+                for entry in os.scandir(path):
+                    if entry.is_dir() and not entry.name.startswith('.') \
+                            and entry.path not in exclude:
+                        stack.append(entry.path)
+
+            for path in set(known) - seen:
+                conn.execute("DELETE FROM files WHERE dir = ?", (path,))
+                conn.execute("DELETE FROM dirs WHERE path = ?", (path,))
+
+        return self
+
+    def get(self, **query):
+        """
+        Return the sorted paths matching all given entities (subject,
+        session, space, desc, model, suffix, extension, datatype). A list of
+        values matches any of them
+        """
+        clauses, params = ["1"], []
+        for key, value in sorted(query.items()):
+            if key not in ENTITIES + ('suffix', 'extension', 'datatype'):
+                raise ValueError("Unknown BIDS entity: %s" % key)
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple)):
+                clauses.append("%s IN (%s)" % (key,
+                                               ", ".join("?" * len(value))))
+                params.extend(value)
+            else:
+                clauses.append("%s = ?" % key)
+                params.append(value)
+
+        rows = self._conn.execute("SELECT path FROM files WHERE %s "
+                                  "ORDER BY path" % " AND ".join(clauses),
+                                  params)
+
+        return [row[0] for row in rows]
+
+    def getSubjects(self):
+        rows = self._conn.execute("SELECT DISTINCT subject FROM files "
+                                  "ORDER BY subject")
+
+        return [row[0] for row in rows]
+
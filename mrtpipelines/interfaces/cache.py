@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Cross-run result cache for expensive MRtrix nodes
+
+Results are stored in a shared content-addressed directory, keyed on the
+interface, its parameters, the MRtrix version and a fast fingerprint of
+its input files (size, header and a hash of evenly spaced blocks), so large
+images and tractograms are never hashed in full. Entries are evicted least
+recently used first once the store exceeds its size limit. Files are
+reflinked into and out of the store where the filesystem allows, copied
+otherwise, and never hardlinked: a work directory file or a derivative
+sunk from it must not share its data with the cache entry
+"""
+import hashlib
+import json
+import os
+import os.path as op
+import shutil
+import subprocess
+
+from nipype.interfaces import mrtrix3 as mrt
+from nipype.interfaces.base import isdefined
+
+from mrtpipelines.interfaces.io import placeFile
+
+HEAD_BYTES = 1 << 16
+BLOCK_BYTES = 1 << 12
+NBLOCKS = 64
+
+# Inputs that do not change results
+IGNORED_INPUTS = ('nthreads', 'num_threads')
+
+_fingerprints = {}
+_versions = {}
+
+
+def _fileFingerprint(path):
+    """
+    Fast fingerprint of a file: its size, first and last 64 KiB and NBLOCKS
+    evenly spaced 4 KiB blocks. Memoised on (path, size, mtime) within a
+    process
+    """
+    stat = os.stat(path)
+    memo = (op.realpath(path), stat.st_size, stat.st_mtime_ns)
+    if memo in _fingerprints:
+        return _fingerprints[memo]
+
+    digest = hashlib.sha1(str(stat.st_size).encode('utf-8'))
+    with open(path, 'rb') as f:
+        digest.update(f.read(HEAD_BYTES))
+        if stat.st_size > 2 * HEAD_BYTES:
+            step = (stat.st_size - 2 * HEAD_BYTES) // NBLOCKS
+            for block in range(NBLOCKS):
+                f.seek(HEAD_BYTES + block * step)
+                digest.update(f.read(BLOCK_BYTES))
+            f.seek(-HEAD_BYTES, os.SEEK_END)
+            digest.update(f.read(HEAD_BYTES))
+
+    _fingerprints[memo] = digest.hexdigest()
+
+    return _fingerprints[memo]
+
+
+def _dataFile(path):
+    """ Data file a .mih header points at, None for any other file """
+    if not path.endswith('.mih'):
+        return None
+
+    from mrtpipelines.interfaces import mif
+
+    try:
+        return mif.readHeader(path)['file']
+    except (IOError, KeyError, ValueError):
+        return None
+
+
+def fingerprint(path):
+    """
+    Fast fingerprint of a file, including the data file of a .mih header
+    (which holds no voxel data itself)
+    """
+    digest = _fileFingerprint(path)
+    data_file = _dataFile(path)
+    if data_file is not None and op.isfile(data_file):
+        digest = hashlib.sha1((digest + _fileFingerprint(data_file))
+                              .encode('utf-8')).hexdigest()
+
+    return digest
+
+
+def commandVersion(cmd):
+    """
+    Version line printed by an MRtrix command (e.g. '== mrregister 3.0.4
+    =='), or None when it cannot be run. Memoised within a process
+    """
+    executable = cmd.split()[0]
+    path = shutil.which(executable)
+    if path not in _versions:
+        try:
+            out = subprocess.check_output([path or executable, '--version'],
+                                          stderr=subprocess.DEVNULL,
+                                          universal_newlines=True)
+            _versions[path] = out.strip().split('\n')[0] or None
+        except (OSError, subprocess.CalledProcessError):
+            _versions[path] = None
+
+    return _versions[path]
+
+
+def _describe(value):
+    """ JSON friendly description of an input, with files fingerprinted """
+    if isinstance(value, (list, tuple)):
+        return [_describe(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _describe(v) for k, v in sorted(value.items())}
+    # Input files are absolute, output names given to the node are not
+    if isinstance(value, str) and op.isabs(value) and op.isfile(value):
+        return {'file': fingerprint(value)}
+
+    return value
+
+
+def cacheKey(interface, cmd, inputs):
+    """
+    Key and description of a run of interface (name of a cached interface,
+    e.g. 'CachedMRRegister') running cmd on inputs, a dict of the defined
+    inputs
+    """
+    # Results of another MRtrix release are not reused
+    description = {'interface': interface,
+                   'cmd': cmd,
+                   'version': commandVersion(cmd)}
+    for name, value in inputs.items():
+        if name not in IGNORED_INPUTS:
+            description[name] = _describe(value)
+    key = hashlib.sha1(json.dumps(description, sort_keys=True,
+                                  default=str).encode('utf-8'))
+
+    return key.hexdigest(), description
+
+
+def definedInputs(inputs):
+    """ Defined inputs of an interface (its inputs spec), as a dict """
+    defined = {}
+    for name in inputs.copyable_trait_names():
+        value = getattr(inputs, name)
+        if isdefined(value):
+            defined[name] = value
+
+    return defined
+
+
+def _cloneOrCopy(src, dst):
+    """
+    Reflink src to dst, copying when the filesystem cannot share extents.
+    A hardlink would let an edit of either file change the other
+    """
+    if op.lexists(dst):
+        os.remove(dst)
+    placeFile(src, dst, 'reflink')
+
+
+class ResultCache(object):
+    """ Content-addressed store of node results under cache_dir """
+
+    def __init__(self, cache_dir, max_gb=100):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_gb * (1 << 30))
+
+    def _entry(self, key):
+        return op.join(self.cache_dir, key[:2], key)
+
+    def contains(self, key):
+        """ Whether outputs are stored for key """
+        return op.exists(op.join(self._entry(key), 'manifest.json'))
+
+    def restore(self, key, out_dir):
+        """
+        Reflink or copy the cached outputs of key into out_dir. Returns False
+        on a cache miss
+        """
+        entry = self._entry(key)
+        manifest = op.join(entry, 'manifest.json')
+        if not op.exists(manifest):
+            return False
+
+        with open(manifest) as f:
+            files = json.load(f)['files']
+        try:
+            for fname in files:
+                _cloneOrCopy(op.join(entry, fname), op.join(out_dir, fname))
+        except (IOError, OSError):  # Evicted concurrently
+            return False
+
+        # Mark as recently used
+        os.utime(manifest, None)
+
+        return True
+
+    def store(self, key, outputs, description=None):
+        """ Store the existing files listed in outputs (any nesting) """
+        files = []
+
+        def _collect(value):
+            if isinstance(value, (list, tuple)):
+                for v in value:
+                    _collect(v)
+            elif isinstance(value, str) and op.isfile(value):
+                files.append(value)
+        _collect(list(outputs.values()))
+
+        entry = self._entry(key)
+        if op.exists(entry):
+            return entry
+
+        # Populate a private directory first so entries appear atomically
+        tmp = "%s.tmp%d" % (entry, os.getpid())
+        os.makedirs(tmp)
+        for path in files:
+            _cloneOrCopy(path, op.join(tmp, op.basename(path)))
+        with open(op.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump({'files': [op.basename(p) for p in files],
+                       'inputs': description}, f, indent=1, default=str)
+        try:
+            os.rename(tmp, entry)
+        except OSError:  # Stored concurrently
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        self.evict()
+
+        return entry
+
+    def evict(self):
+        """ Remove least recently used entries beyond the size limit """
+        entries = []
+        total = 0
+        for prefix in os.listdir(self.cache_dir):
+            prefix = op.join(self.cache_dir, prefix)
+            if not op.isdir(prefix):
+                continue
+            for key in os.listdir(prefix):
+                entry = op.join(prefix, key)
+                manifest = op.join(entry, 'manifest.json')
+                if not op.exists(manifest):
+                    continue
+                size = sum(op.getsize(op.join(entry, f))
+                           for f in os.listdir(entry))
+                entries.append((op.getmtime(manifest), size, entry))
+                total += size
+
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+class CachedInterfaceMixin(object):
+    """
+    Mixin short-circuiting the execution of a command line interface when
+    the result cache already holds outputs for the same parameters and
+    inputs
+    """
+    _cache_dir = None
+    _cache_gb = 100
+
+    def _cacheKey(self):
+        return cacheKey(type(self).__name__, self.cmd,
+                        definedInputs(self.inputs))
+
+    def _run_interface(self, runtime):
+        if self._cache_dir is None:
+            return super(CachedInterfaceMixin, self)._run_interface(runtime)
+
+        cache = ResultCache(self._cache_dir, self._cache_gb)
+        key, description = self._cacheKey()
+        if cache.restore(key, runtime.cwd):
+            runtime.returncode = 0
+            runtime.stdout = "Restored from result cache (%s)" % key
+            runtime.stderr = ""
+            return runtime
+
+        runtime = super(CachedInterfaceMixin, self)._run_interface(runtime)
+        if runtime.returncode == 0:
+            cache.store(key, self._list_outputs(), description)
+
+        return runtime
+
+
+# Interfaces worth caching, created at import so that they can be pickled
+CACHED_INTERFACES = ('MRRegister', 'EstimateFOD', 'Tractography', 'SIFT',
+                     'FitTensor', 'TCKSample')
+
+for _name in CACHED_INTERFACES:
+    if hasattr(mrt, _name):
+        globals()['Cached' + _name] = type('Cached' + _name,
+                                           (CachedInterfaceMixin,
+                                            getattr(mrt, _name)),
+                                           {'__module__': __name__})
+
+
+def cachedInterface(interface, cache_dir=None, max_gb=100):
+    """
+    Instantiate interface (e.g. mrt.MRRegister), backed by the result cache
+    in cache_dir when one is given
+    """
+    cached = globals().get('Cached' + interface.__name__)
+    if cache_dir is None or cached is None:
+        return interface()
+
+    if not op.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    instance = cached()
+    instance._cache_dir = op.realpath(cache_dir)
+    instance._cache_gb = max_gb
+
+    return instance
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Group-level scalar sampling
+
+Subjects are sampled by a pool of worker processes, each writing its values
+(and optional streamline statistics) to a columnar npz archive in its own
+work directory. As subjects finish, in order, their archives are streamed
+into a single subject-indexed group archive and removed, so neither the
+workers nor the aggregation hold more than one block of streamlines in
+memory. A subject that fails is recorded and the batch carries on; when a
+worker process dies, the unfinished subjects are rerun one at a time
+"""
+import numpy as np
+
+
+def _sampleSubject(task):
+    """
+    Sample the scalars of one subject (run in a worker). Returns (subjid,
+    dict of archives, error); error is None on success
+    """
+    import os
+    import os.path as op
+    import traceback
+
+    from mrtpipelines.interfaces import io, tractography, tractstats
+
+    subjid, wdir = task['subjid'], task['wdir']
+    try:
+        if not op.exists(wdir):
+            os.makedirs(wdir)
+
+        _, tract, images = io._getScalarData(task['index_db'], subjid,
+                                             list(task['names']),
+                                             task['space'])
+        if task['include'] or task['exclude']:
+            from mrtpipelines.interfaces.tckindex import selectTck
+
+            tract, _ = selectTck(tract, op.join(wdir, 'selected.tck'),
+                                 task['include'], task['exclude'],
+                                 chunk_size=task['chunk_size'])
+
+        if task['engine'] == 'mrtrix':
+            from nipype.interfaces import mrtrix3 as mrt
+
+            samples = []
+            for name, image in zip(task['names'], images):
+                tckSample = mrt.TCKSample(in_file=tract, in_image=image,
+                                          out_file=op.join(wdir,
+                                                           'tcksample_%s.txt'
+                                                           % name),
+                                          nthreads=1)
+                tckSample.run(cwd=wdir)
+                samples.append(tckSample.inputs.out_file)
+            values = tractography._writeScalar(samples, wdir, 'npz',
+                                               task['chunk_size'],
+                                               task['names'], combine=True)
+            for sample in samples:
+                os.remove(sample)
+        else:
+            values = tractography._sampleTract(tract, images, wdir, 'npz',
+                                               task['chunk_size'],
+                                               task['interp'],
+                                               task['names'], combine=True)
+
+        archives = {'values': values}
+        if task['stats']:
+            archives['stats'] = tractstats.tractStats(
+                tract, values, op.join(wdir, 'stats.npz'),
+                names=task['names'], npoints=task['stats_points'],
+                chunk_size=task['chunk_size'])
+
+        return subjid, archives, None
+    except Exception:
+        return subjid, None, traceback.format_exc()
+
+
+def _npyHeader(src):
+    """ (shape, dtype) of the .npy array open in src, read past its header """
+    version = np.lib.format.read_magic(src)
+    if version == (1, 0):
+        shape, _, dtype = np.lib.format.read_array_header_1_0(src)
+    else:
+        shape, _, dtype = np.lib.format.read_array_header_2_0(src)
+
+    return shape, dtype
+
+
+class GroupWriter(object):
+    """
+    Appends per-subject archives into one npz archive
+
+    The group archive holds 'subjects' and 'subject_offsets', where subject
+    i spans streamlines subject_offsets[i]:subject_offsets[i + 1]; the
+    sampled values of each scalar with int64 'offsets' (streamline j spans
+    values offsets[j]:offsets[j + 1]); when appended, the streamline
+    statistics columns; and 'failed' / 'errors' for subjects that failed
+    """
+
+    def __init__(self, out_file):
+        import os.path as op
+
+        self.out_file = out_file
+        self.subjects = []
+        self.failed = []
+        self.errors = []
+        self.nstreamlines = 0
+        self.npoints = 0
+
+        self._spool = op.join(op.dirname(op.abspath(out_file)),
+                              ".%s.%%s.raw" % op.basename(out_file))
+        # name -> (raw file, dtype, shape of one row, rows)
+        self._members = {}
+        self._order = []
+        self._offsets = [0]
+
+        offsets = self._member('offsets', np.int64, ())
+        offsets[0].write(np.zeros(1, dtype=np.int64).tobytes())
+        offsets[3] = 1
+
+    def _member(self, name, dtype, shape):
+        if name not in self._members:
+            raw = open(self._spool % name, 'wb')
+            self._members[name] = [raw, np.dtype(dtype), shape, 0]
+            self._order.append(name)
+        return self._members[name]
+
+    def _copyMember(self, zf, name):
+        """ Append the rows of one array of an archive to its spool """
+        import shutil
+
+        with zf.open(name + '.npy') as src:
+            shape, dtype = _npyHeader(src)
+            member = self._member(name, dtype, tuple(shape[1:]))
+            shutil.copyfileobj(src, member[0], 16 * 1024 * 1024)
+            member[3] += shape[0]
+
+        return shape[0]
+
+    def _check(self, values, stats=None):
+        """
+        Check that the archives of a subject can be appended: every array
+        has as many rows as its counterparts and the same columns as the
+        subjects already appended. Raises ValueError otherwise
+        """
+        import zipfile
+
+        headers = {}
+        for archive in (values, stats):
+            if archive is None:
+                continue
+            with zipfile.ZipFile(archive) as zf:
+                for name in zf.namelist():
+                    with zf.open(name) as src:
+                        headers[name[:-4]] = _npyHeader(src)
+
+        if 'offsets' not in headers:
+            raise ValueError("%s has no streamline offsets" % values)
+        nstreamlines = headers['offsets'][0][0] - 1
+        nrows = {name: shape[0] for name, (shape, _) in headers.items()
+                 if name != 'offsets'}
+        if stats is not None:
+            with zipfile.ZipFile(stats) as zf:
+                for name in zf.namelist():
+                    if nrows.pop(name[:-4]) != nstreamlines:
+                        raise ValueError("%s: %s does not have a row per "
+                                         "streamline" % (stats, name[:-4]))
+        if len(set(nrows.values())) > 1:
+            raise ValueError("%s: values of different lengths" % values)
+
+        if self.subjects and set(headers) != set(self._order):
+            raise ValueError("%s holds %s, previous subjects %s" %
+                             (values, sorted(headers), sorted(self._order)))
+        for name, (shape, dtype) in headers.items():
+            if name in self._members and \
+               self._members[name][1:3] != [np.dtype(dtype),
+                                            tuple(shape[1:])]:
+                raise ValueError("%s: %s differs in type or shape from "
+                                 "previous subjects" % (values, name))
+
+    def _rollback(self, state):
+        """ Truncate the spools back to state (name -> (size, rows)) """
+        import os
+
+        for name in list(self._order):
+            member = self._members[name]
+            if name in state:
+                member[0].seek(state[name][0])
+                member[0].truncate()
+                member[3] = state[name][1]
+            else:
+                member[0].close()
+                os.remove(member[0].name)
+                del self._members[name]
+                self._order.remove(name)
+
+    def append(self, subjid, values, stats=None, chunk_size=1 << 20):
+        """
+        Append the archives of one subject, streamed from disk. The archives
+        are checked first, and the spools rolled back if appending fails
+        part way, so a bad subject cannot misalign the group archive
+        """
+        self._check(values, stats)
+
+        state = {}
+        for name, member in self._members.items():
+            member[0].flush()
+            state[name] = (member[0].tell(), member[3])
+        try:
+            npoints, nstreamlines = self._append(values, stats, chunk_size)
+        except Exception:
+            self._rollback(state)
+            raise
+
+        self.subjects.append(subjid)
+        self.npoints += npoints
+        self.nstreamlines += nstreamlines
+        self._offsets.append(self.nstreamlines)
+
+    def _append(self, values, stats, chunk_size):
+        """ Copy the archives to the spools, returning (points, streamlines) """
+        import zipfile
+
+        with zipfile.ZipFile(values) as zf:
+            names = [name[:-4] for name in zf.namelist()
+                     if name != 'offsets.npy']
+            npoints = 0
+            for name in names:
+                npoints = self._copyMember(zf, name)
+
+            # Streamline offsets, shifted past the values already written
+            with zf.open('offsets.npy') as src:
+                shape, _ = _npyHeader(src)
+                member = self._member('offsets', np.int64, ())
+                src.read(8)
+                remaining = shape[0] - 1
+                while remaining:
+                    count = min(chunk_size, remaining)
+                    block = np.frombuffer(src.read(8 * count), dtype='<i8')
+                    (block + self.npoints).astype(np.int64).tofile(member[0])
+                    remaining -= count
+                member[3] += shape[0] - 1
+                nstreamlines = shape[0] - 1
+
+        if stats is not None:
+            with zipfile.ZipFile(stats) as zf:
+                for name in zf.namelist():
+                    self._copyMember(zf, name[:-4])
+
+        return npoints, nstreamlines
+
+    def fail(self, subjid, error):
+        self.failed.append(subjid)
+        self.errors.append(error)
+
+    def close(self):
+        import io
+        import os
+        import zipfile
+
+        from mrtpipelines.interfaces.tractography import _writeNpyMember
+
+        for raw, _, _, _ in self._members.values():
+            raw.close()
+
+        with zipfile.ZipFile(self.out_file, 'w',
+                             compression=zipfile.ZIP_STORED) as zf:
+            for name in self._order:
+                raw, dtype, shape, rows = self._members[name]
+                _writeNpyMember(zf, name, raw.name, dtype, (rows,) + shape)
+
+            for name, array in (('subjects', np.array(self.subjects,
+                                                      dtype=str)),
+                                ('subject_offsets',
+                                 np.array(self._offsets, dtype=np.int64)),
+                                ('failed', np.array(self.failed, dtype=str)),
+                                ('errors', np.array(self.errors, dtype=str))):
+                buf = io.BytesIO()
+                np.lib.format.write_array(buf, array, allow_pickle=False)
+                zf.writestr(name + '.npy', buf.getvalue())
+
+        for raw, _, _, _ in self._members.values():
+            os.remove(raw.name)
+
+        return self.out_file
+
+
+def _aggregate(writer, task, result, keep=False):
+    """
+    Append the result (subjid, archives, error) of one subject to writer,
+    or record its failure, then remove its work directory unless keep
+    """
+    import shutil
+    import sys
+    import traceback
+
+    subjid, archives, error = result
+    if error is None:
+        try:
+            writer.append(subjid, archives['values'], archives.get('stats'))
+        except Exception:
+            error = traceback.format_exc()
+
+    if error is None:
+        print("%s: done" % subjid)
+    else:
+        writer.fail(subjid, error)
+        print("%s: FAILED\n%s" % (subjid, error), file=sys.stderr)
+
+    if not keep:
+        shutil.rmtree(task['wdir'], ignore_errors=True)
+
+
+def sampleGroup(index_db, subjids, names, space, out_file, wdir,
+                engine='python', jobs=1, chunk_size=10000, interp='linear',
+                stats=False, stats_points=20, include=(), exclude=(),
+                keep=False):
+    """
+    Sample the scalars names of every subject in subjids with a pool of jobs
+    processes into the group archive out_file (see GroupWriter), restricted
+    to the streamlines selected by the include / exclude ROIs if given.
+    Returns the subjects that failed, with their errors
+    """
+    import os.path as op
+    import sys
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+
+    tasks = [{'index_db': index_db, 'subjid': subjid, 'names': list(names),
+              'space': space, 'wdir': op.join(wdir, subjid),
+              'engine': engine, 'chunk_size': chunk_size, 'interp': interp,
+              'stats': stats, 'stats_points': stats_points,
+              'include': list(include), 'exclude': list(exclude)}
+             for subjid in subjids]
+
+    writer = GroupWriter(out_file)
+    results = [None] * len(tasks)
+    written = 0
+    unfinished = list(range(len(tasks)))
+    workers = max(1, jobs)
+    while unfinished:
+        broken = False
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [(idx, pool.submit(_sampleSubject, tasks[idx]))
+                       for idx in unfinished]
+            for idx, future in futures:
+                try:
+                    results[idx] = future.result()
+                except BrokenProcessPool:  # A worker was killed (e.g. OOM)
+                    broken = True
+                    break
+                except Exception as exc:
+                    results[idx] = (tasks[idx]['subjid'], None, repr(exc))
+
+                # Aggregate in subject order as results become available
+                while written < len(tasks) and results[written] is not None:
+                    _aggregate(writer, tasks[written], results[written], keep)
+                    written += 1
+
+            if broken:  # Keep the subjects that finished all the same
+                for idx, future in futures:
+                    if results[idx] is not None or not future.done() or \
+                       future.cancelled():
+                        continue
+                    if future.exception() is None:
+                        results[idx] = future.result()
+
+        unfinished = [idx for idx in unfinished if results[idx] is None]
+        if broken:
+            if workers == 1:
+                # Run one at a time, the first unfinished subject killed it
+                idx = unfinished.pop(0)
+                results[idx] = (tasks[idx]['subjid'], None,
+                                "Worker process died while sampling")
+            else:
+                print("Worker process died, rerunning %d subjects one at "
+                      "a time" % len(unfinished), file=sys.stderr)
+            workers = 1
+
+        while written < len(tasks) and results[written] is not None:
+            _aggregate(writer, tasks[written], results[written], keep)
+            written += 1
+
+    writer.close()
+
+    return list(zip(writer.failed, writer.errors))
@@ -1,6 +1,9 @@
-from nipype.pipeline import engine as pe
-from nipype.interfaces import utility as niu
-from nipype.interfaces import io as nio
+import os.path as op
+
+from mrtpipelines.interfaces import resources
+
+# nipype is imported by the node factories, so inputs can be resolved (e.g.
+# for a dry run) without importing it
 
 def _getTemplate(template_dir, template_label, work_dir):
     import os.path as op
@@ -22,6 +25,9 @@ def _getTemplate(template_dir, template_label, work_dir):
     return wm_fod, wm_response, gm_response, csf_response, mask
 
 def getTemplate(template_dir, template_label, wdir=None):
+    from nipype.pipeline import engine as pe
+    from nipype.interfaces import utility as niu
+
     getTemplate = pe.Node(niu.Function(function=_getTemplate,
                                         input_names=['template_dir',
                                                      'template_label',
@@ -37,36 +43,46 @@ def getTemplate(template_dir, template_label, wdir=None):
     getTemplate.inputs.template_dir = template_dir
     getTemplate.inputs.template_label = template_label
     getTemplate.inputs.work_dir = wdir
+    resources.setProfile(getTemplate)
 
     return getTemplate
 
 
-def _getData(bids_layout, subjid, bmask):
+def _getData(bids_index, subjid, bmask):
+    from mrtpipelines.interfaces.bidsindex import BIDSIndex, parseEntities
+
     # Strip leading 'sub-'
-    subj = subjid.lstrip('sub-')
+    subj = subjid[4:] if subjid.startswith('sub-') else subjid
 
-    # Diffusion
-    nifti = bids_layout.get(subject=subj, modality='dwi', type='preproc',
-                            return_type='file', extensions=['nii', 'nii.gz'])
-    bval = bids_layout.get(subject=subj, modality='dwi', type='preproc',
-                           return_type='file', extensions=['bval'])
-    bvec = bids_layout.get(subject=subj, modality='dwi', type='preproc',
-                           return_type='file', extensions=['bvec'])
+    # Diffusion (single query for image, bval and bvec)
+    index = BIDSIndex(bids_index)
+    preproc = index.get(subject=subj, datatype='dwi', suffix='preproc',
+                        extension=['nii', 'nii.gz', 'bval', 'bvec'])
+    byext = {}
+    for f in preproc:
+        byext.setdefault(parseEntities(f)['extension'], []).append(f)
+    nifti = byext.get('nii', []) + byext.get('nii.gz', [])
+    bval, bvec = byext['bval'], byext['bvec']
 
     if bmask is None:
-        mask = bids_layout.get(subject=subj, modality='dwi', type='brainmask',
-                               return_type='file', extensions=['nii', 'nii.gz'])
+        mask = index.get(subject=subj, datatype='dwi', suffix='brainmask',
+                         extension=['nii', 'nii.gz'])
+        index.close()
 
         return subjid, nifti[0], (bvec[0], bval[0]), mask[0]
     else:
         mask = bmask
+        index.close()
 
         return subjid, nifti[0], (bvec[0], bval[0]), mask
 
 
-def getBIDS(layout, subj, bmask, wdir=None, nthreads=1):
+def getBIDS(index_db, subj, bmask, wdir=None, nthreads=1):
+    from nipype.pipeline import engine as pe
+    from nipype.interfaces import utility as niu
+
     BIDSDataGrabber = pe.Node(niu.Function(function=_getData,
-                                           input_names=['bids_layout',
+                                           input_names=['bids_index',
                                                         'subjid',
                                                         'bmask'],
                                            output_names=['subjid',
@@ -75,36 +91,52 @@ def getBIDS(layout, subj, bmask, wdir=None, nthreads=1):
                                                          'mask']),
                                            name='BIDSDataGrabber')
     BIDSDataGrabber.base_dir = wdir
-    BIDSDataGrabber.inputs.bids_layout = layout
-    BIDSDataGrabber.inputs.subjid = subj
+    BIDSDataGrabber.inputs.bids_index = index_db
+    if isinstance(subj, list):  # Batch of participants
+        BIDSDataGrabber.iterables = [('subjid', subj)]
+    else:
+        BIDSDataGrabber.inputs.subjid = subj
     BIDSDataGrabber.inputs.bmask = bmask
-    BIDSDataGrabber.interface.num_threads = nthreads
+    resources.setProfile(BIDSDataGrabber, nthreads)
 
     return BIDSDataGrabber
 
 
-def _getScalarData(bids_layout, subjid, scalar, space):
+def _getScalarData(bids_index, subjid, scalar, space):
+    from mrtpipelines.interfaces.bidsindex import BIDSIndex, parseEntities
+
     # Strip leading 'sub-'
-    subj = subjid.lstrip('sub-')
+    subj = subjid[4:] if subjid.startswith('sub-') else subjid
+
+    # Tractography and all scalars in a single query
+    scalars = scalar if isinstance(scalar, list) else [scalar]
+    index = BIDSIndex(bids_index)
+    found = index.get(subject=subj, space=space,
+                      suffix=['tractography'] + scalars,
+                      extension=['tck', 'nii', 'nii.gz', 'mif'])
+    index.close()
 
-    # Diffusion
-    tract_list = bids_layout.get(subject=subj, type='tractography',
-                            return_type='file', extensions=['tck'])
-    scalar_list = bids_layout.get(subject=subj, type=scalar,
-                             return_type='file',
-                             extensions=['nii', 'nii.gz', 'mif'])
+    bysuffix = {}
+    for f in found:
+        ents = parseEntities(f)
+        if (ents['suffix'] == 'tractography') == (ents['extension'] == 'tck'):
+            bysuffix.setdefault(ents['suffix'], []).append(f)
 
-    # Search for correct files via filter
-    space_str = "space-%s" % space
-    tract = list(filter(lambda x: space_str in x, tract_list))
-    scalar = list(filter(lambda x: space_str in x, scalar_list))
+    tract = bysuffix['tractography'][0]
+    scalar_files = [bysuffix[scalar_type][0] for scalar_type in scalars]
 
-    return subjid, tract[0], scalar[0]
+    if not isinstance(scalar, list):
+        return subjid, tract, scalar_files[0]
 
+    return subjid, tract, scalar_files
+
+
+def getScalarData(index_db, subj, scalar, space, wdir=None, nthreads=1):
+    from nipype.pipeline import engine as pe
+    from nipype.interfaces import utility as niu
 
-def getScalarData(layout, subj, scalar, space, wdir=None, nthreads=1):
     BIDSScalarGrabber = pe.Node(niu.Function(function=_getScalarData,
-                                           input_names=['bids_layout',
+                                           input_names=['bids_index',
                                                         'subjid',
                                                         'scalar',
                                                         'space'],
@@ -113,31 +145,233 @@ def getScalarData(layout, subj, scalar, space, wdir=None, nthreads=1):
                                                          'scalar']),
                                            name='BIDSScalarGrabber')
     BIDSScalarGrabber.base_dir = wdir
-    BIDSScalarGrabber.inputs.bids_layout = layout
+    BIDSScalarGrabber.inputs.bids_index = index_db
     BIDSScalarGrabber.inputs.subjid = subj
     BIDSScalarGrabber.inputs.scalar = scalar
     BIDSScalarGrabber.inputs.space = space
-    BIDSScalarGrabber.interface.num_threads = nthreads
+    resources.setProfile(BIDSScalarGrabber, nthreads)
 
     return BIDSScalarGrabber
 
 
+def _convertImage(in_file, grad_fsl=None, out_base='dwi', data_file=None):
+    # data_file (the data of a .mih in_file) is only there to be hashed
+    import os.path as op
+    import subprocess
+
+    from nibabel.filebasedimages import ImageFileError
+
+    from mrtpipelines.interfaces import mif
+
+    # Already an MRtrix image
+    if in_file.endswith(('.mif', '.mif.gz', '.mih')) and grad_fsl is None:
+        return in_file
+
+    # Header pointing at the NIfTI data, or a full copy when compressed
+    try:
+        return mif.niftiHeader(in_file, op.abspath(out_base + '.mih'),
+                               grad_fsl)
+    except ImageFileError:
+        # Not a NIfTI image (e.g. an MRtrix image given FSL gradients)
+        out_file = op.abspath(out_base + '.mif')
+        cmd = ['mrconvert', '-quiet', in_file, out_file]
+        if grad_fsl is not None:
+            cmd += ['-fslgrad', grad_fsl[0], grad_fsl[1]]
+        subprocess.check_call(cmd)
+        return out_file
+    except IOError:
+        return mif.convertNifti(in_file, op.abspath(out_base + '.mif'),
+                                grad_fsl)
+
+
+def convertImage(node_name, out_base='dwi', wdir=None, nthreads=1):
+    """
+    Make a NIfTI image (and FSL gradients, as grad_fsl) readable by MRtrix,
+    replacing mrconvert. Uncompressed images are not copied. nipype hashes a
+    .mih input by its header alone, so set data_file to the data it points
+    at to rerun the node when the data changes
+    """
+    from nipype.pipeline import engine as pe
+    from nipype.interfaces import utility as niu
+
+    convertImage = pe.Node(niu.Function(function=_convertImage,
+                                        input_names=['in_file',
+                                                     'grad_fsl',
+                                                     'out_base',
+                                                     'data_file'],
+                                        output_names=['out_file']),
+                                        name=node_name)
+    convertImage.base_dir = wdir
+    convertImage.inputs.out_base = out_base
+    resources.setProfile(convertImage, nthreads)
+
+    return convertImage
+
+
 def renameFile(file_name, node_name, wdir=None, nthreads=1):
-    renameFile = pe.Node(niu.Rename(format_string="%(subjid)s_%(file_name)s"),
-                                    name=node_name)
+    from nipype.pipeline import engine as pe
+    from nipype.interfaces import utility as niu
+
+    # A list of names renames a list of files pairwise
+    if isinstance(file_name, list):
+        renameFile = pe.MapNode(niu.Rename(format_string="%(subjid)s_%(file_name)s"),
+                                           iterfield=['in_file', 'file_name'],
+                                           name=node_name)
+    else:
+        renameFile = pe.Node(niu.Rename(format_string="%(subjid)s_%(file_name)s"),
+                                        name=node_name)
     renameFile.base_dir = wdir
     renameFile.inputs.keep_ext = True
     renameFile.inputs.file_name = file_name
-    renameFile.interface.num_threads = nthreads
+    resources.setProfile(renameFile, nthreads, profile='rename')
 
     return renameFile
 
 
 def subjSink(out_dir, wdir=None, nthreads=1):
+    from nipype.pipeline import engine as pe
+    from nipype.interfaces import io as nio
+
     subjSink = pe.Node(nio.DataSink(), parameterization=False,
                                        name='subjSink')
     subjSink.base_dir = wdir
     subjSink.inputs.base_directory = out_dir
-    subjSink.interface.num_threads = nthreads
+    resources.setProfile(subjSink, nthreads)
 
     return subjSink
+
+
+LINK_MODES = ('auto', 'reflink', 'hardlink', 'move', 'copy')
+
+# ioctl cloning a file's extents (Linux: btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+
+def _splitExt(path):
+    """ Split an extension, keeping compressed image extensions together """
+    import os.path as op
+
+    for ext in ('.nii.gz', '.mif.gz'):
+        if path.endswith(ext):
+            return path[:-len(ext)], ext
+
+    return op.splitext(path)
+
+
+def _reflink(src, dst):
+    import fcntl
+    import os
+    import shutil
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except (IOError, OSError):
+            fdst.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def placeFile(src, dst, link_mode='auto'):
+    """
+    Place src at dst without copying its data where the filesystem allows:
+    'auto' reflinks, then hardlinks, 'reflink' and 'hardlink' use only that
+    method, and 'move' renames src. Every mode falls back to a copy (across
+    filesystems, or where links are not supported). Returns the method used
+    """
+    import os
+    import os.path as op
+    import shutil
+
+    if link_mode not in LINK_MODES:
+        raise ValueError("Unknown link mode: %s" % link_mode)
+
+    if op.lexists(dst):
+        if op.exists(dst) and op.samefile(src, dst):
+            return 'same'
+        os.remove(dst)
+
+    if link_mode == 'move':
+        shutil.move(src, dst)
+        return 'move'
+
+    methods = {'auto': [('reflink', _reflink), ('hardlink', os.link)],
+               'reflink': [('reflink', _reflink)],
+               'hardlink': [('hardlink', os.link)],
+               'copy': []}[link_mode]
+    for method, func in methods:
+        try:
+            func(src, dst)
+            return method
+        except (IOError, OSError, AttributeError):
+            continue
+
+    shutil.copy2(src, dst)
+
+    return 'copy'
+
+
+def _sinkFiles(subjid, in_files, outputs, out_dir, link_mode='auto'):
+    import os
+    import os.path as op
+
+    from mrtpipelines.interfaces.io import _splitExt, placeFile
+
+    out_files = []
+    for in_file, (subfolder, name) in zip(in_files, outputs):
+        # A list of files is sunk with a list of names
+        pairs = zip(in_file, name) if isinstance(in_file, list) \
+            else [(in_file, name)]
+        for src, fname in pairs:
+            dst_dir = op.join(out_dir, subjid, subfolder)
+            if not op.exists(dst_dir):
+                os.makedirs(dst_dir, exist_ok=True)
+
+            dst = op.join(dst_dir, "%s_%s%s" % (subjid, fname,
+                                                _splitExt(src)[1]))
+            placeFile(src, dst, link_mode)
+            out_files.append(dst)
+
+    return out_files
+
+
+def bidsSink(out_dir, outputs, link_mode='auto', wdir=None, nthreads=1):
+    """
+    Sink files into out_dir/<subjid>/<subfolder>/<subjid>_<name><ext>,
+    with outputs giving (subfolder, name) for each file of in_files (a name
+    may be a list, for a list of files). Files are reflinked, hardlinked or
+    moved instead of copied where possible (see placeFile)
+    """
+    from nipype.pipeline import engine as pe
+    from nipype.interfaces import utility as niu
+
+    bidsSink = pe.Node(niu.Function(function=_sinkFiles,
+                                    input_names=['subjid',
+                                                 'in_files',
+                                                 'outputs',
+                                                 'out_dir',
+                                                 'link_mode'],
+                                    output_names=['out_files']),
+                                    name='bidsSink')
+    bidsSink.base_dir = wdir
+    bidsSink.inputs.outputs = outputs
+    bidsSink.inputs.out_dir = op.abspath(out_dir)
+    bidsSink.inputs.link_mode = link_mode
+    resources.setProfile(bidsSink, nthreads)
+
+    return bidsSink
+
+
+def mergeFiles(numinputs, node_name='sinkFiles', wdir=None, nthreads=1):
+    """ Gather numinputs files (in1, in2, ...) into a list for bidsSink """
+    from nipype.pipeline import engine as pe
+    from nipype.interfaces import utility as niu
+
+    mergeFiles = pe.Node(niu.Merge(numinputs), name=node_name)
+    mergeFiles.base_dir = wdir
+    # Keep lists of files as single entries, matching a list of names
+    mergeFiles.inputs.no_flatten = True
+    resources.setProfile(mergeFiles, nthreads, profile='mergeFiles')
+
+    return mergeFiles
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Reading and writing of MRtrix .mif / .mif.gz / .mih images
+
+Image data is returned as a memory map indexed in MRtrix voxel order (x, y,
+z, volume), whatever the on-disk strides are. Gradient tables embedded in
+the header (dw_scheme) are parsed to an N x 4 array. Uncompressed NIfTI
+images can be exposed to MRtrix without copying their data, through a .mih
+header pointing at the NIfTI voxel data
+"""
+import gzip
+
+import numpy as np
+
+# Bit images pack 8 voxels per byte, the first in the most significant bit
+MIF_DTYPES = {'Bit': 'b1',
+              'Int8': 'i1', 'UInt8': 'u1',
+              'Int16': 'i2', 'UInt16': 'u2',
+              'Int32': 'i4', 'UInt32': 'u4',
+              'Int64': 'i8', 'UInt64': 'u8',
+              'Float32': 'f4', 'Float64': 'f8',
+              'CFloat32': 'c8', 'CFloat64': 'c16'}
+
+
+def _parseDtype(datatype):
+    """ Convert an MRtrix datatype string (e.g. Float32LE) to numpy """
+    order = '<'
+    if datatype.endswith('LE'):
+        datatype = datatype[:-2]
+    elif datatype.endswith('BE'):
+        datatype, order = datatype[:-2], '>'
+
+    if datatype not in MIF_DTYPES:
+        raise IOError("Unsupported mif datatype: %s" % datatype)
+
+    return np.dtype(order + MIF_DTYPES[datatype])
+
+
+def _formatDtype(dtype):
+    """ Convert a numpy dtype to an MRtrix datatype string (e.g. Float32LE) """
+    dtype = np.dtype(dtype)
+    if dtype == np.bool_:
+        dtype = np.dtype('u1')
+
+    names = dict((v, k) for k, v in MIF_DTYPES.items())
+    code = '%s%d' % (dtype.kind, dtype.itemsize)
+    if code not in names:
+        raise IOError("Unsupported mif datatype: %s" % dtype)
+
+    if dtype.itemsize == 1:
+        return names[code]
+    if dtype.byteorder == '>' or (dtype.byteorder == '=' and
+                                  np.little_endian is False):
+        return names[code] + 'BE'
+
+    return names[code] + 'LE'
+
+
+def _open(in_file):
+    """ Open an image header, decompressing .mif.gz """
+    if in_file.endswith('.gz'):
+        return gzip.open(in_file, 'rb')
+
+    return open(in_file, 'rb')
+
+
+def readHeader(in_file):
+    """
+    Parse the text header of a .mif / .mif.gz / .mih image
+
+    Returns a dict with the parsed 'dim', 'vox', 'layout', 'dtype',
+    'transform' (4x4 voxel to scanner affine, voxel sizes included),
+    'scaling', 'dw_scheme' (N x 4 array, or None), 'file' and 'offset'
+    entries, plus all remaining keys as strings (repeated keys are joined by
+    new lines)
+    """
+    import os.path as op
+
+    keys = {}
+    transform = []
+    dw_scheme = []
+    with _open(in_file) as f:
+        magic = f.readline().decode('latin-1').strip()
+        if magic != 'mrtrix image':
+            raise IOError("%s is not an MRtrix image" % in_file)
+
+        for line in f:
+            line = line.decode('latin-1').strip()
+            if line == 'END':
+                break
+            key, _, value = line.partition(':')
+            key, value = key.strip(), value.strip()
+            if key == 'transform':
+                transform.append([float(v) for v in value.split(',')])
+            elif key == 'dw_scheme':
+                dw_scheme.append([float(v) for v in value.split(',')])
+            elif key in keys:
+                keys[key] = keys[key] + '\n' + value
+            else:
+                keys[key] = value
+        else:
+            raise IOError("Header of %s is not terminated" % in_file)
+
+    dim = [int(d) for d in keys.pop('dim').split(',')]
+    vox = [float(v) for v in keys.pop('vox').split(',')]
+    layout = keys.pop('layout').split(',')
+    dtype = _parseDtype(keys.pop('datatype'))
+
+    fname, _, offset = keys.pop('file').partition(' ')
+    if fname == '.':
+        fname = in_file
+    else:
+        fname = op.join(op.dirname(op.realpath(in_file)), fname)
+
+    affine = np.eye(4)
+    if transform:
+        affine[:3, :] = np.array(transform)
+    affine[:3, :3] = affine[:3, :3] * np.array(vox[:3])
+
+    scaling = (0.0, 1.0)
+    if 'scaling' in keys:
+        scaling = tuple(float(s) for s in keys.pop('scaling').split(','))
+
+    header = dict(keys)
+    header.update({'dim': dim,
+                   'vox': vox,
+                   'layout': layout,
+                   'dtype': dtype,
+                   'transform': affine,
+                   'scaling': scaling,
+                   'dw_scheme': np.array(dw_scheme) if dw_scheme else None,
+                   'file': fname,
+                   'offset': int(offset or 0)})
+
+    return header
+
+
+def _strideView(raw, dim, layout):
+    """
+    Re-index a flat on-disk buffer as an array in MRtrix voxel order
+    following the layout (e.g. ['-0', '+2', '+1']) of the image
+    """
+    ndim = len(dim)
+    rank = [abs(int(s)) for s in layout]
+    # Axes from slowest to fastest varying in the file
+    disk_order = sorted(range(ndim), key=lambda a: rank[a], reverse=True)
+
+    data = raw.reshape([dim[a] for a in disk_order])
+    data = data.transpose([disk_order.index(a) for a in range(ndim)])
+
+    flips = tuple(slice(None, None, -1) if layout[a].startswith('-')
+                  else slice(None) for a in range(ndim))
+
+    return data[flips]
+
+
+def load(in_file, mode='r'):
+    """
+    Load a .mif / .mif.gz / .mih image
+
+    Returns (data, header) where data is a memory map (read-only unless mode
+    is 'r+'; scaling is not applied) and header is as returned by
+    readHeader. Compressed and Bit images are read into memory instead
+    (Bit images unpacked to booleans, and read-only)
+    """
+    header = readHeader(in_file)
+    count = int(np.prod(header['dim']))
+    bits = header['dtype'] == np.bool_
+    if bits and mode != 'r':
+        raise IOError("Bit image %s cannot be written in place" % in_file)
+
+    # Bytes on disk
+    dtype = np.dtype('u1') if bits else header['dtype']
+    nbytes = (count + 7) // 8 if bits else count
+
+    if header['file'].endswith('.gz'):
+        with gzip.open(header['file'], 'rb') as f:
+            f.seek(header['offset'])
+            raw = np.frombuffer(f.read(nbytes * dtype.itemsize), dtype=dtype)
+    else:
+        raw = np.memmap(header['file'], dtype=dtype, mode=mode,
+                        offset=header['offset'], shape=(nbytes,))
+    if bits:
+        raw = np.unpackbits(raw, count=count, bitorder='big').view(np.bool_)
+
+    return _strideView(raw, header['dim'], header['layout']), header
+
+
+def _headerText(dim, vox, layout, dtype, affine, data_file='.', offset=None,
+                scaling=None, dw_scheme=None, keys=None):
+    """
+    Text of an MRtrix image header. With data in the same file (data_file
+    '.'), the data offset is chosen past the header, aligned to 16 bytes.
+    Returns (text, offset)
+    """
+    affine = np.asarray(affine, dtype=np.float64)
+    vox3 = np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+    rotation = affine[:3, :3] / vox3
+
+    lines = ['mrtrix image',
+             'dim: %s' % ','.join(str(int(d)) for d in dim),
+             'vox: %s' % ','.join('%.10g' % v for v in vox),
+             'layout: %s' % ','.join(layout),
+             'datatype: %s' % _formatDtype(dtype)]
+    for row in range(3):
+        lines.append('transform: %s' % ','.join(
+            '%.10g' % v for v in list(rotation[row]) + [affine[row, 3]]))
+    if scaling is not None:
+        lines.append('scaling: %.10g,%.10g' % tuple(scaling))
+    if dw_scheme is not None:
+        for grad in np.asarray(dw_scheme):
+            lines.append('dw_scheme: %s' % ','.join('%.10g' % v
+                                                    for v in grad))
+    for key, value in (keys or {}).items():
+        for item in str(value).split('\n'):
+            lines.append('%s: %s' % (key, item))
+
+    # Values (and the data file name) are kept out of the format string, as
+    # they may hold '%'
+    head = '\n'.join(lines) + '\nfile: %s ' % data_file
+    tail = '%d\nEND\n'
+    if offset is not None:
+        return head + tail % offset, offset
+
+    # The offset is part of the header it points past
+    offset = 0
+    while len(head) + len(tail % offset) > offset:
+        offset = (len(head) + len(tail % offset) + 15) // 16 * 16
+
+    return head + tail % offset, offset
+
+
+def defaultLayout(ndim):
+    """ Layout of images written here: x varies fastest (as NIfTI) """
+    return ['+%d' % axis for axis in range(ndim)]
+
+
+def create(out_file, dim, dtype, affine, vox=None, layout=None, scaling=None,
+           dw_scheme=None, keys=None):
+    """
+    Create an uncompressed .mif image and return a writable memory map of
+    its data in MRtrix voxel order (to be filled in by the caller). affine
+    maps voxel to scanner coordinates, voxel sizes included
+    """
+    dim = [int(d) for d in dim]
+    layout = layout or defaultLayout(len(dim))
+    if vox is None:
+        vox = list(np.sqrt((np.asarray(affine)[:3, :3] ** 2).sum(axis=0)))
+        vox = vox[:len(dim)] + [1.] * (len(dim) - 3)
+    dtype = np.dtype(dtype)
+
+    text, offset = _headerText(dim, vox, layout, dtype, affine,
+                               scaling=scaling, dw_scheme=dw_scheme,
+                               keys=keys)
+    count = int(np.prod(dim))
+    with open(out_file, 'wb') as f:
+        f.write(text.encode('latin-1'))
+        f.write(b'\0' * (offset - len(text)))
+        f.truncate(offset + count * dtype.itemsize)
+
+    raw = np.memmap(out_file, dtype=dtype, mode='r+', offset=offset,
+                    shape=(count,))
+
+    return _strideView(raw, dim, layout)
+
+
+def save(out_file, data, affine, vox=None, scaling=None, dw_scheme=None,
+         keys=None):
+    """
+    Write data (in voxel order) as a .mif image, or a compressed .mif.gz.
+    Returns out_file
+    """
+    data = np.asarray(data)
+    if data.dtype == np.bool_:
+        data = data.astype(np.uint8)
+
+    if not out_file.endswith('.gz'):
+        out = create(out_file, data.shape, data.dtype, affine, vox=vox,
+                     scaling=scaling, dw_scheme=dw_scheme, keys=keys)
+        out[...] = data
+        out.flush()
+        del out
+
+        return out_file
+
+    if vox is None:
+        vox = list(np.sqrt((np.asarray(affine)[:3, :3] ** 2).sum(axis=0)))
+        vox = vox[:data.ndim] + [1.] * (data.ndim - 3)
+    text, offset = _headerText(data.shape, vox, defaultLayout(data.ndim),
+                               data.dtype, affine, scaling=scaling,
+                               dw_scheme=dw_scheme, keys=keys)
+    with gzip.open(out_file, 'wb') as f:
+        f.write(text.encode('latin-1'))
+        f.write(b'\0' * (offset - len(text)))
+        f.write(data.tobytes(order='F'))
+
+    return out_file
+
+
+def fslToScheme(bvecs, bvals, affine):
+    """
+    Convert FSL bvecs/bvals (given in image axes) to an MRtrix dw_scheme in
+    scanner space, as MRtrix does: the x component is negated when the image
+    transform has a positive determinant, then directions are rotated into
+    scanner space. bvecs may be given as 3 x N (as FSL writes them) or N x 3
+    """
+    bvecs = np.array(bvecs, dtype=np.float64)
+    bvals = np.array(bvals, dtype=np.float64).ravel()
+    if bvecs.ndim == 2 and bvecs.shape == (3, bvals.size):
+        pass
+    elif bvecs.ndim == 2 and bvecs.shape == (bvals.size, 3):
+        bvecs = bvecs.T.copy()
+    else:
+        raise ValueError("bvecs of shape %s do not match %d bvals (expected "
+                         "3 x N or N x 3)" % (bvecs.shape, bvals.size))
+
+    linear = np.asarray(affine, dtype=np.float64)[:3, :3]
+    if np.linalg.det(linear) > 0:
+        bvecs[0] = -bvecs[0]
+    rotation = linear / np.sqrt((linear ** 2).sum(axis=0))
+
+    return np.column_stack([rotation.dot(bvecs).T, bvals])
+
+
+def _readFsl(grad_fsl):
+    """ Read an FSL (bvecs, bvals) file pair """
+    bvec_file, bval_file = grad_fsl
+
+    return np.loadtxt(bvec_file, ndmin=2), np.loadtxt(bval_file, ndmin=1)
+
+
+def _niftiScaling(img):
+    """ (offset, multiplier) of a NIfTI image, or None when unscaled """
+    slope = getattr(img.dataobj, 'slope', 1.)
+    inter = getattr(img.dataobj, 'inter', 0.)
+    if np.isnan(slope) or slope == 0 or (slope == 1. and inter == 0.):
+        return None
+
+    return float(inter), float(slope)
+
+
+def niftiHeader(in_file, out_file, grad_fsl=None):
+    """
+    Write a .mih header exposing the data of an uncompressed NIfTI image
+    (in_file) to MRtrix without copying it. grad_fsl is an optional
+    (bvecs, bvals) pair embedded as dw_scheme. Returns out_file
+    """
+    import os
+    import os.path as op
+
+    import nibabel as nib
+
+    img = nib.load(in_file)
+    data_file = img.file_map['image'].filename
+    if data_file.endswith('.gz'):
+        raise IOError("%s is compressed and cannot be referenced" % in_file)
+
+    dw_scheme = None
+    if grad_fsl is not None:
+        dw_scheme = fslToScheme(*(_readFsl(grad_fsl) + (img.affine,)))
+
+    # The data file is resolved relative to the header
+    rel_file = op.relpath(op.realpath(data_file),
+                          op.dirname(op.realpath(out_file)))
+    # Stamped with the data file, so that the header changes with the data
+    # for anything hashing the header alone (e.g. nipype)
+    stat = os.stat(data_file)
+    zooms = img.header.get_zooms()
+    text, _ = _headerText(img.shape, zooms, defaultLayout(len(img.shape)),
+                          img.get_data_dtype(), img.affine,
+                          data_file=rel_file, offset=int(img.dataobj.offset),
+                          scaling=_niftiScaling(img), dw_scheme=dw_scheme,
+                          keys={'data_stamp': '%d %d' % (stat.st_size,
+                                                         stat.st_mtime_ns)})
+    with open(out_file, 'w') as f:
+        f.write(text)
+
+    return out_file
+
+
+def convertNifti(in_file, out_file, grad_fsl=None):
+    """
+    Convert a (possibly compressed) NIfTI image to .mif, streaming one
+    volume at a time. grad_fsl is an optional (bvecs, bvals) pair embedded
+    as dw_scheme. Returns out_file
+    """
+    import nibabel as nib
+
+    img = nib.load(in_file)
+    proxy = img.dataobj
+    # Scaled values are written as floats
+    dtype = img.get_data_dtype()
+    if _niftiScaling(img) is not None:
+        dtype = np.float32
+
+    dw_scheme = None
+    if grad_fsl is not None:
+        dw_scheme = fslToScheme(*(_readFsl(grad_fsl) + (img.affine,)))
+
+    vox = list(img.header.get_zooms())
+    out = create(out_file, img.shape, dtype, img.affine, vox=vox,
+                 dw_scheme=dw_scheme)
+    if len(img.shape) > 3:
+        volumes = img.shape[3:]
+        for idx in np.ndindex(*volumes):
+            out[(Ellipsis,) + idx] = proxy[(slice(None),) * 3 + idx]
+    else:
+        out[...] = np.asanyarray(proxy)
+    out.flush()
+    del out
+
+    return out_file
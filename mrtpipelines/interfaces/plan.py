@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Dry-run planning
+
+Lists the nodes a pipeline would run, in execution order, with the nodes
+each depends on, without importing nipype or building the workflow. A node
+is cached when the work directory holds its result from a previous run
+(nipype reruns it only if its inputs changed), restorable when the result
+cache holds the outputs for the inputs it last ran with, and an output is
+present when it is already in the output directory. The node lists mirror the
+workflows of preproc_wf and tractography_wf, and the connections made by
+the command line interfaces (tests/test_plan.py checks them against the
+workflows built)
+"""
+import glob
+import gzip
+import os.path as op
+import pickle
+
+PREPROC = 'dholl_preproc_wf.'
+TRACT = 'genDhollTract_wf.'
+
+# Nodes wrapped with cache.cachedInterface, as (interface, command)
+CACHED_NODES = {
+    'dwi2fod': ('EstimateFOD', 'dwi2fod'),
+    'MRRegister': ('MRRegister', 'mrregister'),
+    'FitTensor': ('FitTensor', 'dwi2tensor'),
+    'genTract': ('Tractography', 'tckgen'),
+    'siftTract': ('SIFT', 'tcksift'),
+    'tckSample': ('TCKSample', 'tcksample')
+}
+
+
+def dhollNodes(sink_nodes, sshell=False, shards=1, export=('vtk',),
+               tensor_engine='mrtrix'):
+    """
+    Nodes of genDhollanderTractography, as (node, upstream nodes), with
+    sink_nodes the nodes whose outputs are sunk
+    """
+    pre, trk = PREPROC, TRACT
+    nodes = [
+        ('BIDSDataGrabber', []),
+        (pre + 'getTemplate', []),
+        (pre + 'dwiConvert', ['BIDSDataGrabber']),
+        (pre + 'maskConvert', ['BIDSDataGrabber']),
+        (pre + 'dwi2response', [pre + 'dwiConvert', pre + 'maskConvert']),
+        (pre + 'dwi2fod', [pre + 'dwiConvert', pre + 'dwi2response',
+                           pre + 'maskConvert']),
+        (pre + 'mtnormalise', [pre + 'dwi2fod', pre + 'maskConvert']),
+        (pre + 'MRRegister', [pre + 'maskConvert', pre + 'getTemplate',
+                              pre + 'mtnormalise']),
+        (pre + 'WarpSelect1', [pre + 'MRRegister']),
+        (pre + 'WarpSelect2', [pre + 'MRRegister']),
+        (pre + 'MaskTransform', [pre + 'maskConvert', pre + 'WarpSelect1']),
+        (pre + 'FODTransform', [pre + 'mtnormalise', pre + 'WarpSelect1']),
+        (pre + 'DWINormalise', [pre + 'dwiConvert', pre + 'maskConvert']),
+        (pre + 'DWITransform', [pre + 'DWINormalise', pre + 'WarpSelect1']),
+        (pre + 'FitTensor', [pre + 'DWITransform', pre + 'MaskTransform'])
+    ]
+    if tensor_engine != 'python':
+        nodes.append((pre + 'TensorMetrics', [pre + 'FitTensor',
+                                              pre + 'MaskTransform']))
+
+    source = pre + ('DWITransform' if sshell else 'FODTransform')
+    nodes.append((trk + 'genTract', [source, pre + 'MaskTransform']))
+    if shards > 1:
+        nodes.append((trk + 'mergeTract', [trk + 'genTract']))
+        tract = trk + 'mergeTract'
+    else:
+        tract = trk + 'genTract'
+    nodes += [
+        (trk + 'siftTract', [tract, pre + 'FODTransform']),
+        (trk + 'indexTract', [trk + 'siftTract', pre + 'MaskTransform'])
+    ]
+    if export:
+        nodes.append((trk + 'convTract',
+                      [trk + 'siftTract'] +
+                      ([pre + 'MaskTransform'] if 'trk' in export else [])))
+
+    nodes += [
+        ('sinkFiles', sorted(set(sink_nodes),
+                             key=[node for node, _ in nodes].index)),
+        ('bidsSink', ['BIDSDataGrabber', 'sinkFiles'])
+    ]
+
+    return nodes
+
+
+def scalarNodes(engine='mrtrix', stats=False, select=False):
+    """ Nodes of tractScalar, as (node, upstream nodes) """
+    nodes = [('BIDSScalarGrabber', [])]
+    tract = 'BIDSScalarGrabber'
+    if select:
+        nodes.append(('selectTract', ['BIDSScalarGrabber']))
+        tract = 'selectTract'
+
+    if engine == 'mrtrix':
+        nodes.append(('tckSample', sorted({tract, 'BIDSScalarGrabber'})))
+        nodes.append(('writeScalar', ['tckSample']))
+        values = 'writeScalar'
+    else:
+        nodes.append(('sampleTract', sorted({tract, 'BIDSScalarGrabber'})))
+        values = 'sampleTract'
+
+    sinks = [values]
+    if stats:
+        nodes.append(('tractStats', sorted({tract, values})))
+        sinks.append('tractStats')
+
+    nodes += [
+        ('sinkFiles', sinks),
+        ('bidsSink', ['BIDSScalarGrabber', 'sinkFiles'])
+    ]
+
+    return nodes
+
+
+def nodeDir(work_dir, pipeline, node, subjid=None):
+    """
+    Directory of node ('workflow.node') of pipeline in the work directory.
+    In a batch (subjid given), nodes run once per participant
+    """
+    parts = node.split('.')
+    path = [work_dir, pipeline] + parts[:-1]
+    if subjid is not None:
+        path.append('_subjid_%s' % subjid)
+
+    return op.join(*(path + [parts[-1]]))
+
+
+def nodeCached(node_dir, node):
+    """ Whether node_dir holds a result of node """
+    name = node.split('.')[-1]
+    if not op.exists(op.join(node_dir, 'result_%s.pklz' % name)):
+        return False
+
+    # nipype writes the hash file of a node once it has run successfully
+    return any(not hashfile.endswith('_unfinished.json')
+               for hashfile in glob.glob(op.join(glob.escape(node_dir),
+                                                 '_0x*.json')))
+
+
+def restorable(cache_dir, node, runs):
+    """
+    Whether the result cache in cache_dir holds the outputs of node for
+    every run in runs (dicts of its defined inputs, one per run of a
+    MapNode). Input files are fingerprinted as they are now
+    """
+    name = node.split('.')[-1]
+    if name not in CACHED_NODES or not runs:
+        return False
+
+    # Imports nipype, so only when a result cache is given
+    from mrtpipelines.interfaces import cache
+
+    interface, cmd = CACHED_NODES[name]
+    results = cache.ResultCache(op.realpath(cache_dir))
+
+    return all(results.contains(cache.cacheKey('Cached' + interface, cmd,
+                                               inputs)[0])
+               for inputs in runs)
+
+
+def nodeRestorable(node_dir, node, cache_dir):
+    """
+    Whether the result cache in cache_dir holds the outputs of node, for the
+    inputs recorded in node_dir when it last ran (those of every run of a
+    MapNode)
+    """
+    name = node.split('.')[-1]
+    if name not in CACHED_NODES:
+        return False
+
+    records = sorted(glob.glob(op.join(glob.escape(node_dir), 'mapflow',
+                                       '_%s[0-9]*' % name, '_inputs.pklz')))
+    records = records or [op.join(node_dir, '_inputs.pklz')]
+    runs = []
+    for record in records:
+        try:
+            with gzip.open(record, 'rb') as f:
+                runs.append(pickle.load(f))
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return False
+
+    return restorable(cache_dir, node, runs)
+
+
+def findOutput(out_dir, subjid, subfolder, name, ext=None):
+    """
+    Sunk file of an output (out_dir/<subjid>/<subfolder>/<subjid>_<name>),
+    with extension ext or any extension when None. Returns None if missing
+    """
+    base = op.join(out_dir, subjid, subfolder, '%s_%s' % (subjid, name))
+    if ext is not None:
+        return base + ext if op.exists(base + ext) else None
+
+    found = sorted(glob.glob(glob.escape(base) + '.*'))
+    return found[0] if found else None
+
+
+def printPlan(pipeline, nodes, work_dir, out_dir, subjid, inputs, outputs,
+              batch=False, cache_dir=None, runs=None):
+    """
+    Print the plan of one participant: its resolved inputs (name, value),
+    each node with its status and upstream nodes, and each output
+    (subfolder, name, ext) with its status. With work_dir None (a new work
+    directory per run), no node is cached, and nodes are looked up in the
+    result cache with the inputs given in runs (node: list of dicts of
+    inputs, see restorable). Returns the number of nodes to run
+    """
+    print("%s: %s" % (pipeline, subjid))
+    print("  inputs")
+    for name, value in inputs:
+        print("    %-13s %s%s" % (name, value,
+                                 '' if op.exists(value) else ' (missing)'))
+
+    print("  nodes (%s%s)" %
+          ('work directory %s' % work_dir if work_dir else
+           'new work directory per run, none cached',
+           ', result cache %s' % cache_dir if cache_dir else ''))
+    run = restore = 0
+    # In a batch, the first node iterates over participants
+    iterated = {nodes[0][0]} if batch else set()
+    for node, upstream in nodes:
+        if iterated.intersection(upstream):
+            iterated.add(node)
+        if work_dir is None:
+            cached = False
+            found = bool(cache_dir) and \
+                restorable(cache_dir, node, (runs or {}).get(node))
+        else:
+            node_dir = nodeDir(work_dir, pipeline, node,
+                               subjid if node in iterated else None)
+            cached = nodeCached(node_dir, node)
+            found = not cached and bool(cache_dir) and \
+                nodeRestorable(node_dir, node, cache_dir)
+        status = 'cached' if cached else \
+            'restorable' if found else 'uncached'
+        run += status != 'cached'
+        restore += status == 'restorable'
+        line = "    %-10s %s" % (status, node)
+        if upstream:
+            line += " <- %s" % ", ".join(upstream)
+        print(line)
+
+    print("  outputs (output directory %s)" % out_dir)
+    for subfolder, name, ext in outputs:
+        found = findOutput(out_dir, subjid, subfolder, name, ext)
+        print("    %-10s %s" % ('present' if found else 'missing',
+                                op.relpath(found, out_dir) if found else
+                                op.join(subjid, subfolder, '%s_%s%s' %
+                                        (subjid, name, ext or '.*'))))
+
+    print("  %d of %d nodes to run%s" %
+          (run, len(nodes),
+           ', %d restored from the result cache' % restore if restore else ''))
+
+    return run
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Per-node profiling of pipeline runs
+
+NodeProfiler is passed to the nipype plugin as status_callback and records
+wall time, CPU time, thread utilisation, peak RSS (from the nipype resource
+monitor, when enabled) and the size of each node's input and output files.
+The report is written as JSON and CSV together with the critical path of
+the executed graph
+"""
+import csv
+import json
+import os.path as op
+import time
+
+FIELDS = ('node', 'interface', 'status', 'start', 'wall_s', 'cpu_s',
+          'threads', 'thread_util', 'peak_rss_gb', 'in_bytes', 'out_bytes')
+
+
+def _fileBytes(value):
+    """ Total size of the existing files within an input/output value """
+    if isinstance(value, (list, tuple)):
+        return sum(_fileBytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_fileBytes(v) for v in value.values())
+    if isinstance(value, str) and op.isabs(value) and op.isfile(value):
+        return op.getsize(value)
+
+    return 0
+
+
+def _runtimeValue(runtime, name):
+    value = getattr(runtime, name, None)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _cpuSeconds(runtime, wall):
+    """
+    CPU time of a runtime, from its CPU usage over its duration (or wall,
+    when the runtime has no duration)
+    """
+    cpu_percent = _runtimeValue(runtime, 'cpu_percent')
+    if cpu_percent is None:
+        return None
+
+    duration = _runtimeValue(runtime, 'duration')
+    if duration is None:
+        duration = wall
+
+    return duration * cpu_percent / 100.
+
+
+class NodeProfiler(object):
+    """ nipype status callback collecting one record per executed node """
+
+    def __init__(self):
+        self.records = {}
+        self._started = {}
+
+    def __call__(self, node, status):
+        name = node.fullname
+        if status == 'start':
+            self._started[name] = time.time()
+            return
+
+        end = time.time()
+        start = self._started.pop(name, end)
+        wall = end - start
+        threads = node.n_procs or 1
+
+        record = {'node': name,
+                  'interface': type(node.interface).__name__,
+                  'status': status,
+                  'start': start,
+                  'wall_s': wall,
+                  'cpu_s': None,
+                  'threads': threads,
+                  'thread_util': None,
+                  'peak_rss_gb': None,
+                  'in_bytes': _fileBytes(node.inputs.get()),
+                  'out_bytes': 0}
+
+        try:
+            result = node.result
+        except Exception:
+            result = None
+
+        if result is not None:
+            runtimes = result.runtime
+            if not isinstance(runtimes, list):
+                runtimes = [runtimes]
+            # A MapNode has a runtime per subnode: CPU time adds up, memory
+            # peaks at the largest subnode
+            cpu = [_cpuSeconds(runtime, wall) for runtime in runtimes]
+            cpu = [c for c in cpu if c is not None]
+            if cpu:
+                record['cpu_s'] = sum(cpu)
+                if wall > 0:
+                    record['thread_util'] = sum(cpu) / wall / threads
+            rss = [_runtimeValue(runtime, 'mem_peak_gb')
+                   for runtime in runtimes]
+            rss = [r for r in rss if r is not None]
+            record['peak_rss_gb'] = max(rss) if rss else None
+            if result.outputs is not None:
+                record['out_bytes'] = _fileBytes(result.outputs.get())
+
+        self.records[name] = record
+
+    def criticalPath(self, graph):
+        """
+        Longest chain of dependent nodes by wall time through the executed
+        graph (as returned by Workflow.run)
+        """
+        import networkx as nx
+
+        best = {}
+        for node in nx.topological_sort(graph):
+            wall = self.records.get(node.fullname, {}).get('wall_s', 0.)
+            prev = max((best[p] for p in graph.predecessors(node)),
+                       key=lambda b: b[0], default=(0., []))
+            best[node] = (prev[0] + wall, prev[1] + [node.fullname])
+
+        if not best:
+            return 0., []
+
+        return max(best.values(), key=lambda b: b[0])
+
+    def write(self, out_base, graph=None):
+        """
+        Write out_base.json and out_base.csv, returning the JSON report
+        """
+        records = sorted(self.records.values(), key=lambda r: r['start'])
+        report = {'nodes': records,
+                  'total_wall_s': (max(r['start'] + r['wall_s']
+                                       for r in records) -
+                                   min(r['start'] for r in records))
+                                  if records else 0.}
+        if graph is not None:
+            length, path = self.criticalPath(graph)
+            report['critical_path_s'] = length
+            report['critical_path'] = path
+
+        with open(out_base + '.json', 'w') as f:
+            json.dump(report, f, indent=2)
+
+        with open(out_base + '.csv', 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+
+        return report
+
+
+def summary(report, top=5):
+    """ Short text summary of a profiling report """
+    lines = ["Total wall time: %.1f s" % report['total_wall_s']]
+    if 'critical_path' in report:
+        lines.append("Critical path (%.1f s): %s" %
+                     (report['critical_path_s'],
+                      " -> ".join(report['critical_path'])))
+    lines.append("Slowest nodes:")
+    slowest = sorted(report['nodes'], key=lambda r: r['wall_s'],
+                     reverse=True)[:top]
+    for record in slowest:
+        rss = record['peak_rss_gb']
+        lines.append("  %-60s %8.1f s  %s GB" %
+                     (record['node'], record['wall_s'],
+                      "%.2f" % rss if rss is not None else "n/a"))
+
+    return "\n".join(lines)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Resource profiles of pipeline nodes
+
+Each profile gives the share of the thread budget a node should use, its
+estimated peak memory (GB), whether it is bound by CPU or I/O and its
+relative cost (run time with the full budget). I/O-bound nodes always get a
+single thread. Nodes are first given their share of the budget; once a
+workflow is assembled, balance splits the budget between the branches that
+can actually run concurrently, leaving the nodes on the critical path with
+the full budget, and clamp limits every node to the threads and memory
+given to the scheduler
+"""
+
+PROFILES = {
+    # Inputs / outputs
+    'BIDSDataGrabber': {'share': 0.0, 'mem_gb': 0.5, 'bound': 'io',
+                        'cost': 0},
+    'BIDSScalarGrabber': {'share': 0.0, 'mem_gb': 0.5, 'bound': 'io',
+                          'cost': 0},
+    'getTemplate': {'share': 0.0, 'mem_gb': 0.1, 'bound': 'io',
+                    'cost': 0},
+    'rename': {'share': 0.0, 'mem_gb': 0.1, 'bound': 'io',
+               'cost': 0},
+    'subjSink': {'share': 0.0, 'mem_gb': 0.1, 'bound': 'io',
+                 'cost': 0},
+    'bidsSink': {'share': 0.0, 'mem_gb': 0.1, 'bound': 'io',
+                 'cost': 0},
+    'mergeFiles': {'share': 0.0, 'mem_gb': 0.1, 'bound': 'io',
+                   'cost': 0},
+    'dwiConvert': {'share': 0.0, 'mem_gb': 2.0, 'bound': 'io',
+                   'cost': 0},
+    'maskConvert': {'share': 0.0, 'mem_gb': 0.5, 'bound': 'io',
+                    'cost': 0},
+    'WarpSelect1': {'share': 0.0, 'mem_gb': 0.1, 'bound': 'io',
+                    'cost': 0},
+    'WarpSelect2': {'share': 0.0, 'mem_gb': 0.1, 'bound': 'io',
+                    'cost': 0},
+
+    # Response & FOD branch
+    'dwi2response': {'share': 1.0, 'mem_gb': 2.0, 'bound': 'cpu',
+                     'cost': 3},
+    'dwi2fod': {'share': 1.0, 'mem_gb': 4.0, 'bound': 'cpu',
+                'cost': 5},
+    'mtnormalise': {'share': 1.0, 'mem_gb': 2.0, 'bound': 'cpu',
+                    'cost': 1},
+    'FODTransform': {'share': 1.0, 'mem_gb': 3.0, 'bound': 'cpu',
+                     'cost': 1},
+    'MaskTransform': {'share': 0.0, 'mem_gb': 0.5, 'bound': 'io',
+                      'cost': 0},
+
+    # Registration (all remaining stages wait on it)
+    'MRRegister': {'share': 1.0, 'mem_gb': 4.0, 'bound': 'cpu',
+                   'cost': 10},
+
+    # Tensor branch (DWINormalise runs alongside the FOD branch)
+    'DWINormalise': {'share': 1.0, 'mem_gb': 2.0, 'bound': 'cpu',
+                     'cost': 1},
+    'DWITransform': {'share': 1.0, 'mem_gb': 3.0, 'bound': 'cpu',
+                     'cost': 1},
+    'FitTensor': {'share': 1.0, 'mem_gb': 3.0, 'bound': 'cpu',
+                  'cost': 2},
+    'TensorMetrics': {'share': 1.0, 'mem_gb': 2.0, 'bound': 'cpu',
+                      'cost': 1},
+
+    # Tractography
+    'genTract': {'share': 1.0, 'mem_gb': 2.0, 'bound': 'cpu',
+                 'cost': 20},
+    'genTractShard': {'share': 0.0, 'mem_gb': 1.0, 'bound': 'cpu',
+                      'cost': 20},
+    'mergeTract': {'share': 0.0, 'mem_gb': 0.5, 'bound': 'io',
+                   'cost': 0},
+    'siftTract': {'share': 1.0, 'mem_gb': 8.0, 'bound': 'cpu',
+                  'cost': 10},
+    'convTract': {'share': 0.0, 'mem_gb': 1.0, 'bound': 'io',
+                  'cost': 0},
+    'indexTract': {'share': 0.0, 'mem_gb': 2.0, 'bound': 'io',
+                   'cost': 0},
+
+    # Scalar sampling
+    'tckSample': {'share': 1.0, 'mem_gb': 1.0, 'bound': 'cpu',
+                  'cost': 2},
+    'writeScalar': {'share': 0.0, 'mem_gb': 0.5, 'bound': 'io',
+                    'cost': 0},
+    'sampleTract': {'share': 0.0, 'mem_gb': 1.0, 'bound': 'cpu',
+                    'cost': 2},
+    'tractStats': {'share': 0.0, 'mem_gb': 1.0, 'bound': 'cpu',
+                   'cost': 1},
+    'selectTract': {'share': 0.0, 'mem_gb': 0.5, 'bound': 'io',
+                    'cost': 0},
+}
+
+DEFAULT_PROFILE = {'share': 1.0, 'mem_gb': 1.0, 'bound': 'cpu', 'cost': 1}
+
+
+def getThreads(profile, nthreads=1):
+    """ Number of threads a profile is given out of a budget of nthreads """
+    if profile['bound'] == 'io':
+        return 1
+
+    return max(1, int(nthreads * profile['share']))
+
+
+def setProfile(node, nthreads=1, profile=None):
+    """
+    Apply a resource profile (by default the one registered under the node's
+    name) to a node, setting the threads the scheduler reserves for it, the
+    thread count passed to MRtrix commands and the memory estimate
+    """
+    profile = PROFILES.get(profile or node.name, DEFAULT_PROFILE)
+
+    setThreads(node, getThreads(profile, int(nthreads)))
+    node._mem_gb = profile['mem_gb']
+
+    return node
+
+
+def setThreads(node, threads):
+    """ Set the threads reserved for a node and passed to its command """
+    node.interface.num_threads = threads
+    node.n_procs = threads
+    if 'nthreads' in node.inputs.copyable_trait_names():
+        node.inputs.nthreads = threads
+
+    return node
+
+
+def _maxAntichain(graph, nodes):
+    """
+    Size of the largest set of nodes (of a DAG) that do not depend on each
+    other, by Dilworth's theorem: nodes less a maximum matching between each
+    node and its descendants
+    """
+    import networkx as nx
+
+    pairs = nx.Graph()
+    pairs.add_nodes_from((node, 0) for node in nodes)
+    pairs.add_nodes_from((node, 1) for node in nodes)
+    for node in nodes:
+        after = nx.descendants(graph, node)
+        pairs.add_edges_from(((node, 0), (other, 1)) for other in nodes
+                             if other in after)
+    matching = nx.bipartite.hopcroft_karp_matching(
+        pairs, top_nodes=[(node, 0) for node in nodes])
+
+    return len(nodes) - len(matching) // 2
+
+
+def _nodes(workflow):
+    """ Nodes of workflow and its sub-workflows, by full name """
+    nodes = {}
+
+    def _walk(wf, prefix):
+        for node in wf._graph.nodes():
+            if hasattr(node, '_graph'):
+                _walk(node, prefix + node.name + '.')
+            else:
+                nodes[prefix + node.name] = node
+
+    _walk(workflow, workflow.name + '.')
+
+    return nodes
+
+
+def clamp(workflow, nprocs, mem_gb=None):
+    """
+    Limit the threads and memory estimate of every node of workflow to the
+    budget of the MultiProc plugin (nprocs processors and mem_gb GB, by
+    default 90% of the system memory as the plugin assumes), which refuses
+    to run a workflow holding a node estimated beyond it. Such nodes then run
+    alone
+    """
+    if mem_gb is None:
+        from nipype.utils.profiler import get_system_total_memory_gb
+
+        mem_gb = get_system_total_memory_gb() * 0.9
+
+    for node in _nodes(workflow).values():
+        if node.n_procs > nprocs:
+            setThreads(node, max(1, int(nprocs)))
+        if node.mem_gb > mem_gb:
+            node._mem_gb = mem_gb
+
+    return workflow
+
+
+def balance(workflow, nthreads=1):
+    """
+    Split the thread budget of an assembled workflow between the branches
+    that can run concurrently. Multi-threaded nodes on the critical path (the
+    costliest chain of nodes) keep the full budget, so the scheduler runs
+    them alone; other multi-threaded nodes share the budget with the
+    branches they can run alongside
+    """
+    import networkx as nx
+
+    # The flat graph holds copies of the nodes, matched back by their names
+    nodes = _nodes(workflow)
+    graph = workflow._create_flat_graph()
+
+    # Costliest chain
+    cost, previous = {}, {}
+    for node in nx.topological_sort(graph):
+        upstream = max(graph.predecessors(node), key=cost.get, default=None)
+        previous[node] = upstream
+        cost[node] = PROFILES.get(node.name, DEFAULT_PROFILE)['cost'] + \
+            (cost[upstream] if upstream is not None else 0)
+    critical = set()
+    node = max(cost, key=cost.get, default=None)
+    while node is not None:
+        critical.add(node)
+        node = previous[node]
+
+    threaded = [node for node in graph.nodes() if node.n_procs > 1]
+    for node in threaded:
+        if node in critical:
+            continue
+        related = nx.ancestors(graph, node) | nx.descendants(graph, node)
+        alongside = [other for other in threaded
+                     if other is not node and other not in related]
+        branches = 1 + _maxAntichain(graph, alongside)
+        setThreads(nodes[node.fullname], max(1, int(nthreads) // branches))
+
+    return workflow
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+In-process sampling of scalar images along streamlines
+
+Mirrors MRtrix3 tcksample: vertices are mapped from scanner space to voxel
+space, points further than half a voxel outside the image are NaN, and
+neighbours are clamped to the image edge for trilinear interpolation
+"""
+import numpy as np
+
+
+def loadImage(in_file):
+    """
+    Load a 3D scalar image (NIfTI or MRtrix) as float32
+
+    Returns (data, affine) with affine mapping voxel to scanner coordinates
+    """
+    from mrtpipelines.interfaces import mif
+
+    if in_file.endswith(('.mif', '.mif.gz', '.mih')):
+        data, header = mif.load(in_file)
+        offset, scale = header['scaling']
+        affine = header['transform']
+        data = np.asarray(data, dtype=np.float32) * np.float32(scale) + \
+            np.float32(offset)
+    else:
+        import nibabel as nib
+
+        img = nib.load(in_file)
+        data = np.asarray(img.get_fdata(dtype=np.float32))
+        affine = img.affine
+
+    data = np.squeeze(data)
+    if data.ndim != 3:
+        raise ValueError("%s is not a 3D scalar image" % in_file)
+
+    return data, affine
+
+
+def sampleImage(data, affine, points, interp='linear'):
+    """
+    Sample a 3D image at scanner space points (N x 3)
+
+    interp is one of 'linear' or 'nearest'. Points outside of the image, or
+    non-finite points (such as .tck delimiters), are NaN
+    """
+    if interp not in ('linear', 'nearest'):
+        raise ValueError("Unknown interpolation: %s" % interp)
+
+    inv = np.linalg.inv(affine)
+    vox = np.asarray(points, dtype=np.float64).dot(inv[:3, :3].T) + inv[:3, 3]
+
+    dim = np.array(data.shape[:3])
+    with np.errstate(invalid='ignore'):
+        valid = np.all((vox >= -0.5) & (vox <= dim - 0.5), axis=1)
+
+    out = np.full(vox.shape[0], np.nan, dtype=np.float32)
+    vox = vox[valid]
+
+    if interp == 'nearest':
+        idx = np.clip(np.floor(vox + 0.5).astype(np.intp), 0, dim - 1)
+        out[valid] = data[idx[:, 0], idx[:, 1], idx[:, 2]]
+        return out
+
+    base = np.floor(vox)
+    frac = vox - base
+    base = base.astype(np.intp)
+    lo = np.clip(base, 0, dim - 1)
+    hi = np.clip(base + 1, 0, dim - 1)
+
+    value = np.zeros(vox.shape[0], dtype=np.float64)
+    for corner in range(8):
+        sel = [(corner >> axis) & 1 for axis in range(3)]
+        weight = np.ones(vox.shape[0], dtype=np.float64)
+        ijk = []
+        for axis in range(3):
+            if sel[axis]:
+                weight *= frac[:, axis]
+                ijk.append(hi[:, axis])
+            else:
+                weight *= 1.0 - frac[:, axis]
+                ijk.append(lo[:, axis])
+        value += weight * data[ijk[0], ijk[1], ijk[2]]
+
+    out[valid] = value
+
+    return out
+
+
+def sampleTck(in_file, in_image, writer, chunk_size=10000, interp='linear'):
+    """
+    Sample in_image at every vertex of the streamlines in in_file, feeding
+    blocks of chunk_size streamlines to writer (see
+    tractography.ScalarWriter). Returns the number of streamlines sampled
+
+    in_image may be a list of images, all sampled during the same pass over
+    the tractogram. writer is then either a single writer receiving one
+    column per image, or a list with one writer per image
+    """
+    from mrtpipelines.interfaces.tck import TckFile
+
+    images = in_image if isinstance(in_image, list) else [in_image]
+    images = [loadImage(image) for image in images]
+    tck = TckFile(in_file)
+
+    for _, block, lengths in tck.iterChunks(chunk_size):
+        # Delimiters sample to NaN and are dropped by position
+        keep = ~np.isnan(block[:, 0])
+        values = [sampleImage(data, affine, block, interp)[keep]
+                  for data, affine in images]
+
+        if isinstance(writer, list):
+            for out, column in zip(writer, values):
+                out.write(column, lengths)
+        elif isinstance(in_image, list):
+            writer.write(np.column_stack(values), lengths)
+        else:
+            writer.write(values[0], lengths)
+
+    return len(tck)
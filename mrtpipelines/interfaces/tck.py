@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Reading and writing of MRtrix .tck tractography files
+
+Streamline vertices are exposed through a read-only memory map of the
+float32 triplet stream, so individual streamlines and blocks of streamlines
+are returned as views without copying the file into memory
+"""
+import numpy as np
+
+TCK_DTYPES = {'Float32LE': '<f4',
+              'Float32BE': '>f4',
+              'Float64LE': '<f8',
+              'Float64BE': '>f8'}
+
+# Number of vertices scanned at a time when locating streamline delimiters
+SCAN_BLOCK = 1 << 22
+
+
+def readHeader(in_file):
+    """
+    Parse the text header of a .tck file
+
+    Returns the header as a dict of strings (repeated keys are joined by new
+    lines, as MRtrix does) and the byte offset of the vertex data
+    """
+    header = {}
+    with open(in_file, 'rb') as f:
+        magic = f.readline().decode('latin-1').strip()
+        if magic != 'mrtrix tracks':
+            raise IOError("%s is not an MRtrix tracks file" % in_file)
+
+        for line in f:
+            line = line.decode('latin-1').strip()
+            if line == 'END':
+                break
+            key, _, value = line.partition(':')
+            key, value = key.strip(), value.strip()
+            if key in header:
+                header[key] = header[key] + '\n' + value
+            else:
+                header[key] = value
+        else:
+            raise IOError("Header of %s is not terminated" % in_file)
+
+    fname, _, offset = header.get('file', '').partition(' ')
+    if fname != '.' or not offset:
+        raise IOError("%s does not store data in the same file" % in_file)
+
+    return header, int(offset)
+
+
+class TckFile(object):
+    """
+    Memory-mapped view of the streamlines in a .tck file
+
+    streamline i spans points[starts[i]:ends[i]]; consecutive streamlines are
+    separated by a single NaN triplet in the underlying stream
+    """
+
+    def __init__(self, in_file, starts=None, ends=None):
+        import os.path as op
+
+        self.in_file = in_file
+        self.header, self.data_offset = readHeader(in_file)
+
+        datatype = self.header.get('datatype', 'Float32LE')
+        if datatype not in TCK_DTYPES:
+            raise IOError("Unsupported tck datatype: %s" % datatype)
+        self.dtype = np.dtype(TCK_DTYPES[datatype])
+
+        nrows = (op.getsize(in_file) - self.data_offset) // \
+            (3 * self.dtype.itemsize)
+        if nrows > 0:
+            self._data = np.memmap(in_file, dtype=self.dtype, mode='r',
+                                   offset=self.data_offset, shape=(nrows, 3))
+        else:
+            self._data = np.zeros((0, 3), dtype=self.dtype)
+
+        self._starts = starts
+        self._ends = ends
+        self._nrows = None
+
+    def _scan(self):
+        """ Locate streamline delimiters and the end of data marker """
+        delims = []
+        nrows = self._data.shape[0]
+        for start in range(0, nrows, SCAN_BLOCK):
+            col = self._data[start:start + SCAN_BLOCK, 0]
+            inf = np.flatnonzero(np.isinf(col))
+            if inf.size:
+                col = col[:inf[0]]
+                nrows = start + inf[0]
+            delims.append(np.flatnonzero(np.isnan(col)) + start)
+            if inf.size:
+                break
+
+        ends = np.concatenate(delims) if delims else np.zeros(0, np.int64)
+        ends = ends.astype(np.int64)
+        starts = np.empty_like(ends)
+        if ends.size:
+            starts[0] = 0
+            starts[1:] = ends[:-1] + 1
+
+        self._starts, self._ends, self._nrows = starts, ends, nrows
+
+    @property
+    def starts(self):
+        if self._starts is None:
+            self._scan()
+        return self._starts
+
+    @property
+    def ends(self):
+        if self._ends is None:
+            self._scan()
+        return self._ends
+
+    @property
+    def lengths(self):
+        return self.ends - self.starts
+
+    @property
+    def points(self):
+        """ Raw vertex stream, including NaN delimiters """
+        return self._data
+
+    def __len__(self):
+        return self.starts.size
+
+    def __getitem__(self, idx):
+        return self._data[self.starts[idx]:self.ends[idx]]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def iterChunks(self, chunk_size=10000):
+        """
+        Yield (first streamline index, block, lengths) for runs of at most
+        chunk_size streamlines. block is a view of the raw vertex stream
+        covering the run, delimiters included. When starts and ends select
+        streamlines that are not consecutive in the file, block is instead a
+        copy of the selected streamlines, separated by NaN delimiters
+        """
+        starts, ends = self.starts, self.ends
+        for first in range(0, starts.size, chunk_size):
+            last = min(first + chunk_size, starts.size)
+            lengths = ends[first:last] - starts[first:last]
+            if np.all(starts[first + 1:last] == ends[first:last - 1] + 1):
+                block = self._data[starts[first]:ends[last - 1]]
+            else:
+                # Rows of each streamline and the delimiter following it
+                rows = lengths + 1
+                offsets = np.cumsum(rows) - rows
+                idx = np.arange(rows.sum()) + \
+                    np.repeat(starts[first:last] - offsets, rows)
+                block = self._data[idx[:-1]]
+            yield first, block, lengths
+
+
+def writeHeader(f, header):
+    """
+    Write the text header of a .tck file to the open binary file f, with
+    the data stored directly after it. Returns the byte offset of the data
+    """
+    lines = ['mrtrix tracks']
+    for key, value in header.items():
+        if key in ('file', 'END'):
+            continue
+        for item in str(value).split('\n'):
+            lines.append("%s: %s" % (key, item))
+
+    # The offset is part of the header it points past. Values are kept
+    # out of the format string, as they may hold '%' (e.g. command_history)
+    head = "\n".join(lines) + "\n"
+    tail = "file: . %d\nEND\n"
+    offset = len(head) + len(tail % 0)
+    while len(head) + len(tail % offset) != offset:
+        offset = len(head) + len(tail % offset)
+    f.write((head + tail % offset).encode('latin-1'))
+
+    return offset
+
+
+def mergeTck(in_files, out_file):
+    """
+    Concatenate the streamlines of in_files, in order, into out_file. The
+    header of the first file is kept, with count and total_count summed over
+    all inputs. Vertices are streamed block by block
+    """
+    tcks = [TckFile(in_file) for in_file in in_files]
+
+    header = dict(tcks[0].header)
+    header['count'] = str(sum(len(tck) for tck in tcks))
+    if all('total_count' in tck.header for tck in tcks):
+        header['total_count'] = str(sum(int(tck.header['total_count'])
+                                        for tck in tcks))
+    header.pop('timestamp', None)
+    dtype = tcks[0].dtype
+
+    with open(out_file, 'wb') as f:
+        writeHeader(f, header)
+        for tck in tcks:
+            if not len(tck):
+                continue
+            # Every streamline, each followed by its delimiter
+            nrows = tck.ends[-1] + 1
+            for start in range(0, nrows, SCAN_BLOCK):
+                block = tck.points[start:min(start + SCAN_BLOCK, nrows)]
+                f.write(np.ascontiguousarray(block, dtype=dtype).tobytes())
+        f.write(np.full((1, 3), np.inf, dtype=dtype).tobytes())
+
+    return out_file
+
+
+def subsetTck(in_file, out_file, starts, ends, chunk_size=10000):
+    """
+    Write the streamlines of in_file spanning points[starts[i]:ends[i]]
+    (e.g. a selection from a streamline index) to out_file, in order. Only
+    the selected streamlines are read
+    """
+    tck = TckFile(in_file, starts=np.asarray(starts, dtype=np.int64),
+                  ends=np.asarray(ends, dtype=np.int64))
+
+    header = dict(tck.header)
+    header['count'] = str(len(tck))
+    header.pop('timestamp', None)
+    delim = np.full((1, 3), np.nan, dtype=tck.dtype)
+
+    with open(out_file, 'wb') as f:
+        writeHeader(f, header)
+        for _, block, _ in tck.iterChunks(chunk_size):
+            f.write(np.ascontiguousarray(block, dtype=tck.dtype).tobytes())
+            f.write(delim.tobytes())
+        f.write(np.full((1, 3), np.inf, dtype=tck.dtype).tobytes())
+
+    return out_file
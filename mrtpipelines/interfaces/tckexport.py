@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Streaming export of .tck tractograms
+
+Streamlines are read block by block from the memory-mapped tractogram and
+written to legacy binary VTK polydata or TrackVis .trk, so the tractogram is
+never held in memory. VTK points are kept in scanner coordinates, as
+tckconvert writes them; .trk points are stored in TrackVis voxmm coordinates
+of a reference image
+"""
+import numpy as np
+
+EXPORT_FORMATS = ('vtk', 'trk')
+
+
+def writeVtk(in_file, out_file, chunk_size=10000):
+    """ Write the streamlines of in_file as legacy binary VTK polydata """
+    from mrtpipelines.interfaces.tck import TckFile
+
+    tck = TckFile(in_file)
+    lengths = tck.lengths
+    npoints = int(lengths.sum())
+
+    with open(out_file, 'wb') as f:
+        f.write(("# vtk DataFile Version 3.0\n"
+                 "mrtpipelines tractography\n"
+                 "BINARY\n"
+                 "DATASET POLYDATA\n"
+                 "POINTS %d float\n" % npoints).encode('ascii'))
+        for _, block, _ in tck.iterChunks(chunk_size):
+            keep = ~np.isnan(block[:, 0])
+            f.write(np.ascontiguousarray(block[keep], dtype='>f4').tobytes())
+
+        # Each line is its number of points followed by their indices
+        f.write(("\nLINES %d %d\n" % (len(tck), len(tck) + npoints))
+                .encode('ascii'))
+        first_point = 0
+        for first in range(0, lengths.size, chunk_size):
+            counts = lengths[first:first + chunk_size]
+            cells = np.arange(counts.sum() + counts.size, dtype=np.int64)
+            heads = np.cumsum(counts + 1) - (counts + 1)
+            cells -= np.repeat(np.arange(counts.size) + 1, counts + 1)
+            cells += first_point
+            cells[heads] = counts
+            f.write(cells.astype('>i4').tobytes())
+            first_point += int(counts.sum())
+        f.write(b"\n")
+
+    return out_file
+
+
+def trkHeader(ref_image, nstreamlines):
+    """ TrackVis header (nibabel layout) for the grid of ref_image """
+    import nibabel as nib
+    from nibabel.streamlines.trk import header_2_dtype
+
+    from mrtpipelines.interfaces.tckindex import imageGrid
+
+    dim, affine = imageGrid(ref_image)
+    affine = np.asarray(affine, dtype=np.float64)
+    vox = np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+
+    header = np.zeros((), dtype=header_2_dtype)
+    header['magic_number'] = b'TRACK'
+    header['dimensions'] = dim
+    header['voxel_sizes'] = vox
+    header['voxel_to_rasmm'] = affine
+    header['voxel_order'] = ''.join(nib.aff2axcodes(affine)).encode('ascii')
+    header['nb_streamlines'] = nstreamlines
+    header['version'] = 2
+    header['hdr_size'] = header_2_dtype.itemsize
+
+    return header, affine, vox
+
+
+def writeTrk(in_file, out_file, ref_image, chunk_size=10000):
+    """
+    Write the streamlines of in_file as TrackVis .trk, in the voxel space of
+    ref_image
+    """
+    from mrtpipelines.interfaces.tck import TckFile
+
+    tck = TckFile(in_file)
+    header, affine, vox = trkHeader(ref_image, len(tck))
+    inv = np.linalg.inv(affine)
+
+    with open(out_file, 'wb') as f:
+        f.write(header.tobytes())
+        for _, block, lengths in tck.iterChunks(chunk_size):
+            keep = ~np.isnan(block[:, 0])
+            points = np.asarray(block[keep], dtype=np.float64)
+            # Scanner -> voxel (centre at 0) -> voxmm (corner at 0)
+            voxmm = (points.dot(inv[:3, :3].T) + inv[:3, 3] + 0.5) * vox
+
+            # Each streamline is its number of points, then the points
+            size = 1 + 3 * lengths
+            heads = np.cumsum(size) - size
+            out = np.empty(size.sum(), dtype='<f4')
+            body = np.ones(out.size, dtype=bool)
+            body[heads] = False
+            out[body] = voxmm.ravel()
+            out.view('<i4')[heads] = lengths
+            f.write(out.tobytes())
+
+    return out_file
+
+
+def exportTck(in_file, out_base, formats=('vtk',), ref_image=None,
+              chunk_size=10000):
+    """
+    Export in_file to each of formats (see EXPORT_FORMATS) as
+    out_base.<format>. Returns a dict of format to output file
+    """
+    out_files = {}
+    for fmt in formats:
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError("Unknown tractography format: %s" % fmt)
+        out_file = "%s.%s" % (out_base, fmt)
+        if fmt == 'vtk':
+            writeVtk(in_file, out_file, chunk_size)
+        else:
+            if ref_image is None:
+                raise ValueError("A reference image is needed for .trk")
+            writeTrk(in_file, out_file, ref_image, chunk_size)
+        out_files[fmt] = out_file
+
+    return out_files
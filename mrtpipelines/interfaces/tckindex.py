@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Voxel to streamline index of a .tck file
+
+The index maps every voxel of a reference grid to the (sorted) ids of the
+streamlines with a vertex in it, in compressed sparse row layout: the ids of
+voxel v are indices[indptr[v]:indptr[v + 1]]. It is saved next to the
+tractogram as an uncompressed npz archive that also holds the start and end
+of every streamline in the vertex stream, so selected streamlines are read
+straight from the tractogram without scanning it. Arrays are memory-mapped
+from the archive when querying, so only the rows of the queried voxels are
+read
+"""
+import os.path as op
+
+import numpy as np
+
+# Streamline ids are stored as uint32
+MAX_STREAMLINES = np.iinfo(np.uint32).max
+
+
+def indexFile(tract):
+    """ Path of the index of a tractogram (<...>_tractography.tck) """
+    base = tract[:-len('.tck')] if tract.endswith('.tck') else tract
+    if base.endswith('_tractography'):
+        base = base[:-len('_tractography')] + '_tractindex'
+    else:
+        base = base + '_tractindex'
+
+    return base + '.npz'
+
+
+def imageGrid(in_file):
+    """ Dimensions and voxel to scanner affine of an image (header only) """
+    if in_file.endswith(('.mif', '.mif.gz', '.mih')):
+        from mrtpipelines.interfaces import mif
+
+        header = mif.readHeader(in_file)
+        return tuple(header['dim'][:3]), header['transform']
+
+    import nibabel as nib
+
+    img = nib.load(in_file)
+    return tuple(img.shape[:3]), img.affine
+
+
+def _voxels(points, dim, affine):
+    """ Linear index of the voxels of scanner space points, -1 outside """
+    inv = np.linalg.inv(affine)
+    vox = np.asarray(points, dtype=np.float64).dot(inv[:3, :3].T) + \
+        inv[:3, 3]
+    with np.errstate(invalid='ignore'):
+        vox = np.floor(vox + 0.5)
+        inside = np.all((vox >= 0) & (vox < np.array(dim)), axis=1)
+
+    linear = np.full(vox.shape[0], -1, dtype=np.int64)
+    linear[inside] = np.ravel_multi_index(vox[inside].astype(np.int64).T,
+                                          dim)
+
+    return linear
+
+
+def buildIndex(in_file, ref_image, out_file, chunk_size=10000):
+    """
+    Index the streamlines of in_file on the voxel grid of ref_image into
+    out_file. Pairs of (voxel, streamline) are spooled to disk block by
+    block, counted, then scattered into place, so memory use depends on the
+    block size and the number of voxels only
+    """
+    import os
+    import zipfile
+
+    from mrtpipelines.interfaces.tck import TckFile
+    from mrtpipelines.interfaces.tractography import _writeNpyMember
+
+    dim, affine = imageGrid(ref_image)
+    nvox = int(np.prod(dim))
+    tck = TckFile(in_file)
+    if len(tck) > MAX_STREAMLINES:
+        raise ValueError("Too many streamlines to index: %d" % len(tck))
+
+    spool = op.join(op.dirname(op.abspath(out_file)),
+                    ".%s.%%s.raw" % op.basename(out_file))
+
+    # First pass: unique (voxel, streamline) pairs of each block, in
+    # streamline order, and the number of streamlines per voxel
+    counts = np.zeros(nvox, dtype=np.int64)
+    blocks = []
+    with open(spool % 'voxels', 'wb') as vf, open(spool % 'ids', 'wb') as sf:
+        for first, block, lengths in tck.iterChunks(chunk_size):
+            keep = ~np.isnan(block[:, 0])
+            ids = np.repeat(np.arange(first, first + lengths.size,
+                                      dtype=np.int64), lengths)
+            voxels = _voxels(block[keep], dim, affine)
+            inside = voxels >= 0
+
+            pairs = np.unique(ids[inside] * nvox + voxels[inside])
+            ids, voxels = np.divmod(pairs, nvox)
+            counts += np.bincount(voxels, minlength=nvox)
+            voxels.tofile(vf)
+            ids.astype(np.uint32).tofile(sf)
+            blocks.append(pairs.size)
+
+    indptr = np.zeros(nvox + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+
+    # Second pass: scatter the streamline ids of each voxel into place.
+    # Blocks are in streamline order, so the ids of a voxel stay sorted
+    cursor = indptr[:-1].copy()
+    total = int(indptr[-1])
+    indices = np.memmap(spool % 'indices', dtype=np.uint32, mode='w+',
+                        shape=(max(total, 1),))
+    with open(spool % 'voxels', 'rb') as vf, open(spool % 'ids', 'rb') as sf:
+        for size in blocks:
+            voxels = np.fromfile(vf, dtype=np.int64, count=size)
+            ids = np.fromfile(sf, dtype=np.uint32, count=size)
+            order = np.argsort(voxels, kind='stable')
+            voxels, ids = voxels[order], ids[order]
+
+            uniq, first, nper = np.unique(voxels, return_index=True,
+                                          return_counts=True)
+            rank = np.arange(size) - np.repeat(first, nper)
+            indices[cursor[voxels] + rank] = ids
+            cursor[uniq] += nper
+    indices.flush()
+    del indices
+
+    arrays = {'dim': np.array(dim, dtype=np.int64),
+              'affine': np.asarray(affine, dtype=np.float64),
+              'indptr': indptr,
+              'starts': tck.starts,
+              'ends': tck.ends}
+    with zipfile.ZipFile(out_file, 'w',
+                         compression=zipfile.ZIP_STORED) as zf:
+        for name, array in arrays.items():
+            with zf.open(name + '.npy', 'w', force_zip64=True) as member:
+                np.lib.format.write_array(member, np.ascontiguousarray(array))
+        if total:
+            _writeNpyMember(zf, 'indices', spool % 'indices', np.uint32,
+                            total)
+        else:
+            with zf.open('indices.npy', 'w') as member:
+                np.lib.format.write_array(member, np.zeros(0, np.uint32))
+
+    for name in ('voxels', 'ids', 'indices'):
+        os.remove(spool % name)
+
+    return out_file
+
+
+def _memmapMember(in_file, zf, name):
+    """ Memory map an array stored (uncompressed) in an npz archive """
+    import struct
+    import zipfile
+
+    info = zf.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return np.load(zf.open(name + '.npy'))
+
+    with open(in_file, 'rb') as f:
+        # Local file header: fixed part, then file name and extra field
+        f.seek(info.header_offset)
+        local = f.read(30)
+        name_len, extra_len = struct.unpack('<HH', local[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    if not int(np.prod(shape)):
+        return np.zeros(shape, dtype=dtype)
+
+    return np.memmap(in_file, dtype=dtype, mode='r', offset=offset,
+                     shape=shape, order='F' if fortran else 'C')
+
+
+class TckIndex(object):
+    """ Streamline index saved by buildIndex """
+
+    def __init__(self, in_file):
+        import zipfile
+
+        self.in_file = in_file
+        with zipfile.ZipFile(in_file) as zf:
+            self.dim = tuple(int(d) for d in np.load(zf.open('dim.npy')))
+            self.affine = np.load(zf.open('affine.npy'))
+            self.indptr = _memmapMember(in_file, zf, 'indptr')
+            self.indices = _memmapMember(in_file, zf, 'indices')
+            self.starts = _memmapMember(in_file, zf, 'starts')
+            self.ends = _memmapMember(in_file, zf, 'ends')
+
+    def __len__(self):
+        return self.starts.shape[0]
+
+    def streamlines(self, voxels):
+        """ Sorted ids of the streamlines visiting any of voxels (linear) """
+        voxels = np.unique(np.asarray(voxels, dtype=np.int64))
+        lo, hi = self.indptr[voxels], self.indptr[voxels + 1]
+        ids = [self.indices[a:b] for a, b in zip(lo, hi) if b > a]
+        if not ids:
+            return np.zeros(0, dtype=np.int64)
+
+        return np.unique(np.concatenate(ids)).astype(np.int64)
+
+    def roiVoxels(self, roi_file):
+        """
+        Voxels of the index grid covered by the non-zero voxels of roi: those
+        holding the centre of an ROI voxel (for ROIs finer than the index)
+        and those whose centre falls in an ROI voxel (for coarser ROIs)
+        """
+        from mrtpipelines.interfaces.sampling import loadImage
+
+        data, affine = loadImage(roi_file)
+        roi = np.nan_to_num(data) != 0
+        ijk = np.argwhere(roi)
+        if not ijk.size:
+            return np.zeros(0, dtype=np.int64)
+        affine = np.asarray(affine, dtype=np.float64)
+        points = ijk.dot(affine[:3, :3].T) + affine[:3, 3]
+        voxels = _voxels(points, self.dim, self.affine)
+        found = [voxels[voxels >= 0]]
+
+        # Index voxels within the bounds of the ROI, resampled (nearest
+        # neighbour) onto the ROI grid one plane at a time
+        corners = np.array([[x, y, z] for x in (ijk[:, 0].min() - .5,
+                                                ijk[:, 0].max() + .5)
+                            for y in (ijk[:, 1].min() - .5,
+                                      ijk[:, 1].max() + .5)
+                            for z in (ijk[:, 2].min() - .5,
+                                      ijk[:, 2].max() + .5)])
+        to_index = np.linalg.inv(self.affine).dot(affine)
+        corners = corners.dot(to_index[:3, :3].T) + to_index[:3, 3]
+        lo = np.clip(np.floor(corners.min(axis=0)).astype(np.int64), 0,
+                     self.dim)
+        hi = np.clip(np.ceil(corners.max(axis=0)).astype(np.int64) + 1, 0,
+                     self.dim)
+        for z in range(lo[2], hi[2]):
+            grid = np.stack(np.meshgrid(np.arange(lo[0], hi[0]),
+                                        np.arange(lo[1], hi[1]), [z],
+                                        indexing='ij'), axis=-1)
+            grid = grid.reshape(-1, 3)
+            points = grid.dot(self.affine[:3, :3].T) + self.affine[:3, 3]
+            inroi = _voxels(points, roi.shape, affine)
+            covered = inroi >= 0
+            covered[covered] = roi.ravel()[inroi[covered]]
+            found.append(np.ravel_multi_index(grid[covered].T, self.dim))
+
+        return np.unique(np.concatenate(found))
+
+    def select(self, include=(), exclude=()):
+        """
+        Sorted ids of the streamlines visiting every include ROI and none of
+        the exclude ROIs (image files). Without include ROIs, every
+        streamline not excluded is selected
+        """
+        if include:
+            selected = None
+            for roi in include:
+                ids = self.streamlines(self.roiVoxels(roi))
+                selected = ids if selected is None else \
+                    np.intersect1d(selected, ids, assume_unique=True)
+        else:
+            selected = np.arange(len(self), dtype=np.int64)
+
+        for roi in exclude:
+            ids = self.streamlines(self.roiVoxels(roi))
+            selected = np.setdiff1d(selected, ids, assume_unique=True)
+
+        return selected
+
+
+def selectTck(in_file, out_file, include=(), exclude=(), index_file=None,
+              chunk_size=10000):
+    """
+    Write the streamlines of in_file selected by the include / exclude ROIs
+    (see TckIndex.select) to out_file, using the index saved next to
+    in_file (or index_file). Returns out_file and the selected ids
+    """
+    from mrtpipelines.interfaces.tck import TckFile, subsetTck
+
+    index = TckIndex(index_file or indexFile(in_file))
+
+    # An index of another tractogram (e.g. one regenerated since) would
+    # select the wrong vertices: the streamline count and the end of the
+    # last streamline (followed by its delimiter and the end marker) must
+    # match the file
+    tck = TckFile(in_file, starts=index.starts, ends=index.ends)
+    count = tck.header.get('count')
+    end = int(index.ends[-1]) + 1 if len(index) else 0
+    if (count is not None and int(count) != len(index)) or \
+       tck.points.shape[0] <= end or \
+       not np.isinf(tck.points[end, 0]) or \
+       (end and not np.isnan(tck.points[end - 1, 0])):
+        raise ValueError("Index %s does not match %s" %
+                         (index.in_file, in_file))
+
+    ids = index.select(include, exclude)
+    subsetTck(in_file, out_file, index.starts[ids], index.ends[ids],
+              chunk_size=chunk_size)
+
+    return out_file, ids
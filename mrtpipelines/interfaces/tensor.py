@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+In-process diffusion tensor fitting
+
+Mirrors MRtrix3 dwi2tensor and tensor2metric: tensors are fit to the log
+signal by weighted least squares, weighted by the measured signal, followed
+by iterated reweightings by the predicted signal, and stored in MRtrix order (D11, D22, D33, D12, D13,
+D23). The tensor and FA / MD / AD / RD maps are written in a single pass.
+Masked voxels are streamed from the memory-mapped DWI in chunks, with slabs
+of the volume shared among a pool of processes, so peak memory depends on
+the chunk size rather than the image size
+"""
+import numpy as np
+
+from mrtpipelines.interfaces import resources
+
+# Signal floor before taking the log, relative to the largest signal of the
+# voxel as dwi2tensor, and absolute for empty voxels
+MIN_SIGNAL_FRACTION = 1e-6
+MIN_SIGNAL = 1e-10
+
+
+def bMatrix(dw_scheme):
+    """
+    Design matrix of the log-linear tensor model for an N x 4 gradient table
+    (x, y, z, b). Directions are normalised and b-values scaled by the
+    squared norm of their direction, as MRtrix does by default
+    """
+    grad = np.array(dw_scheme, dtype=np.float64)
+    norm = np.linalg.norm(grad[:, :3], axis=1)
+    nonzero = norm > 0
+    grad[nonzero, :3] /= norm[nonzero, None]
+    grad[nonzero, 3] *= norm[nonzero] ** 2
+
+    g, b = grad[:, :3], grad[:, 3]
+    return np.column_stack([-b * g[:, 0] ** 2,
+                            -b * g[:, 1] ** 2,
+                            -b * g[:, 2] ** 2,
+                            -2 * b * g[:, 0] * g[:, 1],
+                            -2 * b * g[:, 0] * g[:, 2],
+                            -2 * b * g[:, 1] * g[:, 2],
+                            np.ones(b.size)])
+
+
+def fitWLS(signal, bmat, iterations=2):
+    """
+    Fit tensors to signal (voxels x volumes) as dwi2tensor -iter iterations.
+    Returns the voxels x 7 model parameters (6 tensor elements and log S0)
+    """
+    signal = np.asarray(signal, dtype=np.float64)
+    floor = np.maximum(MIN_SIGNAL_FRACTION *
+                       signal.max(axis=1, keepdims=True), MIN_SIGNAL)
+    signal = np.maximum(signal, floor)
+    logs = np.log(signal)
+
+    # Weighted by the squared measured signal first, then by the squared
+    # predicted signal of the previous fit. As dwi2tensor, the weights are
+    # only updated for more than one iteration
+    w2 = signal ** 2
+    for _ in range(iterations + 1):
+        lhs = np.einsum('vn,ni,nj->vij', w2, bmat, bmat)
+        rhs = np.einsum('vn,ni,vn->vi', w2, bmat, logs)
+        try:
+            params = np.linalg.solve(lhs, rhs[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            params = np.einsum('vij,vj->vi', np.linalg.pinv(lhs), rhs)
+        if iterations > 1:
+            w2 = np.exp(2 * params.dot(bmat.T))
+
+    return params
+
+
+def tensorMetrics(tensor):
+    """
+    FA, MD, AD and RD of tensors (voxels x 6, MRtrix order)
+    """
+    d = np.asarray(tensor, dtype=np.float64)
+    mats = np.empty((d.shape[0], 3, 3))
+    mats[:, 0, 0], mats[:, 1, 1], mats[:, 2, 2] = d[:, 0], d[:, 1], d[:, 2]
+    mats[:, 0, 1] = mats[:, 1, 0] = d[:, 3]
+    mats[:, 0, 2] = mats[:, 2, 0] = d[:, 4]
+    mats[:, 1, 2] = mats[:, 2, 1] = d[:, 5]
+
+    # Ascending eigenvalues
+    evals = np.linalg.eigvalsh(mats)
+    md = evals.mean(axis=1)
+    ad = evals[:, 2]
+    rd = evals[:, :2].mean(axis=1)
+
+    norm = (evals ** 2).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fa = np.sqrt(1.5 * ((evals - md[:, None]) ** 2).sum(axis=1) / norm)
+    fa[norm == 0] = 0.
+
+    return fa, md, ad, rd
+
+
+def _fitSlab(task):
+    """ Fit the masked voxels of the z-planes [z0, z1) (run in a worker) """
+    from mrtpipelines.interfaces import mif
+    from mrtpipelines.interfaces.tensor import (bMatrix, fitWLS,
+                                                tensorMetrics)
+
+    (in_file, mask_file, out_files, z0, z1, iterations, chunk_size) = task
+
+    dwi, header = mif.load(in_file)
+    offset, scale = header['scaling']
+    bmat = bMatrix(header['dw_scheme'])
+    mask = mif.load(mask_file)[0] if mask_file else None
+    outs = [mif.load(out_file, mode='r+')[0] for out_file in out_files]
+
+    fitted = 0
+    for z in range(z0, z1):
+        if mask is not None:
+            ix, iy = np.nonzero(np.squeeze(mask[:, :, z]))
+        else:
+            ix, iy = np.nonzero(np.ones(dwi.shape[:2], dtype=bool))
+
+        for first in range(0, ix.size, chunk_size):
+            cx, cy = ix[first:first + chunk_size], iy[first:first + chunk_size]
+            signal = np.asarray(dwi[cx, cy, z, :], dtype=np.float64)
+            signal = signal * scale + offset
+
+            params = fitWLS(signal, bmat, iterations)
+            tensor = params[:, :6]
+            values = (tensor,) + tensorMetrics(tensor)
+            for out, value in zip(outs, values):
+                out[cx, cy, z] = value
+            fitted += cx.size
+
+    for out in outs:
+        out.flush()
+
+    return fitted
+
+
+def fitImage(in_file, out_files, mask_file=None, iterations=2,
+             chunk_size=10000, nprocs=1):
+    """
+    Fit tensors to the DWI in_file (MRtrix format, with an embedded
+    gradient table) within mask_file, writing the tensor, FA, MD, AD and RD
+    images (out_files, in that order, as .mif). Returns the number of voxels
+    fitted
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    from mrtpipelines.interfaces import mif
+
+    header = mif.readHeader(in_file)
+    if header['dw_scheme'] is None:
+        raise IOError("%s has no diffusion gradient table" % in_file)
+
+    dim = header['dim'][:3]
+    affine = header['transform']
+    mif.create(out_files[0], dim + [6], np.float32, affine,
+               keys={'comments': 'DTI tensor (D11,D22,D33,D12,D13,D23)'})
+    for out_file in out_files[1:]:
+        mif.create(out_file, dim, np.float32, affine)
+
+    # Slabs of z-planes, several per process to balance masked voxels
+    nslabs = min(dim[2], max(1, nprocs * 4))
+    bounds = np.linspace(0, dim[2], nslabs + 1).astype(int)
+    tasks = [(in_file, mask_file, out_files, z0, z1, iterations, chunk_size)
+             for z0, z1 in zip(bounds[:-1], bounds[1:]) if z1 > z0]
+
+    if nprocs > 1:
+        with ProcessPoolExecutor(max_workers=nprocs) as pool:
+            return sum(pool.map(_fitSlab, tasks))
+
+    return sum(_fitSlab(task) for task in tasks)
+
+
+def _tensorFit(in_file, in_mask=None, out_file='tensor.mif',
+               out_fa='fa.mif', out_adc='md.mif', out_ad='ad.mif',
+               out_rd='rd.mif', iterations=2, chunk_size=10000, nthreads=1):
+    import os.path as op
+
+    from mrtpipelines.interfaces.tensor import fitImage
+
+    out_files = [op.abspath(f) for f in (out_file, out_fa, out_adc, out_ad,
+                                         out_rd)]
+    fitImage(in_file, out_files, mask_file=in_mask, iterations=iterations,
+             chunk_size=chunk_size, nprocs=nthreads)
+
+    return tuple(out_files)
+
+
+def tensorFit(wdir=None, nthreads=1, iterations=2, chunk_size=10000,
+              name='FitTensor'):
+    """
+    Python alternative to FitTensor followed by TensorMetrics, with the
+    outputs of both (out_file, out_fa, out_adc, out_ad, out_rd)
+    """
+    from nipype.pipeline import engine as pe
+    from nipype.interfaces import utility as niu
+
+    tensorFit = pe.Node(niu.Function(function=_tensorFit,
+                                     input_names=['in_file',
+                                                  'in_mask',
+                                                  'out_file',
+                                                  'out_fa',
+                                                  'out_adc',
+                                                  'out_ad',
+                                                  'out_rd',
+                                                  'iterations',
+                                                  'chunk_size',
+                                                  'nthreads'],
+                                     output_names=['out_file',
+                                                   'out_fa',
+                                                   'out_adc',
+                                                   'out_ad',
+                                                   'out_rd']),
+                                     name=name)
+    tensorFit.base_dir = wdir
+    tensorFit.inputs.iterations = iterations
+    tensorFit.inputs.chunk_size = chunk_size
+    resources.setProfile(tensorFit, nthreads, profile='FitTensor')
+
+    return tensorFit
@@ -2,47 +2,372 @@ from nipype.pipeline import engine as pe
 from nipype.interfaces import mrtrix3 as mrt
 from nipype.interfaces import utility as niu
 
-def tckSample(wdir=None, nthreads=1):
-    tckSample = pe.Node(mrt.TCKSample(), name='tckSample')
+from mrtpipelines.interfaces import cache, resources
+
+def tckSample(wdir=None, nthreads=1, multi=False, cache_dir=None,
+              cache_gb=100):
+    interface = cache.cachedInterface(mrt.TCKSample, cache_dir, cache_gb)
+    if multi is True:  # One tcksample run per image
+        tckSample = pe.MapNode(interface, iterfield=['in_image'],
+                               name='tckSample')
+    else:
+        tckSample = pe.Node(interface, name='tckSample')
     tckSample.base_dir = wdir
     tckSample.inputs.out_file = "scalar.txt"
-    tckSample.inputs.nthreads = nthreads
-    tckSample.interface.num_threads = nthreads
+    resources.setProfile(tckSample, nthreads)
 
     return tckSample
 
-def _writeScalar(in_file, wdir):
+
+class ScalarWriter(object):
+    """
+    Streams sampled scalar values to disk chunk by chunk
+
+    out_format 'txt' writes one value per line. out_format 'npz' writes an
+    uncompressed archive holding float32 'values' and int64 'offsets', where
+    streamline i spans values[offsets[i]:offsets[i + 1]]
+
+    When names are given, several scalars are written side by side: text
+    output gains one column per name (listed in a '#' header line) and the
+    archive holds one float32 array per name in place of 'values'
+    """
+
+    def __init__(self, out_base, out_format='txt', names=None):
+        import os.path as op
+
+        import numpy as np
+
+        if out_format not in ('txt', 'npz'):
+            raise ValueError("Unknown output format: %s" % out_format)
+
+        self.out_format = out_format
+        self.out_file = "%s.%s" % (out_base, out_format)
+        self.names = list(names) if names else None
+        self.npoints = 0
+        self.nstreamlines = 0
+
+        if out_format == 'txt':
+            self._out = open(self.out_file, "w")
+            if self.names:
+                self._out.write("# %s\n" % " ".join(self.names))
+        else:
+            # Values and offsets are spooled to raw files as they arrive and
+            # only packed into the archive once their final length is known
+            spool = op.join(op.dirname(self.out_file),
+                            ".%s.%%s.raw" % op.basename(out_base))
+            self._raw = [(name, spool % name)
+                         for name in (self.names or ['values'])]
+            self._raw.append(('offsets', spool % 'offsets'))
+            self._spool = [open(raw, "wb") for _, raw in self._raw]
+            self._spool[-1].write(np.zeros(1, dtype=np.int64).tobytes())
+
+    def write(self, values, lengths):
+        """
+        Append a chunk of streamlines given as flat values (npoints, or
+        npoints x len(names)) and the number of points per streamline
+        """
+        import numpy as np
+
+        values = np.asarray(values, dtype=np.float32)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if self.names:
+            values = values.reshape(-1, len(self.names))
+
+        if self.out_format == 'txt':
+            if values.size:
+                np.savetxt(self._out, values, fmt='%.9g')
+        else:
+            columns = values.T if self.names else [values]
+            for spool, column in zip(self._spool, columns):
+                np.ascontiguousarray(column).tofile(spool)
+            offsets = self.npoints + np.cumsum(lengths)
+            offsets.tofile(self._spool[-1])
+
+        self.npoints += int(values.shape[0])
+        self.nstreamlines += int(lengths.size)
+
+    def write_text(self, tokens, lengths):
+        """
+        Append a chunk of already formatted values (text output only). With
+        names, tokens holds one list of tokens per column
+        """
+        if self.out_format != 'txt':
+            raise ValueError("write_text is only valid for text output")
+
+        if self.names:
+            tokens = [" ".join(row) for row in zip(*tokens)]
+        if tokens:
+            self._out.write("\n".join(tokens) + "\n")
+
+        self.npoints += len(tokens)
+        self.nstreamlines += len(lengths)
+
+    def close(self):
+        import os
+        import zipfile
+
+        import numpy as np
+
+        if self.out_format == 'txt':
+            self._out.close()
+            return self.out_file
+
+        for spool in self._spool:
+            spool.close()
+
+        with zipfile.ZipFile(self.out_file, "w",
+                             compression=zipfile.ZIP_STORED) as zf:
+            for name, raw in self._raw[:-1]:
+                _writeNpyMember(zf, name, raw, np.float32, self.npoints)
+            _writeNpyMember(zf, 'offsets', self._raw[-1][1], np.int64,
+                            self.nstreamlines + 1)
+
+        for _, raw in self._raw:
+            os.remove(raw)
+
+        return self.out_file
+
+
+def _writeNpyMember(zf, name, raw_file, dtype, count):
+    """
+    Copy a raw array file into an npz archive without loading it. count is
+    the length of a 1D array, or the shape of a C ordered array
+    """
+    import shutil
+
+    import numpy as np
+
+    header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+              'fortran_order': False,
+              'shape': tuple(count) if isinstance(count, tuple)
+              else (count,)}
+    with zf.open(name + '.npy', "w", force_zip64=True) as member:
+        np.lib.format.write_array_header_1_0(member, header)
+        with open(raw_file, "rb") as raw:
+            shutil.copyfileobj(raw, member, 16 * 1024 * 1024)
+
+
+def _readScalarChunks(in_file, chunk_size=10000):
+    """
+    Yield tcksample text output in blocks of at most chunk_size streamlines
+    as (lines, lengths), skipping header comments
+    """
+    from itertools import islice
+
+    import numpy as np
+
+    with open(in_file) as f:
+        data = (line for line in f if not line.startswith('#'))
+        while True:
+            lines = list(islice(data, chunk_size))
+            if not lines:
+                break
+
+            lengths = np.fromiter((len(line.split()) for line in lines),
+                                  dtype=np.int64, count=len(lines))
+
+            yield lines, lengths
+
+
+def _streamScalar(in_file, writer, chunk_size=10000):
+    """ Copy one tcksample output into writer, chunk_size streamlines at a time """
+    import numpy as np
+
+    for lines, lengths in _readScalarChunks(in_file, chunk_size):
+        block = "".join(lines)
+        if writer.out_format == 'txt':
+            writer.write_text(block.split(), lengths)
+        else:
+            values = np.array(block.split(), dtype=np.float32)
+            writer.write(values, lengths)
+
+    return writer.close()
+
+
+def _writeScalar(in_file, wdir, out_format='txt', chunk_size=10000,
+                 names=None, combine=False):
     import os.path as op
+    from itertools import zip_longest
 
-    with open(in_file) as file:
-        scalar_streamlines = [line.rstrip('\n') for line in file]
+    import numpy as np
 
-    # Read in data
-    scalar_data = []
-    for streamline in scalar_streamlines:
-        scalar_data.append(streamline.split())
+    from mrtpipelines.interfaces.tractography import (ScalarWriter,
+                                                      _readScalarChunks,
+                                                      _streamScalar)
 
-    del scalar_streamlines
+    # Single tcksample output
+    if not isinstance(in_file, list):
+        writer = ScalarWriter(op.join(wdir, "scalar"), out_format=out_format)
+        return _streamScalar(in_file, writer, chunk_size)
 
-    # Write values to file line-by-line
-    out_file = op.join(wdir, "scalar.txt")
-    f = open(out_file, "w+")
-    for streamline in scalar_data:
-        for data in streamline:
-            f.write(data + "\n")
-    f.close()
+    # One tcksample output per scalar
+    if combine is False:
+        return [_streamScalar(f, ScalarWriter(op.join(wdir, "scalar_%s" % name),
+                                              out_format=out_format),
+                              chunk_size)
+                for f, name in zip(in_file, names)]
 
-    del scalar_data
+    # Merge per scalar outputs column-wise, streamline block by block
+    writer = ScalarWriter(op.join(wdir, "scalar"), out_format=out_format,
+                          names=names)
+    readers = [_readScalarChunks(f, chunk_size) for f in in_file]
+    for chunks in zip_longest(*readers):
+        # Every output samples the same streamlines at the same vertices
+        short = [f for f, chunk in zip(in_file, chunks) if chunk is None]
+        if short:
+            raise IOError("%s holds fewer streamlines than the other "
+                          "scalar outputs" % ", ".join(short))
+        for f, chunk in zip(in_file[1:], chunks[1:]):
+            if not np.array_equal(chunk[1], chunks[0][1]):
+                raise IOError("%s does not match the streamline lengths of "
+                              "%s" % (f, in_file[0]))
+        lengths = chunks[0][1]
+        blocks = ["".join(lines) for lines, _ in chunks]
+        if out_format == 'txt':
+            writer.write_text([block.split() for block in blocks], lengths)
+        else:
+            values = np.column_stack([np.array(block.split(),
+                                               dtype=np.float32)
+                                      for block in blocks])
+            writer.write(values, lengths)
+    out_file = writer.close()
 
     return out_file
 
-def writeScalar(wdir=None):
+def writeScalar(wdir=None, out_format='txt', chunk_size=10000, names=None,
+                combine=False):
     writeScalar = pe.Node(niu.Function(function=_writeScalar,
                                        input_names=['in_file',
-                                                    'wdir'],
+                                                    'wdir',
+                                                    'out_format',
+                                                    'chunk_size',
+                                                    'names',
+                                                    'combine'],
                                        output_names=['out_file']),
                                        name="writeScalar")
     writeScalar.base_dir = wdir
     writeScalar.inputs.wdir = wdir
+    writeScalar.inputs.out_format = out_format
+    writeScalar.inputs.chunk_size = chunk_size
+    writeScalar.inputs.names = names
+    writeScalar.inputs.combine = combine
+    resources.setProfile(writeScalar)
 
     return writeScalar
+
+
+def _sampleTract(in_file, in_image, wdir, out_format='txt', chunk_size=10000,
+                 interp='linear', names=None, combine=False):
+    import os.path as op
+
+    from mrtpipelines.interfaces.sampling import sampleTck
+    from mrtpipelines.interfaces.tractography import ScalarWriter
+
+    # Sample directly from the memory-mapped tractogram
+    if not isinstance(in_image, list):
+        writers = ScalarWriter(op.join(wdir, "scalar"), out_format=out_format)
+    elif combine is True:
+        writers = ScalarWriter(op.join(wdir, "scalar"), out_format=out_format,
+                               names=names)
+    else:
+        writers = [ScalarWriter(op.join(wdir, "scalar_%s" % name),
+                                out_format=out_format) for name in names]
+
+    sampleTck(in_file, in_image, writers, chunk_size=chunk_size,
+              interp=interp)
+
+    if isinstance(writers, list):
+        out_file = [writer.close() for writer in writers]
+    else:
+        out_file = writers.close()
+
+    return out_file
+
+def sampleTract(wdir=None, out_format='txt', chunk_size=10000,
+                interp='linear', names=None, combine=False):
+    sampleTract = pe.Node(niu.Function(function=_sampleTract,
+                                       input_names=['in_file',
+                                                    'in_image',
+                                                    'wdir',
+                                                    'out_format',
+                                                    'chunk_size',
+                                                    'interp',
+                                                    'names',
+                                                    'combine'],
+                                       output_names=['out_file']),
+                                       name="sampleTract")
+    sampleTract.base_dir = wdir
+    sampleTract.inputs.wdir = wdir
+    sampleTract.inputs.out_format = out_format
+    sampleTract.inputs.chunk_size = chunk_size
+    sampleTract.inputs.interp = interp
+    sampleTract.inputs.names = names
+    sampleTract.inputs.combine = combine
+    resources.setProfile(sampleTract)
+
+    return sampleTract
+
+
+def _tractStats(in_file, in_scalar, wdir, names=None, npoints=20,
+                chunk_size=10000):
+    import os.path as op
+
+    from mrtpipelines.interfaces.tractstats import tractStats
+
+    return tractStats(in_file, in_scalar, op.join(wdir, "stats.npz"),
+                      names=names, npoints=npoints, chunk_size=chunk_size)
+
+def tractStats(wdir=None, names=None, npoints=20, chunk_size=10000):
+    tractStats = pe.Node(niu.Function(function=_tractStats,
+                                      input_names=['in_file',
+                                                   'in_scalar',
+                                                   'wdir',
+                                                   'names',
+                                                   'npoints',
+                                                   'chunk_size'],
+                                      output_names=['out_file']),
+                                      name="tractStats")
+    tractStats.base_dir = wdir
+    tractStats.inputs.wdir = wdir
+    tractStats.inputs.names = names
+    tractStats.inputs.npoints = npoints
+    tractStats.inputs.chunk_size = chunk_size
+    resources.setProfile(tractStats)
+
+    return tractStats
+
+
+def _selectTract(in_file, wdir, include=None, exclude=None,
+                 chunk_size=10000):
+    import os.path as op
+
+    from mrtpipelines.interfaces.tckindex import selectTck
+
+    out_file, _ = selectTck(in_file, op.join(wdir, "selected.tck"),
+                            include=include or [], exclude=exclude or [],
+                            chunk_size=chunk_size)
+
+    return out_file
+
+def selectTract(wdir=None, include=None, exclude=None, chunk_size=10000):
+    """
+    Extract the streamlines visiting every include ROI and no exclude ROI,
+    reading only those streamlines through the index saved next to the
+    tractogram
+    """
+    selectTract = pe.Node(niu.Function(function=_selectTract,
+                                       input_names=['in_file',
+                                                    'wdir',
+                                                    'include',
+                                                    'exclude',
+                                                    'chunk_size'],
+                                       output_names=['out_file']),
+                                       name="selectTract")
+    selectTract.base_dir = wdir
+    selectTract.inputs.wdir = wdir
+    selectTract.inputs.include = include
+    selectTract.inputs.exclude = exclude
+    selectTract.inputs.chunk_size = chunk_size
+    resources.setProfile(selectTract)
+
+    return selectTract
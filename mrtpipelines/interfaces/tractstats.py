@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Per-streamline summaries of sampled scalars
+
+Streamlines are processed in blocks of the memory-mapped tractogram, read in
+lockstep with the sampled values (text or npz output of tractScalar), so
+memory use depends on the block size only. For each streamline, the number
+of vertices, its length (mm) and, per scalar, the mean / median / min / max
+of the finite samples and an along-tract profile resampled to a fixed number
+of points equally spaced in arc length (in vertex order) are computed
+"""
+import numpy as np
+
+STATS = ('mean', 'median', 'min', 'max')
+
+
+class ScalarReader(object):
+    """
+    Sequential reader of scalar values written by tractography.ScalarWriter
+    (or tcksample text output), returning the next npoints values (npoints x
+    columns) on each read
+    """
+
+    def __init__(self, in_file):
+        self.in_file = in_file
+
+        if in_file.endswith('.npz'):
+            import zipfile
+
+            self._zf = zipfile.ZipFile(in_file)
+            members = [name[:-4] for name in self._zf.namelist()
+                       if name != 'offsets.npy']
+            self.names = None if members == ['values'] else members
+            self._members = [self._openMember(name) for name in members]
+        else:
+            self._zf = None
+            self._f = open(in_file)
+            self.names = None
+            # Column names of combined output precede the values, unlike
+            # the 'key: value' comments of tcksample
+            line = self._f.readline()
+            while line.startswith('#'):
+                names = line[1:].split()
+                if len(names) > 1 and ':' not in line:
+                    self.names = names
+                line = self._f.readline()
+            self._pending = np.array(line.split(), dtype=np.float32)
+
+    def _openMember(self, name):
+        member = self._zf.open(name + '.npy')
+        version = np.lib.format.read_magic(member)
+        if version == (1, 0):
+            _, _, dtype = np.lib.format.read_array_header_1_0(member)
+        else:
+            _, _, dtype = np.lib.format.read_array_header_2_0(member)
+
+        return member, dtype
+
+    def read(self, npoints):
+        from itertools import islice
+
+        ncols = len(self.names) if self.names else 1
+        if self._zf is not None:
+            columns = []
+            for member, dtype in self._members:
+                raw = member.read(npoints * dtype.itemsize)
+                columns.append(np.frombuffer(raw, dtype=dtype))
+            values = np.column_stack(columns)
+        else:
+            # Values are whitespace separated, however they are split into
+            # lines (one per vertex, or one per streamline as tcksample)
+            needed = npoints * ncols
+            blocks = [self._pending]
+            count = self._pending.size
+            while count < needed:
+                lines = list(islice(self._f, max(needed - count, 1024)))
+                if not lines:
+                    break
+                block = np.array("".join(lines).split(), dtype=np.float32)
+                blocks.append(block)
+                count += block.size
+            block = np.concatenate(blocks)
+            self._pending = block[needed:]
+            values = block[:needed].reshape(-1, ncols)
+
+        if values.shape[0] != npoints:
+            raise IOError("%s holds fewer values than the tractogram has "
+                          "vertices" % self.in_file)
+
+        return values.astype(np.float32)
+
+    def close(self):
+        if self._zf is not None:
+            for member, _ in self._members:
+                member.close()
+            self._zf.close()
+        else:
+            self._f.close()
+
+
+def segmentStats(values, lengths):
+    """
+    Mean, median, min and max of the finite values of each segment of the
+    flat values (segment i holds lengths[i] values), and the number of
+    finite values. Statistics of segments without finite values are NaN
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    nseg = lengths.size
+    seg = np.repeat(np.arange(nseg), lengths)
+    finite = np.isfinite(values)
+
+    count = np.bincount(seg[finite], minlength=nseg)
+    total = np.bincount(seg[finite], weights=values[finite], minlength=nseg)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+
+    vmin = np.full(nseg, np.nan)
+    vmax = np.full(nseg, np.nan)
+    np.fmin.at(vmin, seg, values)
+    np.fmax.at(vmax, seg, values)
+
+    # Sort within segments, non-finite values last
+    order = np.lexsort((np.where(finite, values, np.inf), ~finite, seg))
+    ranked = values[order]
+    first = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    has = count > 0
+    lo = first[has] + (count[has] - 1) // 2
+    hi = first[has] + count[has] // 2
+    median = np.full(nseg, np.nan)
+    median[has] = 0.5 * (ranked[lo] + ranked[hi])
+
+    return (mean, median, vmin, vmax), count
+
+
+def arcPositions(points, lengths):
+    """
+    Normalised arc length (0 to 1) of each vertex along its streamline and
+    the length (mm) of each streamline, for flat points (N x 3) split into
+    streamlines of lengths vertices
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    points = np.asarray(points, dtype=np.float64)
+    nseg = lengths.size
+    seg = np.repeat(np.arange(nseg), lengths)
+    first = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+
+    step = np.zeros(points.shape[0])
+    if points.shape[0] > 1:
+        step[1:] = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    step[first[lengths > 0]] = 0.
+
+    arc = np.cumsum(step)
+    arc -= np.repeat(arc[first[lengths > 0]], lengths[lengths > 0])
+    total = np.bincount(seg, weights=step, minlength=nseg)
+
+    # Fall back to vertex index for degenerate streamlines
+    span = np.repeat(total, lengths)
+    index = np.arange(points.shape[0]) - np.repeat(first, lengths)
+    count = np.repeat(np.maximum(lengths - 1, 1), lengths)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pos = np.where(span > 0, arc / span, index / count.astype(float))
+
+    return pos, total
+
+
+def resampleProfiles(values, pos, lengths, npoints):
+    """
+    Linearly interpolate the values of each streamline at npoints positions
+    equally spaced in normalised arc length (pos, see arcPositions).
+    Returns a streamlines x npoints array
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    nseg = lengths.size
+    if values.size == 0:
+        return np.full((nseg, npoints), np.nan)
+    first = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+
+    # Streamlines are separated on a single increasing axis
+    key = 2 * np.repeat(np.arange(nseg), lengths) + pos
+    target = 2 * np.arange(nseg)[:, None] + np.linspace(0, 1, npoints)
+    left = np.searchsorted(key, target.ravel(), side='right') - 1
+    left = left.reshape(nseg, npoints)
+
+    start = first[:, None]
+    last = (first + np.maximum(lengths, 1) - 1)[:, None]
+    left = np.clip(left, start, np.maximum(last - 1, start))
+    right = np.minimum(left + 1, last)
+    # Empty streamlines (masked below) may point past the last value
+    left = np.minimum(left, values.size - 1)
+    right = np.minimum(right, values.size - 1)
+
+    left_pos = pos[left] + 2 * np.arange(nseg)[:, None]
+    right_pos = pos[right] + 2 * np.arange(nseg)[:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.where(right_pos > left_pos,
+                        (target - left_pos) / (right_pos - left_pos), 0.)
+    frac = np.clip(frac, 0., 1.)
+    profiles = (1 - frac) * values[left] + frac * values[right]
+    profiles[lengths == 0] = np.nan
+
+    return profiles
+
+
+def tractStats(in_file, in_scalar, out_file, names=None, npoints=20,
+               chunk_size=10000):
+    """
+    Summarise the scalars sampled along the streamlines of in_file (a .tck)
+    into the npz archive out_file. in_scalar is one sampled output (with one
+    column per name when combined) or a list with one output per name
+
+    The archive holds int32 'npoints' and float32 'length' per streamline
+    and, for each scalar <name>, float32 '<name>_mean', '<name>_median',
+    '<name>_min', '<name>_max', int32 '<name>_count' (finite samples) and,
+    unless npoints is 0, '<name>_profile' (streamlines x npoints)
+    """
+    import os
+    import os.path as op
+    import zipfile
+
+    from mrtpipelines.interfaces.tck import TckFile
+    from mrtpipelines.interfaces.tractography import _writeNpyMember
+
+    files = in_scalar if isinstance(in_scalar, list) else [in_scalar]
+    readers = [ScalarReader(f) for f in files]
+    if names is None:
+        names = [name for reader in readers
+                 for name in (reader.names or ['values'])]
+    names = list(names)
+
+    # Columns are spooled to raw files, then packed into the archive
+    columns = [('npoints', np.int32, ()), ('length', np.float32, ())]
+    for name in names:
+        columns += [('%s_%s' % (name, stat), np.float32, ())
+                    for stat in STATS]
+        columns.append(('%s_count' % name, np.int32, ()))
+        if npoints:
+            columns.append(('%s_profile' % name, np.float32, (npoints,)))
+    spool = op.join(op.dirname(op.abspath(out_file)),
+                    ".%s.%%s.raw" % op.basename(out_file))
+    raws = [open(spool % column, 'wb') for column, _, _ in columns]
+
+    tck = TckFile(in_file)
+    for _, block, lengths in tck.iterChunks(chunk_size):
+        keep = ~np.isnan(block[:, 0])
+        points = block[keep]
+        values = np.column_stack([reader.read(points.shape[0])
+                                  for reader in readers])
+
+        pos, length = arcPositions(points, lengths)
+        out = [lengths, length]
+        for col in range(len(names)):
+            stats, count = segmentStats(values[:, col], lengths)
+            out += list(stats) + [count]
+            if npoints:
+                out.append(resampleProfiles(values[:, col], pos, lengths,
+                                            npoints))
+
+        for raw, (_, dtype, _), column in zip(raws, columns, out):
+            np.ascontiguousarray(column, dtype=dtype).tofile(raw)
+
+    for reader in readers:
+        reader.close()
+    for raw in raws:
+        raw.close()
+
+    with zipfile.ZipFile(out_file, 'w',
+                         compression=zipfile.ZIP_STORED) as zf:
+        for column, dtype, shape in columns:
+            _writeNpyMember(zf, column, spool % column, dtype,
+                            (len(tck),) + shape)
+    for column, _, _ in columns:
+        os.remove(spool % column)
+
+    return out_file
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Filesystem-backed work queue
+
+Tasks (one command each, e.g. genDhollanderTractography for a participant)
+are written to a queue directory on a filesystem shared by every node:
+
+    tasks/<id>.json     task, with its attempt count
+    claims/<id>.lock    held by the worker running the task, created with
+                        O_CREAT | O_EXCL so a single worker wins the claim;
+                        its modification time is the worker's heartbeat
+    claims/<id>.requeue held by the coordinator requeueing a stale claim
+    workers/<id>.json   last heartbeat of each worker
+    done/<id>.json      result of a task that succeeded
+    failed/<id>.json    result of a task that failed on its last attempt
+    logs/<id>.<n>.log   output of attempt n
+    results/<id>/       files collected from the task (e.g. profiles)
+
+Workers claim pending tasks, heartbeat while running them and record their
+result. Failed tasks are requeued until they run out of attempts. A
+coordinator requeues the tasks of workers whose heartbeat stopped (against
+the clock of the shared filesystem, as nodes' clocks may differ), and
+writes a summary of the queue. No service other than the filesystem is
+needed, so the queue also runs with several workers on one machine
+"""
+import json
+import os
+import os.path as op
+import socket
+import time
+
+SUBDIRS = ('tasks', 'claims', 'workers', 'done', 'failed', 'logs', 'results')
+
+# Seconds between heartbeats, and without one before a claim is stale
+HEARTBEAT = 30
+TIMEOUT = 300
+
+
+def _writeJSON(path, data):
+    """ Write JSON atomically (readers never see a partial file) """
+    tmp = "%s.%s.%d.tmp" % (path, socket.gethostname(), os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+
+def _readJSON(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _ids(queue_dir, subdir, ext):
+    try:
+        names = os.listdir(op.join(queue_dir, subdir))
+    except OSError:
+        return []
+    return sorted(name[:-len(ext)] for name in names if name.endswith(ext))
+
+
+def initQueue(queue_dir):
+    for subdir in SUBDIRS:
+        # Workers on several nodes may create the queue at once
+        os.makedirs(op.join(queue_dir, subdir), exist_ok=True)
+
+    return queue_dir
+
+
+def submit(queue_dir, task_id, command, max_attempts=3, collect=()):
+    """
+    Add a task running command (list of arguments) to the queue. Files in
+    collect are copied to results/<task_id>/ once the task has run. A task
+    that already exists is left as is. Returns the task path
+    """
+    initQueue(queue_dir)
+    path = op.join(queue_dir, 'tasks', '%s.json' % task_id)
+    if not op.exists(path):
+        _writeJSON(path, {'id': task_id,
+                          'command': list(command),
+                          'attempt': 0,
+                          'max_attempts': int(max_attempts),
+                          'collect': list(collect),
+                          'submitted': time.time()})
+
+    return path
+
+
+def taskState(queue_dir, task_id):
+    """ One of 'done', 'failed', 'running' or 'pending' """
+    if op.exists(op.join(queue_dir, 'done', '%s.json' % task_id)):
+        return 'done'
+    if op.exists(op.join(queue_dir, 'failed', '%s.json' % task_id)):
+        return 'failed'
+    if op.exists(op.join(queue_dir, 'claims', '%s.lock' % task_id)):
+        return 'running'
+    return 'pending'
+
+
+def claim(queue_dir, task_id, worker_id):
+    """ Atomically claim a task, returning whether this worker holds it """
+    path = op.join(queue_dir, 'claims', '%s.lock' % task_id)
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except OSError:
+        return False
+
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'worker': worker_id, 'claimed': time.time()}, f)
+
+    # Finished between listing and claiming
+    if taskState(queue_dir, task_id) in ('done', 'failed'):
+        os.remove(path)
+        return False
+
+    return True
+
+
+def _holds(queue_dir, task_id, worker_id):
+    info = _readJSON(op.join(queue_dir, 'claims', '%s.lock' % task_id))
+    return bool(info) and info.get('worker') == worker_id
+
+
+def _release(queue_dir, task_id):
+    try:
+        os.remove(op.join(queue_dir, 'claims', '%s.lock' % task_id))
+    except OSError:
+        pass
+
+
+def _finish(queue_dir, task, record, requeue):
+    """
+    Record the result of an attempt: done, requeued with one more attempt,
+    or failed once out of attempts
+    """
+    task_id = task['id']
+    if record['returncode'] == 0:
+        _writeJSON(op.join(queue_dir, 'done', '%s.json' % task_id), record)
+    elif requeue and task['attempt'] + 1 < task['max_attempts']:
+        task = dict(task, attempt=task['attempt'] + 1)
+        _writeJSON(op.join(queue_dir, 'tasks', '%s.json' % task_id), task)
+    else:
+        _writeJSON(op.join(queue_dir, 'failed', '%s.json' % task_id), record)
+
+
+def _collect(queue_dir, task):
+    """ Copy the files a task asked for into results/<id>/ """
+    import shutil
+
+    out_dir = op.join(queue_dir, 'results', task['id'])
+    collected = []
+    for path in task.get('collect', []):
+        if op.isfile(path):
+            if not op.exists(out_dir):
+                os.makedirs(out_dir)
+            dst = op.join(out_dir, op.basename(path))
+            shutil.copyfile(path, dst)
+            collected.append(dst)
+
+    return collected
+
+
+def runTask(queue_dir, task, worker_id, heartbeat=HEARTBEAT):
+    """
+    Run a claimed task, heartbeating on its claim. The task is stopped if
+    the claim is lost (requeued by the coordinator). Returns the result
+    record, or None when the claim was lost
+    """
+    import subprocess
+
+    task_id = task['id']
+    claim_file = op.join(queue_dir, 'claims', '%s.lock' % task_id)
+    log_file = op.join(queue_dir, 'logs', '%s.%d.log' % (task_id,
+                                                        task['attempt']))
+    worker_file = op.join(queue_dir, 'workers', '%s.json' % worker_id)
+
+    start = time.time()
+    error = None
+    with open(log_file, 'w') as log:
+        try:
+            proc = subprocess.Popen(task['command'], stdout=log,
+                                    stderr=subprocess.STDOUT)
+        except OSError as err:
+            # e.g. an interpreter or pipeline missing on this node, recorded
+            # as a failed attempt (127, as a shell would return)
+            error = "Could not run %s: %s" % (task['command'][0], err)
+            log.write(error + "\n")
+            proc, returncode = None, 127
+        while proc is not None:
+            try:
+                returncode = proc.wait(timeout=heartbeat)
+                break
+            except subprocess.TimeoutExpired:
+                if not _holds(queue_dir, task_id, worker_id):
+                    proc.terminate()
+                    proc.wait()
+                    return None
+                os.utime(claim_file, None)
+                _writeJSON(worker_file, {'worker': worker_id,
+                                         'task': task_id,
+                                         'heartbeat': time.time()})
+
+    if not _holds(queue_dir, task_id, worker_id):
+        return None
+
+    record = {'id': task_id,
+              'worker': worker_id,
+              'attempt': task['attempt'],
+              'returncode': returncode,
+              'start': start,
+              'wall_s': time.time() - start,
+              'log': log_file,
+              'results': _collect(queue_dir, task)}
+    if error is not None:
+        record['error'] = error
+    _finish(queue_dir, task, record, requeue=True)
+    _release(queue_dir, task_id)
+
+    return record
+
+
+def workerId():
+    return "%s.%d" % (socket.gethostname(), os.getpid())
+
+
+def runWorker(queue_dir, worker_id=None, heartbeat=HEARTBEAT, poll=5.,
+              max_tasks=None):
+    """
+    Claim and run pending tasks until none are pending or running (or
+    max_tasks have run). Returns the number of tasks run
+    """
+    worker_id = worker_id or workerId()
+    worker_file = op.join(queue_dir, 'workers', '%s.json' % worker_id)
+    ran = 0
+
+    while max_tasks is None or ran < max_tasks:
+        _writeJSON(worker_file, {'worker': worker_id, 'task': None,
+                                 'heartbeat': time.time()})
+        claimed = None
+        for task_id in _ids(queue_dir, 'tasks', '.json'):
+            if taskState(queue_dir, task_id) != 'pending':
+                continue
+            if claim(queue_dir, task_id, worker_id):
+                claimed = task_id
+                break
+
+        if claimed is None:
+            # Running tasks may still be requeued
+            if not _ids(queue_dir, 'claims', '.lock'):
+                break
+            time.sleep(poll)
+            continue
+
+        task = _readJSON(op.join(queue_dir, 'tasks', '%s.json' % claimed))
+        if task is None:
+            _release(queue_dir, claimed)
+            continue
+        runTask(queue_dir, task, worker_id, heartbeat)
+        ran += 1
+
+    try:
+        os.remove(worker_file)
+    except OSError:
+        pass
+
+    return ran
+
+
+def _fsTime(queue_dir):
+    """
+    Current time on the filesystem holding the queue: the modification time
+    of a file just touched there. Heartbeats are modification times set by
+    the file server, so they are compared with its clock rather than with
+    the clock of this node
+    """
+    path = op.join(queue_dir, '.clock.%s' % workerId())
+    with open(path, 'w'):
+        pass
+    os.utime(path, None)
+    now = op.getmtime(path)
+    os.remove(path)
+
+    return now
+
+
+def requeueStale(queue_dir, timeout=TIMEOUT):
+    """
+    Requeue the tasks whose claim has not been refreshed for timeout
+    seconds (dead workers), counting it as a failed attempt. Returns the
+    requeued task ids
+    """
+    requeued = []
+    now = _fsTime(queue_dir)
+    for task_id in _ids(queue_dir, 'claims', '.lock'):
+        claim_file = op.join(queue_dir, 'claims', '%s.lock' % task_id)
+        lock_file = op.join(queue_dir, 'claims', '%s.requeue' % task_id)
+        try:
+            if now - op.getmtime(claim_file) < timeout:
+                continue
+            # Left by a coordinator that died while requeueing
+            if op.exists(lock_file) and \
+               now - op.getmtime(lock_file) >= timeout:
+                os.remove(lock_file)
+            # Only one coordinator requeues a task
+            os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                             0o644))
+        except OSError:
+            continue
+
+        try:
+            info = _readJSON(claim_file) or {}
+            task = _readJSON(op.join(queue_dir, 'tasks', '%s.json' % task_id))
+            state = taskState(queue_dir, task_id)
+            if task is not None and state == 'running' and \
+               now - op.getmtime(claim_file) >= timeout:
+                # The task is rewritten with its next attempt before the
+                # claim is released, so no worker can claim it in between
+                # and rerun (and overwrite the log of) the lost attempt
+                record = {'id': task_id,
+                          'worker': info.get('worker'),
+                          'attempt': task['attempt'],
+                          'returncode': -1,
+                          'error': 'worker heartbeat lost'}
+                _finish(queue_dir, task, record, requeue=True)
+                requeued.append(task_id)
+                _release(queue_dir, task_id)
+            elif state in ('done', 'failed'):  # Died before releasing it
+                _release(queue_dir, task_id)
+        except OSError:
+            pass
+        finally:
+            try:
+                os.remove(lock_file)
+            except OSError:
+                pass
+
+    # Heartbeats of dead workers
+    for worker_id in _ids(queue_dir, 'workers', '.json'):
+        worker_file = op.join(queue_dir, 'workers', '%s.json' % worker_id)
+        try:
+            if now - op.getmtime(worker_file) >= timeout:
+                os.remove(worker_file)
+        except OSError:
+            pass
+
+    return requeued
+
+
+def summary(queue_dir):
+    """ State, attempts and result of every task, and counts per state """
+    tasks = []
+    counts = {'pending': 0, 'running': 0, 'done': 0, 'failed': 0}
+    for task_id in _ids(queue_dir, 'tasks', '.json'):
+        task = _readJSON(op.join(queue_dir, 'tasks', '%s.json' % task_id))
+        state = taskState(queue_dir, task_id)
+        counts[state] += 1
+        entry = {'id': task_id, 'state': state,
+                 'attempt': task['attempt'] if task else None}
+        if state in ('done', 'failed'):
+            entry.update(_readJSON(op.join(queue_dir, state,
+                                           '%s.json' % task_id)) or {})
+            entry['state'] = state
+        elif state == 'running':
+            info = _readJSON(op.join(queue_dir, 'claims',
+                                     '%s.lock' % task_id)) or {}
+            entry['worker'] = info.get('worker')
+        tasks.append(entry)
+
+    return {'counts': counts, 'tasks': tasks,
+            'workers': _ids(queue_dir, 'workers', '.json')}
+
+
+def coordinate(queue_dir, timeout=TIMEOUT, poll=10., once=False):
+    """
+    Requeue the tasks of dead workers and write summary.json until every
+    task is done or failed (or once). Returns the final summary
+    """
+    while True:
+        for task_id in requeueStale(queue_dir, timeout):
+            print("%s: requeued (worker heartbeat lost)" % task_id)
+
+        report = summary(queue_dir)
+        _writeJSON(op.join(queue_dir, 'summary.json'), report)
+        counts = report['counts']
+        if once or not (counts['pending'] or counts['running']):
+            return report
+        time.sleep(poll)
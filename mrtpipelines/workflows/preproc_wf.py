@@ -2,14 +2,19 @@ from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu
 from nipype.interfaces import mrtrix3 as mrt
 
-from mrtpipelines.interfaces import io
+from mrtpipelines.interfaces import cache, io, resources, tensor
 
 def dholl_preproc_wf(shells=[0, 1000, 2000], lmax=[0, 8, 8], sshell=False,
                      noreorient=False, template_dir=None, template_label=None,
-                     wdir=None, nthreads=1, name='dholl_preproc_wf'):
+                     wdir=None, nthreads=1, cache_dir=None, cache_gb=100,
+                     tensor_engine='mrtrix', name='dholl_preproc_wf'):
     """
     Set up Dhollander response preproc workflow
     No assumption of registration to T1w space is made
+    Registration, FOD estimation and tensor fitting results are reused
+    across runs when a cache_dir is given
+    With tensor_engine 'python', tensors and their metrics are computed in
+    process by a single FitTensor node (no TensorMetrics node)
     """
 
     if template_dir is None or template_label is None:
@@ -21,11 +26,9 @@ def dholl_preproc_wf(shells=[0, 1000, 2000], lmax=[0, 8, 8], sshell=False,
                                      template_label=template_label,
                                      wdir=wdir)
 
-    # Convert nii to mif
-    dwiConvert = pe.Node(mrt.MRConvert(), name='dwiConvert')
-    dwiConvert.base_dir = wdir
-    dwiConvert.inputs.nthreads = nthreads
-    dwiConvert.interface.num_threads = nthreads
+    # Expose nii (and gradients) to MRtrix, without a copy when uncompressed
+    dwiConvert = io.convertImage(node_name='dwiConvert', out_base='dwi',
+                                 wdir=wdir, nthreads=nthreads)
 
     # dwi2response - included but not used
     dwi2response = pe.Node(mrt.ResponseSD(), name='dwi2response')
@@ -36,17 +39,15 @@ def dholl_preproc_wf(shells=[0, 1000, 2000], lmax=[0, 8, 8], sshell=False,
     dwi2response.inputs.csf_file = 'space-dwi_model-CSD_CSFResp.txt'
     dwi2response.inputs.max_sh = lmax
     dwi2response.inputs.shell = shells
-    dwi2response.inputs.nthreads = nthreads
-    dwi2response.interface.num_threads = nthreads
+    resources.setProfile(dwi2response, nthreads)
 
-    # Convert mask (nii) to mif
-    maskConvert = pe.Node(mrt.MRConvert(), name='maskConvert')
-    maskConvert.base_dir = wdir
-    maskConvert.inputs.nthreads = nthreads
-    maskConvert.interface.num_threads = nthreads
+    # Expose mask (nii) to MRtrix
+    maskConvert = io.convertImage(node_name='maskConvert', out_base='mask',
+                                  wdir=wdir, nthreads=nthreads)
 
     # dwi2fod
-    dwi2fod = pe.Node(mrt.EstimateFOD(), name='dwi2fod')
+    dwi2fod = pe.Node(cache.cachedInterface(mrt.EstimateFOD, cache_dir,
+                                            cache_gb), name='dwi2fod')
     dwi2fod.base_dir = wdir
     dwi2fod.inputs.algorithm = 'msmt_csd'
     dwi2fod.inputs.shell = shells
@@ -54,8 +55,7 @@ def dholl_preproc_wf(shells=[0, 1000, 2000], lmax=[0, 8, 8], sshell=False,
     if sshell is False:
         dwi2fod.inputs.gm_odf = 'space-dwi_model-CSD_GMFOD.mif'
     dwi2fod.inputs.csf_odf = 'space-dwi_model-CSD_CSFFOD.mif'
-    dwi2fod.inputs.nthreads = nthreads
-    dwi2fod.interface.num_threads = nthreads
+    resources.setProfile(dwi2fod, nthreads)
 
     # mtnormalise
     mtnormalise = pe.Node(mrt.MTNormalise(), name='mtnormalise')
@@ -64,71 +64,71 @@ def dholl_preproc_wf(shells=[0, 1000, 2000], lmax=[0, 8, 8], sshell=False,
     if sshell is False:
         mtnormalise.inputs.out_gm = 'space-dwi_model-CSD_GMFODNorm.mif'
     mtnormalise.inputs.out_csf = 'space-dwi_model-CSD_CSFFODNorm.mif'
-    mtnormalise.inputs.nthreads = nthreads
-    mtnormalise.interface.num_threads = nthreads
+    resources.setProfile(mtnormalise, nthreads)
 
     # Registration
-    MRRegister = pe.Node(mrt.MRRegister(), name='MRRegister')
+    MRRegister = pe.Node(cache.cachedInterface(mrt.MRRegister, cache_dir,
+                                               cache_gb), name='MRRegister')
     MRRegister.base_dir = wdir
     # MRRegister.inputs.ref_file = template
     MRRegister.inputs.nl_warp = ['from-dwi_to-Template_xfm.mif',
                                  'from-Template_to-dwi_xfm.mif']
     if noreorient is not False:
         MRRegister.inputs.noreorientation = noreorient
-    MRRegister.inputs.nthreads = nthreads
-    MRRegister.interface.num_threads = nthreads
+    resources.setProfile(MRRegister, nthreads)
 
     # Transforms
     WarpSelect1 = pe.Node(niu.Select(), name='WarpSelect1')
     WarpSelect1.base_dir = wdir
     WarpSelect1.inputs.index = [0]
-    WarpSelect1.interface.num_threads = nthreads
+    resources.setProfile(WarpSelect1, nthreads)
 
     WarpSelect2 = pe.Node(niu.Select(), name='WarpSelect2')
     WarpSelect2.base_dir = wdir
     WarpSelect2.inputs.index = [1]
-    WarpSelect2.interface.num_threads = nthreads
+    resources.setProfile(WarpSelect2, nthreads)
 
     # Warp data
     MaskTransform = pe.Node(mrt.MRTransform(), name='MaskTransform')
     MaskTransform.base_dir = wdir
     MaskTransform.inputs.out_file = 'space-Template_brainmask.mif'
-    MaskTransform.inputs.nthreads = nthreads
-    MaskTransform.interface.num_threads = nthreads
+    resources.setProfile(MaskTransform, nthreads)
 
     FODTransform = pe.Node(mrt.MRTransform(), name='FODTransform')
     FODTransform.base_dir = wdir
     FODTransform.inputs.out_file = 'space-Template_model-CSD_WMFODNorm.mif'
-    FODTransform.inputs.nthreads = nthreads
-    FODTransform.interface.num_threads = nthreads
+    resources.setProfile(FODTransform, nthreads)
 
     # Tensor processing
     DWINormalise = pe.Node(mrt.DWINormalise(), name='DWINormalise')
     DWINormalise.base_dir = wdir
     DWINormalise.inputs.out_file = 'space-dwi_dwiNorm.mif'
-    DWINormalise.inputs.nthreads = nthreads
-    DWINormalise.interface.num_threads = nthreads
+    resources.setProfile(DWINormalise, nthreads)
 
     DWITransform = pe.Node(mrt.MRTransform(), name='DWITransform')
     DWITransform.base_dir = wdir
     DWITransform.inputs.out_file = 'space-Template_dwiNorm.mif'
-    DWITransform.inputs.nthreads = nthreads
-    DWITransform.interface.num_threads = nthreads
+    resources.setProfile(DWITransform, nthreads)
 
-    FitTensor = pe.Node(mrt.FitTensor(), name='FitTensor')
-    FitTensor.base_dir = wdir
-    FitTensor.inputs.out_file = 'space-Template_desc-WLS_model-DTI_tensor.mif'
-    FitTensor.inputs.nthreads = nthreads
-    FitTensor.interface.num_threads = nthreads
+    if tensor_engine == 'python':
+        # Tensor and metrics in one pass
+        FitTensor = tensor.tensorFit(wdir=wdir, nthreads=nthreads)
+        TensorMetrics = FitTensor
+    else:
+        FitTensor = pe.Node(cache.cachedInterface(mrt.FitTensor, cache_dir,
+                                                  cache_gb), name='FitTensor')
+        FitTensor.base_dir = wdir
+        resources.setProfile(FitTensor, nthreads)
+
+        TensorMetrics = pe.Node(mrt.TensorMetrics(), name='TensorMetrics')
+        TensorMetrics.base_dir = wdir
+        resources.setProfile(TensorMetrics, nthreads)
 
-    TensorMetrics = pe.Node(mrt.TensorMetrics(), name='TensorMetrics')
-    TensorMetrics.base_dir = wdir
+    FitTensor.inputs.out_file = 'space-Template_desc-WLS_model-DTI_tensor.mif'
     TensorMetrics.inputs.out_fa = 'space-Template_model-DTI_FA.mif'
     TensorMetrics.inputs.out_adc = 'space-Template_model-DTI_MD.mif'
     TensorMetrics.inputs.out_ad = 'space-Template_model-DTI_AD.mif'
     TensorMetrics.inputs.out_rd = 'space-Template_model-DTI_RD.mif'
-    TensorMetrics.inputs.nthreads = nthreads
-    TensorMetrics.interface.num_threads = nthreads
 
     # Build workflow
     workflow = pe.Workflow(name=name)
@@ -162,9 +162,7 @@ def dholl_preproc_wf(shells=[0, 1000, 2000], lmax=[0, 8, 8], sshell=False,
             (DWINormalise, DWITransform, [('out_file', 'in_file')]),
             (WarpSelect1, DWITransform, [('out', 'warp')]),
             (DWITransform, FitTensor, [('out_file', 'in_file')]),
-            (MaskTransform, FitTensor, [('out_file', 'in_mask')]),
-            (FitTensor, TensorMetrics, [('out_file', 'in_file')]),
-            (MaskTransform, TensorMetrics, [('out_file', 'in_mask')])
+            (MaskTransform, FitTensor, [('out_file', 'in_mask')])
         ])
 
     # For multi-shell
@@ -198,7 +196,12 @@ def dholl_preproc_wf(shells=[0, 1000, 2000], lmax=[0, 8, 8], sshell=False,
             (DWINormalise, DWITransform, [('out_file', 'in_file')]),
             (WarpSelect1, DWITransform, [('out', 'warp')]),
             (DWITransform, FitTensor, [('out_file', 'in_file')]),
-            (MaskTransform, FitTensor, [('out_file', 'in_mask')]),
+            (MaskTransform, FitTensor, [('out_file', 'in_mask')])
+        ])
+
+    # Metrics from the MRtrix tensor fit
+    if tensor_engine != 'python':
+        workflow.connect([
             (FitTensor, TensorMetrics, [('out_file', 'in_file')]),
             (MaskTransform, TensorMetrics, [('out_file', 'in_mask')])
         ])
@@ -1,54 +1,165 @@
 from nipype.pipeline import engine as pe
 from nipype.interfaces import mrtrix3 as mrt
+from nipype.interfaces import utility as niu
+
+from mrtpipelines.interfaces import cache, resources
+
+
+def shardTracks(n_tracks, shards=1, seed=0):
+    """
+    Split n_tracks streamlines across shards, returning the number of
+    streamlines and the environment (with a distinct RNG seed) of each shard.
+    The counts sum exactly to n_tracks
+    """
+    base, extra = divmod(int(n_tracks), int(shards))
+    counts = [base + 1 if shard < extra else base for shard in range(shards)]
+    environ = [{'MRTRIX_RNG_SEED': str(seed + shard)}
+               for shard in range(shards)]
+
+    return counts, environ
+
+
+def _mergeTract(in_file, out_file):
+    import os.path as op
+
+    from mrtpipelines.interfaces.tck import mergeTck
+
+    return mergeTck(in_file, op.abspath(out_file))
+
+
+def _indexTract(in_file, ref_image, out_file):
+    import os.path as op
+
+    from mrtpipelines.interfaces.tckindex import buildIndex
+
+    return buildIndex(in_file, ref_image, op.abspath(out_file))
+
+
+def _convTract(in_file, out_base, formats, ref_image=None):
+    import os.path as op
+
+    from mrtpipelines.interfaces.tckexport import exportTck
+
+    out_files = exportTck(in_file, op.abspath(out_base), formats, ref_image)
+
+    return out_files.get('vtk'), out_files.get('trk')
 
-import numpy as np
 
 def genDhollTract_wf(nfibers=50000, sshell=False, wdir=None, nthreads=1,
-                     name='genDhollTract_wf'):
+                     cache_dir=None, cache_gb=100, shards=1, seed=0,
+                     export=('vtk',), name='genDhollTract_wf'):
     """
     Set up workflow to generate tracts with Dhollander response
+    Tractography and SIFT results are reused across runs when a cache_dir
+    is given
+
+    With shards > 1, streamlines are generated by independent single
+    threaded shards seeded from seed, and merged in shard order before SIFT,
+    so the result is reproducible for a given number of shards
+
+    The SIFTed streamlines are indexed by voxel (indexTract), on the grid of
+    the image connected to indexTract.ref_image, and streamed to each format
+    of export ('vtk', 'trk') by convTract. .trk export needs
+    convTract.ref_image; without formats, there is no convTract node
     """
+    n_tracks = int(nfibers * 10)
 
     # Generate tract
-    genTract = pe.Node(mrt.Tractography(), name='genTract')
+    if shards > 1:
+        genTract = pe.MapNode(cache.cachedInterface(mrt.Tractography,
+                                                    cache_dir, cache_gb),
+                              iterfield=['n_tracks', 'environ'],
+                              name='genTract')
+        genTract.inputs.n_tracks, genTract.inputs.environ = \
+            shardTracks(n_tracks, shards, seed)
+    else:
+        genTract = pe.Node(cache.cachedInterface(mrt.Tractography, cache_dir,
+                                                 cache_gb), name='genTract')
+        genTract.inputs.n_tracks = n_tracks
     genTract.base_dir = wdir
-    genTract.inputs.n_tracks = np.int(nfibers * 10)
     if sshell is False:  # Single-shell
         genTract.inputs.out_file = 'space-Template_desc-iFOD2_tractography.tck'
         genTract.inputs.algorithm = 'iFOD2'
     else:
         genTract.inputs.out_file = 'space-Template_desc-TensorProb_tractography.tck'
         genTract.inputs.algorithm = 'Tensor_Prob'
-    genTract.inputs.nthreads = nthreads
-    genTract.interface.num_threads = nthreads
+    if shards > 1:
+        # A single generating thread per shard keeps each seed reproducible
+        resources.setProfile(genTract, nthreads, profile='genTractShard')
+    else:
+        resources.setProfile(genTract, nthreads)
+
+    # Merge shards
+    mergeTract = pe.Node(niu.Function(function=_mergeTract,
+                                      input_names=['in_file', 'out_file'],
+                                      output_names=['out_file']),
+                                      name='mergeTract')
+    mergeTract.base_dir = wdir
+    mergeTract.inputs.out_file = genTract.inputs.out_file
+    resources.setProfile(mergeTract, nthreads)
 
     # Spherical-deconvolution informed filtering of tractography
-    siftTract = pe.Node(mrt.SIFT(), name='siftTract')
+    siftTract = pe.Node(cache.cachedInterface(mrt.SIFT, cache_dir,
+                                              cache_gb), name='siftTract')
     siftTract.base_dir = wdir
     siftTract.inputs.term_number = nfibers
     if sshell is False:  # Multi-shell
         siftTract.inputs.out_file = 'space-Template_desc-iFOD2_tractography.tck'
     else:  # Single-shell
         siftTract.inputs.out_file = 'space-Template_desc-TensorProb_tractography.tck'
-    siftTract.inputs.nthreads = nthreads
-    siftTract.interface.num_threads = nthreads
+    resources.setProfile(siftTract, nthreads)
 
-    # Convert to VTK
-    tractConvert = pe.Node(mrt.TCKConvert(), name='convTract')
-    tractConvert.base_dir = wdir
+    # Voxel to streamline index, on the grid of ref_image
+    indexTract = pe.Node(niu.Function(function=_indexTract,
+                                      input_names=['in_file', 'ref_image',
+                                                   'out_file'],
+                                      output_names=['out_file']),
+                                      name='indexTract')
+    indexTract.base_dir = wdir
     if sshell is False:  # Multi-shell
-        tractConvert.inputs.out_file = 'space-Template_desc-iFOD2_tractography.vtk'
+        indexTract.inputs.out_file = 'space-Template_desc-iFOD2_tractindex.npz'
     else:  # Single-shell
-        tractConvert.inputs.out_file = 'space-Template_desc-TensorProb_tractography.vtk'
-    tractConvert.inputs.nthreads = nthreads
-    tractConvert.interface.num_threads = nthreads
+        indexTract.inputs.out_file = 'space-Template_desc-TensorProb_tractindex.npz'
+    resources.setProfile(indexTract, nthreads)
+
+    # Export to other formats, streamed from the tractogram
+    if export:
+        tractConvert = pe.Node(niu.Function(function=_convTract,
+                                            input_names=['in_file',
+                                                         'out_base',
+                                                         'formats',
+                                                         'ref_image'],
+                                            output_names=['out_vtk',
+                                                          'out_trk']),
+                                            name='convTract')
+        tractConvert.base_dir = wdir
+        if sshell is False:  # Multi-shell
+            tractConvert.inputs.out_base = 'space-Template_desc-iFOD2_tractography'
+        else:  # Single-shell
+            tractConvert.inputs.out_base = 'space-Template_desc-TensorProb_tractography'
+        tractConvert.inputs.formats = list(export)
+        resources.setProfile(tractConvert, nthreads)
 
     # Build workflow
     workflow = pe.Workflow(name=name)
 
+    if shards > 1:
+        workflow.connect([
+            (genTract, mergeTract, [('out_file', 'in_file')]),
+            (mergeTract, siftTract, [('out_file', 'in_file')])
+        ])
+    else:
+        workflow.connect([
+            (genTract, siftTract, [('out_file', 'in_file')])
+        ])
+
     workflow.connect([
-        (genTract, siftTract, [('out_file', 'in_file')]),
-        (siftTract, tractConvert, [('out_file', 'in_file')])
+        (siftTract, indexTract, [('out_file', 'in_file')])
     ])
 
+    if export:
+        workflow.connect([
+            (siftTract, tractConvert, [('out_file', 'in_file')])
+        ])
+
     return workflow
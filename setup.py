@@ -10,7 +10,8 @@ setup(
               'mrtpipelines/interfaces',
               'mrtpipelines/workflows'],
     scripts=['mrtpipelines/pipelines/genDhollanderTractography',
-             'mrtpipelines/pipelines/tractScalar'],
+             'mrtpipelines/pipelines/tractScalar',
+             'mrtpipelines/pipelines/workQueue'],
 
     # Metadata
     author='Jason Kai',
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Result cache entries stay intact when the files stored from, or restored
+into, a work directory are edited or sunk
+"""
+import os
+import os.path as op
+
+import pytest
+
+from mrtpipelines.interfaces import cache, io
+
+KEY = 'ab' + '0' * 38
+
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    return path
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _edit(path):
+    """ Edit a file in place, as a tool writing into its input would """
+    with open(path, 'r+b') as f:
+        f.write(b'edited')
+
+
+@pytest.fixture
+def stored(tmpdir):
+    results = cache.ResultCache(str(tmpdir.join('cache')))
+    os.makedirs(results.cache_dir)
+    work = tmpdir.mkdir('run1')
+    out_file = _write(str(work.join('tract.tck')), b'streamlines')
+    results.store(KEY, {'out_file': out_file})
+
+    return results, out_file
+
+
+def test_store_independent(stored):
+    results, out_file = stored
+    entry_file = op.join(results._entry(KEY), 'tract.tck')
+    assert not op.samefile(entry_file, out_file)
+
+    _edit(out_file)
+    assert _read(entry_file) == b'streamlines'
+
+
+@pytest.mark.parametrize('link_mode', io.LINK_MODES)
+def test_restore_sunk(tmpdir, stored, link_mode):
+    results, _ = stored
+    work = tmpdir.mkdir('run2')
+    assert results.restore(KEY, str(work))
+    restored = str(work.join('tract.tck'))
+    assert not op.samefile(restored, op.join(results._entry(KEY),
+                                             'tract.tck'))
+
+    # The sunk derivative may share the restored file's data, never the
+    # cache entry's
+    sunk = str(tmpdir.join('sub-01_tractography.tck'))
+    io.placeFile(restored, sunk, link_mode)
+    _edit(sunk)
+
+    again = tmpdir.mkdir('run3')
+    assert results.restore(KEY, str(again))
+    assert _read(str(again.join('tract.tck'))) == b'streamlines'
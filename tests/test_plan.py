@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Node lists of the dry-run plan against the workflows the command line
+interfaces build
+"""
+import os.path as op
+from importlib.machinery import SourceFileLoader
+from importlib.util import module_from_spec, spec_from_loader
+
+import pytest
+
+from mrtpipelines.interfaces import plan
+
+PIPELINES = op.join(op.dirname(op.dirname(op.abspath(__file__))),
+                    'mrtpipelines', 'pipelines')
+
+
+def _pipeline(name):
+    """ Command line interface name, a script without extension """
+    loader = SourceFileLoader(name, op.join(PIPELINES, name))
+    module = module_from_spec(spec_from_loader(name, loader))
+    loader.exec_module(module)
+
+    return module
+
+
+def _graph(pl):
+    """ Nodes of the flat graph of pl, as {node: upstream nodes} """
+    prefix = pl.name + '.'
+    graph = pl._create_flat_graph()
+    names = {node: node.fullname[len(prefix):] for node in graph.nodes()}
+
+    return {names[node]: set(names[up] for up in graph.predecessors(node))
+            for node in graph.nodes()}
+
+
+def _planned(nodes):
+    return {node: set(upstream) for node, upstream in nodes}
+
+
+@pytest.mark.parametrize('options', [
+    [], ['-ss'], ['--shards', '2'], ['--export', 'none'],
+    ['--export', 'vtk', 'trk'], ['--tensor_engine', 'python'],
+    ['-ss', '--shards', '3', '--export', 'trk', '--tensor_engine',
+     'python']
+])
+def test_dholl_nodes(tmpdir, options):
+    cli = _pipeline('genDhollanderTractography')
+    args = cli.get_parser().parse_args([str(tmpdir), str(tmpdir), 'Template',
+                                        'sub-01'] + options)
+    export, outputs = cli.getOutputs(args)
+    pl = cli.buildPipeline(args, 'sub-01', str(tmpdir.join('index.db')),
+                           str(tmpdir), str(tmpdir), outputs, export)
+
+    assert _graph(pl) == _planned(cli.planNodes(args, outputs, export))
+
+
+@pytest.mark.parametrize('options', [
+    [], ['--engine', 'python'], ['--stats'], ['--engine', 'python', '--stats'],
+    ['--include', 'roi.nii.gz'], ['--exclude', 'roi.nii.gz', '--stats']
+])
+def test_scalar_nodes(tmpdir, options):
+    cli = _pipeline('tractScalar')
+    args = cli.get_parser().parse_args([str(tmpdir), 'sub-01', 'FA'] +
+                                       options)
+    outputs = [('dti', 'FA')] + ([('dti', 'FA_stats')] if args.stats else [])
+    pl = cli.buildPipeline(args, 'sub-01', 'FA', str(tmpdir.join('index.db')),
+                           str(tmpdir), str(tmpdir), outputs)
+
+    assert _graph(pl) == _planned(plan.scalarNodes(
+        engine=args.engine, stats=args.stats,
+        select=bool(args.include or args.exclude)))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Profiled workflows run under a scheduler budget smaller than their profiles
+"""
+import pytest
+
+from mrtpipelines.interfaces import resources
+
+
+def _step(x):
+    return x + 1
+
+
+def _workflow(base_dir, nthreads):
+    """ Chain of nodes with the profiles of the costliest pipeline nodes """
+    from nipype.pipeline import engine as pe
+    from nipype.interfaces import utility as niu
+
+    wf = pe.Workflow(name='budget_wf', base_dir=base_dir)
+    previous = None
+    for name in ('dwi2fod', 'MRRegister', 'siftTract'):
+        node = pe.Node(niu.Function(function=_step, input_names=['x'],
+                                    output_names=['x']), name=name)
+        resources.setProfile(node, nthreads)
+        if previous is None:
+            node.inputs.x = 0
+        else:
+            wf.connect(previous, 'x', node, 'x')
+        previous = node
+
+    return wf
+
+
+def test_clamp(tmpdir):
+    wf = _workflow(str(tmpdir), 8)
+    assert max(node.mem_gb for node in resources._nodes(wf).values()) == 8.
+
+    resources.clamp(wf, 2, 1.5)
+    for node in resources._nodes(wf).values():
+        assert node.n_procs == 2 and node.interface.num_threads == 2
+        assert node.mem_gb == 1.5
+
+
+def test_default_memory(tmpdir):
+    from nipype.utils.profiler import get_system_total_memory_gb
+
+    wf = resources.clamp(_workflow(str(tmpdir), 1), 1)
+    budget = get_system_total_memory_gb() * 0.9
+    assert all(node.mem_gb <= budget
+               for node in resources._nodes(wf).values())
+
+
+def test_run_small_budget(tmpdir):
+    plugin_args = {'n_procs': 2, 'memory_gb': 1}
+
+    # More threads (-n 8 -p 2) and memory than the scheduler is given
+    with pytest.raises(RuntimeError):
+        _workflow(str(tmpdir.join('unclamped')), 8).run(
+            plugin='MultiProc', plugin_args=plugin_args)
+
+    wf = resources.clamp(_workflow(str(tmpdir.join('clamped')), 8), 2, 1)
+    graph = wf.run(plugin='MultiProc', plugin_args=plugin_args)
+    results = {node.name: node.result.outputs.x for node in graph.nodes()}
+    assert results == {'dwi2fod': 1, 'MRRegister': 2, 'siftTract': 3}
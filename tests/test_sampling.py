@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Sampling of scalar images along streamlines, against scipy's trilinear
+interpolation and read back from the npz output
+"""
+import os.path as op
+
+import numpy as np
+from scipy import ndimage
+
+from benchmarks import phantoms
+from mrtpipelines.interfaces import sampling
+from mrtpipelines.interfaces.tck import TckFile
+from mrtpipelines.interfaces.tractography import ScalarWriter
+
+SHAPE = (12, 10, 8)
+
+
+def _toVoxels(points, affine):
+    inv = np.linalg.inv(affine)
+    return np.asarray(points, dtype=np.float64).dot(inv[:3, :3].T) + \
+        inv[:3, 3]
+
+
+def test_trilinear(tmpdir):
+    in_file = phantoms.makeScalar(str(tmpdir.join('scalar.nii.gz')), SHAPE)
+    data, affine = sampling.loadImage(in_file)
+
+    # Within the image, including its outer half voxel (edge clamped)
+    rng = np.random.RandomState(0)
+    vox = rng.uniform(-0.5, np.array(SHAPE) - 0.5, size=(500, 3))
+    points = vox.dot(affine[:3, :3].T) + affine[:3, 3]
+
+    expected = ndimage.map_coordinates(data.astype(np.float64),
+                                       _toVoxels(points, affine).T, order=1,
+                                       mode='nearest')
+    np.testing.assert_allclose(sampling.sampleImage(data, affine, points),
+                               expected, rtol=1e-5, atol=1e-6)
+
+    expected = ndimage.map_coordinates(data, _toVoxels(points, affine).T,
+                                       order=0, mode='nearest')
+    np.testing.assert_allclose(sampling.sampleImage(data, affine, points,
+                                                    interp='nearest'),
+                               expected)
+
+
+def test_outside(tmpdir):
+    in_file = phantoms.makeScalar(str(tmpdir.join('scalar.mif')), SHAPE)
+    data, affine = sampling.loadImage(in_file)
+
+    vox = np.array([[-0.6, 0, 0], [0, SHAPE[1] - 0.4, 0], [0, 0, 0],
+                    [np.nan, np.nan, np.nan]])
+    points = vox.dot(affine[:3, :3].T) + affine[:3, 3]
+    values = sampling.sampleImage(data, affine, points)
+
+    assert np.isnan(values[[0, 1, 3]]).all()
+    np.testing.assert_allclose(values[2], data[0, 0, 0])
+
+
+def test_npz_roundtrip(tmpdir):
+    tract = phantoms.makeTck(str(tmpdir.join('tract.tck')), 50, 20, SHAPE)
+    images = [phantoms.makeScalar(str(tmpdir.join('%s.nii.gz' % name)),
+                                  SHAPE, seed=seed)
+              for seed, name in enumerate(['FA', 'MD'])]
+
+    writer = ScalarWriter(str(tmpdir.join('values')), 'npz',
+                          names=['FA', 'MD'])
+    assert sampling.sampleTck(tract, images, writer, chunk_size=16) == 50
+    out_file = writer.close()
+
+    tck = TckFile(tract)
+    with np.load(out_file) as npz:
+        assert sorted(npz.files) == ['FA', 'MD', 'offsets']
+        np.testing.assert_array_equal(npz['offsets'],
+                                      np.concatenate([[0],
+                                                      np.cumsum(tck.lengths)]))
+        for image, name in zip(images, ['FA', 'MD']):
+            data, affine = sampling.loadImage(image)
+            for idx in (0, 17, 49):
+                start, end = npz['offsets'][idx:idx + 2]
+                np.testing.assert_allclose(npz[name][start:end],
+                                           sampling.sampleImage(data, affine,
+                                                                tck[idx]))
+
+    # No spool files are left behind
+    assert sorted(op.basename(f) for f in tmpdir.listdir()) == \
+        ['FA.nii.gz', 'MD.nii.gz', 'tract.tck', 'values.npz']
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Tractograms written by mergeTck and subsetTck, read back with nibabel
+"""
+import nibabel as nib
+import numpy as np
+
+from benchmarks import phantoms
+from mrtpipelines.interfaces import tck
+
+SHAPE = (12, 10, 8)
+
+
+def _streamlines(in_file):
+    return list(nib.streamlines.load(in_file).streamlines)
+
+
+def test_merge(tmpdir):
+    shards = [phantoms.makeTck(str(tmpdir.join('shard%d.tck' % idx)),
+                               count, 15, SHAPE, seed=idx)
+              for idx, count in enumerate([30, 0, 12])]
+    out_file = tck.mergeTck(shards, str(tmpdir.join('merged.tck')))
+
+    merged = nib.streamlines.load(out_file)
+    assert int(merged.header['count']) == 42
+    expected = _streamlines(shards[0]) + _streamlines(shards[2])
+    assert len(merged.streamlines) == len(expected)
+    for got, want in zip(merged.streamlines, expected):
+        np.testing.assert_array_equal(got, want)
+
+
+def test_header_percent(tmpdir):
+    in_file = phantoms.makeTck(str(tmpdir.join('in.tck')), 5, 10, SHAPE)
+    header, offset = tck.readHeader(in_file)
+    header['command_history'] = 'tckgen -select 100% in.mif out.tck'
+
+    out_file = str(tmpdir.join('out.tck'))
+    with open(out_file, 'wb') as f:
+        assert tck.writeHeader(f, header) == f.tell()
+        with open(in_file, 'rb') as src:
+            src.seek(offset)
+            f.write(src.read())
+
+    assert tck.readHeader(out_file)[0]['command_history'] == \
+        header['command_history']
+    expected = _streamlines(in_file)
+    assert len(_streamlines(out_file)) == len(expected) == 5
+    for got, want in zip(_streamlines(out_file), expected):
+        np.testing.assert_array_equal(got, want)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Streamline selection through the index, against a brute force search of
+every vertex
+"""
+import nibabel as nib
+import numpy as np
+import pytest
+
+from benchmarks import phantoms
+from mrtpipelines.interfaces import tckindex
+from mrtpipelines.interfaces.tck import TckFile
+
+SHAPE = (12, 10, 8)
+
+
+@pytest.fixture
+def tract(tmpdir):
+    in_file = phantoms.makeTck(str(tmpdir.join('sub_tractography.tck')),
+                               300, 30, SHAPE)
+    ref = phantoms.makeNifti(str(tmpdir.join('ref.nii.gz')),
+                             np.zeros(SHAPE, dtype=np.float32))
+    tckindex.buildIndex(in_file, ref, tckindex.indexFile(in_file),
+                        chunk_size=64)
+
+    return in_file
+
+
+def _roi(tmpdir, name, shape, seed):
+    """ Random blob ROI on a grid of shape covering the phantom extent """
+    rng = np.random.RandomState(seed)
+    data = np.zeros(shape, dtype=np.uint8)
+    centre = rng.randint(0, shape)
+    lo, hi = np.maximum(centre - 2, 0), centre + 3
+    data[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]] = 1
+    voxel = phantoms.VOXEL_SIZE * SHAPE[0] / shape[0]
+
+    return phantoms.makeNifti(str(tmpdir.join(name)), data,
+                              phantoms.getAffine(shape, voxel))
+
+
+def _bruteForce(in_file, include, exclude):
+    """
+    Streamlines with a vertex in an index voxel covered by every include
+    ROI and by no exclude ROI. ROI grids are aligned with the index grid,
+    so an index voxel is covered when its centre is in an ROI voxel
+    """
+    affine = phantoms.getAffine(SHAPE)
+    rois = []
+    for roi in include + exclude:
+        img = nib.load(roi)
+        rois.append((np.asarray(img.dataobj) != 0, img.affine))
+
+    selected = []
+    for idx, points in enumerate(TckFile(in_file)):
+        # Centres of the index voxels visited
+        vox = np.floor(np.linalg.inv(affine)[:3].dot(
+            np.column_stack([points, np.ones(len(points))]).T).T + 0.5)
+        inside = np.all((vox >= 0) & (vox < SHAPE), axis=1)
+        centres = np.unique(vox[inside], axis=0).dot(affine[:3, :3].T) + \
+            affine[:3, 3]
+
+        hits = []
+        for data, roi_affine in rois:
+            ijk = np.floor(np.linalg.inv(roi_affine)[:3].dot(
+                np.column_stack([centres, np.ones(len(centres))]).T).T + 0.5)
+            ijk = ijk.astype(int)
+            ok = np.all((ijk >= 0) & (ijk < data.shape), axis=1)
+            hits.append(data[tuple(ijk[ok].T)].any())
+
+        if all(hits[:len(include)]) and not any(hits[len(include):]):
+            selected.append(idx)
+
+    return np.array(selected, dtype=np.int64)
+
+
+@pytest.mark.parametrize('grid', ['same', 'coarse'])
+def test_select(tmpdir, tract, grid):
+    shape = SHAPE if grid == 'same' else tuple(d // 2 for d in SHAPE)
+    include = [_roi(tmpdir, 'include%d.nii.gz' % idx, shape, idx)
+               for idx in range(2)]
+    exclude = [_roi(tmpdir, 'exclude.nii.gz', shape, 8)]
+    index = tckindex.TckIndex(tckindex.indexFile(tract))
+
+    for inc, exc in [(include[:1], []), (include, []), (include[:1], exclude),
+                     ([], exclude)]:
+        expected = _bruteForce(tract, inc, exc)
+        assert 0 < expected.size < len(index)
+        np.testing.assert_array_equal(index.select(inc, exc), expected)
+
+
+def test_select_tck(tmpdir, tract):
+    include = [_roi(tmpdir, 'include.nii.gz', SHAPE, 0)]
+    out_file, ids = tckindex.selectTck(tract, str(tmpdir.join('sel.tck')),
+                                       include, chunk_size=7)
+
+    subset = nib.streamlines.load(out_file)
+    assert int(subset.header['count']) == ids.size > 0
+    tck = TckFile(tract)
+    assert len(subset.streamlines) == ids.size
+    for got, idx in zip(subset.streamlines, ids):
+        np.testing.assert_array_equal(got, tck[idx])
+
+
+def test_select_other_tract(tmpdir, tract):
+    # The index of a regenerated tractogram no longer matches
+    other = phantoms.makeTck(str(tmpdir.join('other.tck')), 300, 31, SHAPE)
+    with pytest.raises(ValueError):
+        tckindex.selectTck(other, str(tmpdir.join('sel.tck')),
+                           index_file=tckindex.indexFile(tract))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Tensor fit and metrics on the signal of known tensors
+"""
+import numpy as np
+import pytest
+
+from benchmarks import phantoms
+from mrtpipelines.interfaces import mif, tensor
+
+EVALS = np.array([1.7e-3, 0.3e-3, 0.2e-3])
+
+
+def _scheme(directions=30, shells=(1000, 2000), seed=0):
+    rng = np.random.RandomState(seed)
+    dirs = rng.normal(size=(directions, 3))
+    dirs /= np.linalg.norm(dirs, axis=1, keepdims=True)
+    rows = [[0., 0., 0., 0.]] + [list(d) + [float(b)] for b in shells
+                                 for d in dirs]
+    return np.array(rows)
+
+
+def _tensors(n, seed=0):
+    """ n tensors with eigenvalues EVALS and random orientations """
+    rng = np.random.RandomState(seed)
+    rot, _ = np.linalg.qr(rng.normal(size=(n, 3, 3)))
+    mats = np.einsum('vij,j,vkj->vik', rot, EVALS, rot)
+    return mats
+
+
+def _mrtrixOrder(mats):
+    return np.stack([mats[:, 0, 0], mats[:, 1, 1], mats[:, 2, 2],
+                     mats[:, 0, 1], mats[:, 0, 2], mats[:, 1, 2]], axis=1)
+
+
+def _signal(mats, scheme, s0=1000.):
+    g, b = scheme[:, :3], scheme[:, 3]
+    return s0 * np.exp(-b * np.einsum('ni,vij,nj->vn', g, mats, g))
+
+
+@pytest.mark.parametrize('iterations', [0, 2])
+def test_fit_known_tensor(iterations):
+    scheme = _scheme()
+    mats = _tensors(20)
+    params = tensor.fitWLS(_signal(mats, scheme), tensor.bMatrix(scheme),
+                           iterations)
+
+    np.testing.assert_allclose(params[:, :6], _mrtrixOrder(mats), atol=1e-9)
+    np.testing.assert_allclose(np.exp(params[:, 6]), 1000., rtol=1e-6)
+
+
+def _dwi2tensor(signal, scheme, iterations, start='signal'):
+    """
+    Voxel by voxel fit as dwi2tensor: log signal floored at 1e-6 of its
+    maximum, weighted by the measured signal, then reweighted by the
+    predicted signal (start 'ols' starts from ordinary least squares)
+    """
+    bmat = tensor.bMatrix(scheme)
+    params = []
+    for voxel in signal:
+        voxel = np.maximum(voxel, 1e-6 * voxel.max())
+        w = voxel.copy() if start == 'signal' else np.ones(voxel.size)
+        for _ in range(iterations + 1):
+            p = np.linalg.lstsq(bmat * w[:, None], w * np.log(voxel),
+                                rcond=None)[0]
+            if iterations > 1:
+                w = np.exp(bmat.dot(p))
+        params.append(p)
+
+    return np.array(params)
+
+
+@pytest.mark.parametrize('iterations', [0, 1, 2, 3])
+def test_fit_noisy(iterations):
+    scheme = _scheme(directions=12, shells=(1000, 3000))
+    signal = _signal(_tensors(50, seed=2), scheme, s0=100.)
+    rng = np.random.RandomState(3)
+    noisy = np.abs(signal + rng.normal(scale=8., size=signal.shape) +
+                   1j * rng.normal(scale=8., size=signal.shape))
+
+    params = tensor.fitWLS(noisy, tensor.bMatrix(scheme), iterations)
+    expected = _dwi2tensor(noisy, scheme, iterations)
+    np.testing.assert_allclose(params, expected, rtol=1e-6, atol=1e-10)
+
+    # Starting from ordinary least squares gives other tensors
+    ols = _dwi2tensor(noisy, scheme, iterations, start='ols')
+    assert np.abs(ols[:, :6] - expected[:, :6]).max() > 1e-6
+
+
+def test_metrics():
+    fa, md, ad, rd = tensor.tensorMetrics(_mrtrixOrder(_tensors(5)))
+
+    mean = EVALS.mean()
+    expected_fa = np.sqrt(1.5 * ((EVALS - mean) ** 2).sum() /
+                          (EVALS ** 2).sum())
+    np.testing.assert_allclose(fa, expected_fa)
+    np.testing.assert_allclose(md, mean)
+    np.testing.assert_allclose(ad, EVALS[0])
+    np.testing.assert_allclose(rd, EVALS[1:].mean())
+
+    # Zero tensors have zero anisotropy rather than NaN
+    assert tensor.tensorMetrics(np.zeros((1, 6)))[0][0] == 0.
+
+
+@pytest.mark.parametrize('nprocs', [1, 2])
+def test_fit_image(tmpdir, nprocs):
+    shape = (4, 3, 5)
+    scheme = _scheme()
+    mats = _tensors(int(np.prod(shape)), seed=1)
+    dwi = _signal(mats, scheme).reshape(shape + (len(scheme),))
+    mask = np.zeros(shape, dtype=np.float32)
+    mask[1:, :, 1:4] = 1
+
+    affine = phantoms.getAffine(shape)
+    in_file = mif.save(str(tmpdir.join('dwi.mif')), dwi.astype(np.float32),
+                       affine, dw_scheme=scheme)
+    mask_file = phantoms.makeMif(str(tmpdir.join('mask.mif')), mask)
+    out_files = [str(tmpdir.join('%s.mif' % name))
+                 for name in ('tensor', 'fa', 'md', 'ad', 'rd')]
+
+    fitted = tensor.fitImage(in_file, out_files, mask_file=mask_file,
+                             chunk_size=4, nprocs=nprocs)
+    assert fitted == int(mask.sum())
+
+    inside = mask.astype(bool)
+    expected = _mrtrixOrder(mats).reshape(shape + (6,))
+    fit = mif.load(out_files[0])[0]
+    np.testing.assert_allclose(fit[inside], expected[inside], atol=1e-7)
+    assert not np.asarray(fit)[~inside].any()
+
+    md = mif.load(out_files[2])[0]
+    np.testing.assert_allclose(md[inside], EVALS.mean(), rtol=1e-3)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+tcksample outputs of several scalars merged column-wise by writeScalar
+"""
+import numpy as np
+import pytest
+
+from benchmarks import phantoms
+from mrtpipelines.interfaces.tractography import _writeScalar
+
+LENGTHS = np.array([3, 1, 4, 1, 5, 9, 2, 6])
+
+
+def _samples(tmpdir, lengths=LENGTHS):
+    return [phantoms.makeSampleText(str(tmpdir.join('%s.txt' % name)),
+                                    lengths, seed=seed)
+            for seed, name in enumerate(['FA', 'MD'])]
+
+
+def _values(in_file):
+    with open(in_file) as f:
+        return np.array([value for line in f if not line.startswith('#')
+                         for value in line.split()], dtype=np.float64)
+
+
+@pytest.mark.parametrize('out_format', ['txt', 'npz'])
+def test_combine(tmpdir, out_format):
+    in_files = _samples(tmpdir)
+    out_file = _writeScalar(in_files, str(tmpdir), out_format, chunk_size=3,
+                            names=['FA', 'MD'], combine=True)
+
+    if out_format == 'txt':
+        values = np.loadtxt(out_file, ndmin=2)
+        columns = [values[:, 0], values[:, 1]]
+    else:
+        with np.load(out_file) as npz:
+            np.testing.assert_array_equal(
+                npz['offsets'], np.concatenate([[0], np.cumsum(LENGTHS)]))
+            columns = [npz['FA'], npz['MD']]
+    for in_file, column in zip(in_files, columns):
+        np.testing.assert_allclose(column, _values(in_file), rtol=1e-6)
+
+
+def test_combine_truncated(tmpdir):
+    in_files = _samples(tmpdir)
+    with open(in_files[1]) as f:
+        lines = f.readlines()
+    with open(in_files[1], 'w') as f:
+        f.writelines(lines[:-4])
+
+    with pytest.raises(IOError):
+        _writeScalar(in_files, str(tmpdir), 'npz', chunk_size=3,
+                     names=['FA', 'MD'], combine=True)
+    # Whichever output ends first
+    with pytest.raises(IOError):
+        _writeScalar(in_files[::-1], str(tmpdir), 'txt', chunk_size=3,
+                     names=['MD', 'FA'], combine=True)
+
+
+def test_combine_mismatched(tmpdir):
+    in_files = _samples(tmpdir)
+    phantoms.makeSampleText(in_files[1], LENGTHS[::-1])
+
+    with pytest.raises(IOError):
+        _writeScalar(in_files, str(tmpdir), 'txt', chunk_size=3,
+                     names=['FA', 'MD'], combine=True)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Work queue claims, requeueing and attempts, with local workers
+"""
+import os
+import os.path as op
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from mrtpipelines.interfaces import workqueue
+
+SUCCEED = [sys.executable, '-c', 'pass']
+FAIL = [sys.executable, '-c', 'import sys; sys.exit(3)']
+
+
+def _claim(args):
+    return workqueue.claim(*args)
+
+
+def _age(path, seconds):
+    """ Move the modification time of path seconds into the past """
+    mtime = op.getmtime(path) - seconds
+    os.utime(path, (mtime, mtime))
+
+
+def _record(queue_dir, state, task_id):
+    return workqueue._readJSON(op.join(queue_dir, state,
+                                       '%s.json' % task_id))
+
+
+def test_claim_exclusive(tmpdir):
+    queue_dir = workqueue.initQueue(str(tmpdir))
+    workqueue.submit(queue_dir, 't', SUCCEED)
+
+    with ProcessPoolExecutor(max_workers=8) as pool:
+        won = list(pool.map(_claim, [(queue_dir, 't', 'w%d' % idx)
+                                     for idx in range(16)]))
+    assert sum(won) == 1
+    assert workqueue._holds(queue_dir, 't', 'w%d' % won.index(True))
+    assert workqueue.taskState(queue_dir, 't') == 'running'
+
+    # A finished task cannot be claimed again
+    workqueue._release(queue_dir, 't')
+    workqueue._writeJSON(op.join(queue_dir, 'done', 't.json'), {})
+    assert not workqueue.claim(queue_dir, 't', 'late')
+    assert not op.exists(op.join(queue_dir, 'claims', 't.lock'))
+
+
+def test_requeue_dead_worker(tmpdir):
+    queue_dir = workqueue.initQueue(str(tmpdir))
+    workqueue.submit(queue_dir, 'dead', SUCCEED)
+    workqueue.submit(queue_dir, 'alive', SUCCEED)
+    assert workqueue.claim(queue_dir, 'dead', 'w1')
+    assert workqueue.claim(queue_dir, 'alive', 'w2')
+    _age(op.join(queue_dir, 'claims', 'dead.lock'), 100)
+
+    assert workqueue.requeueStale(queue_dir, timeout=50) == ['dead']
+    assert workqueue.taskState(queue_dir, 'dead') == 'pending'
+    assert workqueue.taskState(queue_dir, 'alive') == 'running'
+    task = workqueue._readJSON(op.join(queue_dir, 'tasks', 'dead.json'))
+    assert task['attempt'] == 1
+
+    assert workqueue.runWorker(queue_dir, 'w3', heartbeat=1, poll=.1,
+                               max_tasks=1) == 1
+    assert workqueue.taskState(queue_dir, 'dead') == 'done'
+    assert _record(queue_dir, 'done', 'dead')['attempt'] == 1
+    assert op.exists(op.join(queue_dir, 'logs', 'dead.1.log'))
+
+
+def test_requeue_races(tmpdir):
+    queue_dir = workqueue.initQueue(str(tmpdir))
+    workqueue.submit(queue_dir, 'busy', SUCCEED)
+    workqueue.submit(queue_dir, 'finished', SUCCEED)
+    for task_id in ('busy', 'finished'):
+        assert workqueue.claim(queue_dir, task_id, 'w1')
+        _age(op.join(queue_dir, 'claims', '%s.lock' % task_id), 100)
+
+    # Another coordinator is requeueing 'busy'
+    lock_file = op.join(queue_dir, 'claims', 'busy.requeue')
+    open(lock_file, 'w').close()
+    # 'finished' completed, but its worker died before releasing the claim
+    workqueue._writeJSON(op.join(queue_dir, 'done', 'finished.json'),
+                         {'returncode': 0})
+
+    assert workqueue.requeueStale(queue_dir, timeout=50) == []
+    assert workqueue.taskState(queue_dir, 'busy') == 'running'
+    assert workqueue.taskState(queue_dir, 'finished') == 'done'
+    assert not op.exists(op.join(queue_dir, 'claims', 'finished.lock'))
+
+    # The lock of a coordinator that died is cleared once stale
+    _age(lock_file, 100)
+    assert workqueue.requeueStale(queue_dir, timeout=50) == ['busy']
+    assert not op.exists(lock_file)
+
+
+def test_attempts_exhausted(tmpdir):
+    queue_dir = workqueue.initQueue(str(tmpdir))
+    workqueue.submit(queue_dir, 'bad', FAIL, max_attempts=2)
+
+    assert workqueue.runWorker(queue_dir, 'w1', heartbeat=1, poll=.1) == 2
+    assert workqueue.taskState(queue_dir, 'bad') == 'failed'
+    record = _record(queue_dir, 'failed', 'bad')
+    assert record['returncode'] == 3 and record['attempt'] == 1
+    assert sorted(os.listdir(op.join(queue_dir, 'logs'))) == \
+        ['bad.0.log', 'bad.1.log']
+
+
+def test_missing_command(tmpdir):
+    queue_dir = workqueue.initQueue(str(tmpdir))
+    workqueue.submit(queue_dir, 'c', ['/nonexistent/cmd'], max_attempts=2)
+
+    assert workqueue.runWorker(queue_dir, 'w1', heartbeat=1, poll=.1) == 2
+    record = _record(queue_dir, 'failed', 'c')
+    assert record['returncode'] == 127
+    assert '/nonexistent/cmd' in record['error']
+    assert os.listdir(op.join(queue_dir, 'claims')) == []
+    with open(op.join(queue_dir, 'logs', 'c.0.log')) as f:
+        assert 'Could not run' in f.read()